@@ -0,0 +1,252 @@
+""" Benchmarks for loading, querying and generating from policy lists.
+
+Runs every benchmark against deterministic synthetic policy lists of the
+given sizes and writes the best time of each to a JSON file. With
+`--compare`, the results are checked against a saved baseline, and the
+exit status is 1 if any benchmark got slower by more than the threshold.
+
+    python -m starttls_policy_cli.benchmark --sizes 1000,100000 --output base.json
+    python -m starttls_policy_cli.benchmark --sizes 1000,100000 --compare base.json
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+from starttls_policy_cli import configure
+from starttls_policy_cli import constants
+from starttls_policy_cli import policy
+
+RESULTS_VERSION = 1
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# Number of distinct MX hostname suffixes; policies share them, as real ones do.
+_MX_SUFFIXES = 50
+
+def synthetic_policy_list(domains, alias_ratio=0.1, mx_count=2, aliases=10, seed=0):
+    """ Returns a valid policy list (as a dict, like the parsed JSON) with
+    `domains` policies. A fraction `alias_ratio` of them refer to one of
+    `aliases` policy aliases, and the others have `mx_count` MX patterns.
+    The same arguments always give the same list. """
+    rand = random.Random(seed)
+    policy_aliases = {}
+    for i in range(aliases):
+        policy_aliases["alias{}".format(i)] = {
+            "mode": "enforce",
+            "mxs": [".mx{}.alias{}.example".format(j, i) for j in range(mx_count)],
+        }
+    policies = {}
+    for i in range(domains):
+        domain = "domain{}.{}.example".format(i, rand.choice(("com", "net", "org")))
+        if policy_aliases and rand.random() < alias_ratio:
+            policies[domain] = {"policy-alias": "alias{}".format(rand.randrange(aliases))}
+            continue
+        mxs = []
+        for j in range(mx_count):
+            suffix = "provider{}.example".format(rand.randrange(_MX_SUFFIXES))
+            mxs.append(".{}".format(suffix) if j % 2 else "mx{}.{}".format(j, suffix))
+        policies[domain] = {"mode": rand.choice(("enforce", "testing")), "mxs": mxs}
+    return {
+        "author": "Synthetic benchmark list",
+        "timestamp": "2018-06-18T09:41:50-07:00",
+        "expires": "2038-01-16T09:41:50-07:00",
+        "policy-aliases": policy_aliases,
+        "policies": policies,
+    }
+
+class _Case(object):
+    # pylint: disable=useless-object-inheritance
+    """ A synthetic policy list written to a temporary directory,
+    with the loaded configurations the benchmarks need. """
+
+    def __init__(self, domains, alias_ratio, mx_count, seed):
+        self.params = collections.OrderedDict([
+            ("domains", domains), ("alias_ratio", alias_ratio), ("mx_count", mx_count)])
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, constants.POLICY_FILENAME)
+        data = synthetic_policy_list(domains, alias_ratio, mx_count, seed=seed)
+        with open(self.filename, "w") as f:
+            json.dump(data, f)
+        # A newer list for merging: some policies changed, some added.
+        newer = synthetic_policy_list(domains // 10, alias_ratio, mx_count, seed=seed + 1)
+        newer["policies"].update((domain, {"mode": "enforce", "mxs": ["mx.changed.example"]})
+                                 for domain in sorted(data["policies"])[::20])
+        self.newer_data = newer
+        self.config = self.load()
+        self.domains = sorted(self.config)
+
+    def load(self):
+        """ Loads the policy list from its file. """
+        config = policy.Config(self.filename)
+        config.load()
+        return config
+
+    def cleanup(self):
+        """ Removes the temporary directory. """
+        shutil.rmtree(self.directory)
+
+def _timed(func):
+    start = timeit.default_timer()
+    func()
+    return timeit.default_timer() - start
+
+def _bench_load(case):
+    return _timed(case.load)
+
+def _bench_load_stream(case):
+    return _timed(lambda: policy.Config(case.filename).load(stream=True))
+
+def _bench_load_snapshot(case):
+    # The first run builds the snapshot; `repeat` keeps the best time.
+    return _timed(lambda: policy.Config(case.filename).load(snapshot=True))
+
+def _bench_validate(case):
+    return _timed(policy.Config(case.filename).collect_errors)
+
+def _bench_get_policy_for(case):
+    get_policy_for = case.config.get_policy_for
+    domains = case.domains
+    def lookups():
+        for domain in domains:
+            get_policy_for(domain)
+    return _timed(lookups)
+
+def _bench_get_policies_for(case):
+    return _timed(lambda: case.config.get_policies_for(case.domains))
+
+def _bench_merge(case):
+    newer = policy.Config()
+    newer.load_from_dict(case.newer_data)
+    older = case.load()
+    return _timed(lambda: older.merge(newer))
+
+def _bench_dump(case):
+    return _timed(case.config.dump)
+
+def _bench_flush(case):
+    filename = os.path.join(case.directory, "flushed.json")
+    return _timed(lambda: case.config.flush(filename))
+
+def _bench_generate(case):
+    generator = configure.PostfixGenerator(case.directory)
+    generator._policy_config = case.config # pylint: disable=protected-access
+    # Remove the output, so it is written rather than found unchanged.
+    output = os.path.join(case.directory, generator.default_filename)
+    if os.path.exists(output):
+        os.remove(output)
+    return _timed(generator.generate)
+
+BENCHMARKS = collections.OrderedDict([
+    ("load", _bench_load),
+    ("load_stream", _bench_load_stream),
+    ("load_snapshot", _bench_load_snapshot),
+    ("validate", _bench_validate),
+    ("get_policy_for", _bench_get_policy_for),
+    ("get_policies_for", _bench_get_policies_for),
+    ("merge", _bench_merge),
+    ("dump", _bench_dump),
+    ("flush", _bench_flush),
+    ("generate", _bench_generate),
+])
+
+def run_benchmarks(sizes=DEFAULT_SIZES, alias_ratio=0.1, mx_count=2, repeat=3,
+                   names=None, seed=0, progress=None):
+    """ Runs the benchmarks named in `names` (default: all) on synthetic
+    lists of each size, keeping the best of `repeat` runs. If given,
+    `progress` is called with each result as it is measured.
+    Returns the results as a JSON-serializable dict. """
+    # pylint: disable=too-many-arguments
+    results = []
+    for size in sizes:
+        case = _Case(size, alias_ratio, mx_count, seed)
+        try:
+            for name in names or BENCHMARKS:
+                runs = [BENCHMARKS[name](case) for _ in range(repeat)]
+                result = collections.OrderedDict([("benchmark", name)])
+                result.update(case.params)
+                result["seconds"] = min(runs)
+                result["runs"] = runs
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+        finally:
+            case.cleanup()
+    return {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "results": results,
+    }
+
+def _key(result):
+    return (result["benchmark"], result["domains"], result["alias_ratio"], result["mx_count"])
+
+def compare(baseline, current, threshold=0.25):
+    """ Compares two results dicts from `run_benchmarks`. Returns a list of
+    (result, baseline seconds) pairs for the benchmarks in `current` that
+    are more than `threshold` (a fraction) slower than in `baseline`.
+    Benchmarks missing from `baseline` are ignored. """
+    previous = dict((_key(result), result["seconds"]) for result in baseline["results"])
+    regressions = []
+    for result in current["results"]:
+        old = previous.get(_key(result))
+        if old is not None and result["seconds"] > old * (1 + threshold):
+            regressions.append((result, old))
+    return regressions
+
+def _format(result):
+    return "{benchmark:>16} {domains:>8} domains: {seconds:.4f}s".format(**result)
+
+def _argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks policy list handling on synthetic policy lists",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Comma-separated numbers of domains in the synthetic lists.")
+    parser.add_argument("--alias-ratio", type=float, default=0.1, dest="alias_ratio",
+                        help="Fraction of domains that use a policy alias.")
+    parser.add_argument("--mx-count", type=int, default=2, dest="mx_count",
+                        help="Number of MX patterns of each policy.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each benchmark; the best one is kept.")
+    parser.add_argument("--benchmark", action="append", choices=BENCHMARKS, dest="names",
+                        help="Only run this benchmark. May be given several times.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="Compare the results with those saved in this file.")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="With --compare, the slowdown (as a fraction) that counts "
+                        "as a regression.")
+    return parser
+
+def main(argv=None):
+    """ Entrypoint for running the benchmarks. """
+    arguments = _argument_parser().parse_args(argv)
+    sizes = [int(size) for size in arguments.sizes.split(",")]
+    results = run_benchmarks(sizes, arguments.alias_ratio, arguments.mx_count,
+                             arguments.repeat, arguments.names,
+                             progress=lambda result: print(_format(result)))
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, arguments.threshold)
+        for result, old in regressions:
+            print("REGRESSION {} (was {:.4f}s)".format(_format(result), old), file=sys.stderr)
+        if regressions:
+            return 1
+        print("No regressions against {}".format(arguments.compare))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,130 @@
+""" Reader and writer for constant databases (CDB), as read by Postfix `cdb:` tables. """
+import struct
+
+_HEADER = struct.Struct("<" + "LL" * 256)
+_PAIR = struct.Struct("<LL")
+_MAX_OFFSET = 0xffffffff
+
+def cdb_hash(key):
+    """ The CDB hash function of the byte string `key`. """
+    h = 5381
+    for char in bytearray(key):
+        h = ((h << 5) + h ^ char) & 0xffffffff
+    return h
+
+class CDBError(Exception):
+    """ Raised when a database is corrupt or too large for the CDB format. """
+
+class Writer(object):
+    # pylint: disable=useless-object-inheritance
+    """ Streams records into a CDB file.
+
+    Records are written to the seekable binary `fileobj` as they are added;
+    only the hash and offset of each record are kept in memory, from which
+    the hash tables are built by `finish()`.
+    """
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._pos = _HEADER.size
+        self._buckets = [[] for _ in range(256)]
+        self._file.write(b"\0" * _HEADER.size)
+
+    def _advance(self, size):
+        self._pos += size
+        if self._pos > _MAX_OFFSET:
+            raise CDBError("Database exceeds the 4 GiB limit of the CDB format")
+
+    def add(self, key, value):
+        """ Adds a record. `key` and `value` are byte strings. """
+        h = cdb_hash(key)
+        self._buckets[h & 0xff].append((h, self._pos))
+        self._file.write(_PAIR.pack(len(key), len(value)))
+        self._file.write(key)
+        self._file.write(value)
+        self._advance(_PAIR.size + len(key) + len(value))
+
+    def finish(self):
+        """ Writes the hash tables and the header. No records can be added afterwards. """
+        header = []
+        for bucket in self._buckets:
+            slots = 2 * len(bucket)
+            table = [(0, 0)] * slots
+            for h, pos in bucket:
+                slot = (h >> 8) % slots
+                while table[slot][1]:
+                    slot = (slot + 1) % slots
+                table[slot] = (h, pos)
+            header.extend((self._pos, slots))
+            for h, pos in table:
+                self._file.write(_PAIR.pack(h, pos))
+            self._advance(_PAIR.size * slots)
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(*header))
+        self._file.seek(self._pos)
+        self._buckets = None
+
+class Reader(object):
+    # pylint: disable=useless-object-inheritance
+    """ Looks up records in CDB `data`, which may be a byte string or
+    any other buffer such as an `mmap`. """
+
+    def __init__(self, data):
+        if len(data) < _HEADER.size:
+            raise CDBError("Database is truncated")
+        self._data = data
+
+    def _read_pair(self, pos):
+        if pos + _PAIR.size > len(self._data):
+            raise CDBError("Database is truncated")
+        return _PAIR.unpack(self._data[pos:pos + _PAIR.size])
+
+    def _record(self, pos):
+        klen, vlen = self._read_pair(pos)
+        start = pos + _PAIR.size
+        if start + klen + vlen > len(self._data):
+            raise CDBError("Database is truncated")
+        return (bytes(self._data[start:start + klen]),
+                bytes(self._data[start + klen:start + klen + vlen]))
+
+    def get_all(self, key):
+        """ Returns the values of all records stored under `key`, in the order they were added. """
+        h = cdb_hash(key)
+        table_pos, slots = self._read_pair(8 * (h & 0xff))
+        values = []
+        if not slots:
+            return values
+        slot = (h >> 8) % slots
+        for _ in range(slots):
+            slot_hash, pos = self._read_pair(table_pos + 8 * slot)
+            if not pos:
+                break
+            if slot_hash == h:
+                record_key, value = self._record(pos)
+                if record_key == key:
+                    values.append(value)
+            slot = (slot + 1) % slots
+        return values
+
+    def get(self, key, default=None):
+        """ Returns the first value stored under `key`, or `default`. """
+        values = self.get_all(key)
+        return values[0] if values else default
+
+    def __getitem__(self, key):
+        values = self.get_all(key)
+        if not values:
+            raise KeyError(key)
+        return values[0]
+
+    def __contains__(self, key):
+        return bool(self.get_all(key))
+
+    def items(self):
+        """ Iterates over all (key, value) records in file order. """
+        pos = _HEADER.size
+        end = min(self._read_pair(8 * i)[0] for i in range(256))
+        while pos < end:
+            key, value = self._record(pos)
+            yield key, value
+            pos += _PAIR.size + len(key) + len(value)
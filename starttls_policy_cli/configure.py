@@ -3,15 +3,47 @@ Config generator
 """
 import sys
 import abc
+import collections
+import io
+import json
+import operator
 import os
 import six
 
+from starttls_policy_cli import cdb
 from starttls_policy_cli import constants
 from starttls_policy_cli import policy
+from starttls_policy_cli import profiling
 from starttls_policy_cli import util
 
+# Sort key for (domain, policy) pairs.
+_domain = operator.itemgetter(0)
+
+class PolicyDelta(collections.namedtuple('PolicyDelta', ('added', 'removed', 'changed'))):
+    """Sorted lists of mail domains whose policies were added, removed or
+    changed since the previous incremental run. False if there are none.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    __nonzero__ = __bool__ # Python 2
+
+class GenerateResult(collections.namedtuple('GenerateResult', ('changed', 'delta'))):
+    """Outcome of `ConfigGenerator.generate`: whether the configuration file
+    was (re)written, and for incremental runs the `PolicyDelta` since the
+    previous run (otherwise None). True if the file changed.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return self.changed
+
+    __nonzero__ = __bool__ # Python 2
+
 class ConfigGenerator(object):
-    # pylint: disable=useless-object-inheritance
+    # pylint: disable=useless-object-inheritance,too-many-instance-attributes
     """
     Generic configuration generator.
     The two primary public functions:
@@ -20,21 +52,45 @@ class ConfigGenerator(object):
     """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, policy_dir, enforce_testing=False):
+    # Mode in which the configuration file is opened for `_write_config`.
+    file_mode = "w"
+
+    def __init__(self, policy_dir, enforce_testing=False, fsync=False, overlays=()):
         self._policy_dir = policy_dir
         self._enforce_testing = enforce_testing
+        self._fsync = fsync
+        self._overlays = tuple(overlays)
         self._policy_filename = os.path.join(self._policy_dir, constants.POLICY_FILENAME)
         self._config_filename = os.path.join(self._policy_dir, self.default_filename)
+        self._state_filename = self._config_filename + ".state"
         self._policy_config = None
 
     def _load_config(self):
         if self._policy_config is None:
-            self._policy_config = policy.Config(filename=self._policy_filename)
-            self._policy_config.load()
+            config = policy.Config(filename=self._policy_filename)
+            config.load(snapshot=True)
+            if self._overlays:
+                layers = [config]
+                for filename in self._overlays:
+                    # Lazy, so only the policies that win the merge are validated.
+                    overlay = policy.Config(filename=filename, schema=util.OVERLAY_SCHEMA,
+                                            lazy=True)
+                    overlay.load()
+                    layers.append(overlay)
+                config = policy.merge_all(layers)
+            self._policy_config = config
         return self._policy_config
 
     def _write_config(self, result, output):
-        six.print_(result, file=output)
+        if isinstance(result, six.string_types):
+            six.print_(result, file=output)
+            return
+        empty = True
+        for line in result:
+            output.write(line + "\n")
+            empty = False
+        if empty:
+            output.write("\n")
 
     def _expired_warning(self):
         """Warns user about policy list expiration.
@@ -46,17 +102,98 @@ class ConfigGenerator(object):
                        .format(config_location=self._policy_filename),
                    file=sys.stderr)
 
-    def generate(self):
+    def generate(self, incremental=False):
         """Generates and dumps MTA configuration file to `policy_dir`.
+
+        Lines are streamed into a temporary file that then atomically
+        replaces the configuration file, so the MTA never reads a truncated
+        file. If the generator was created with `fsync`, the data is flushed
+        to disk before the rename. If the generated content hashes the same
+        as the existing file, the existing file is left untouched.
+
+        If `incremental` is set, the policies are also compared against the
+        state saved next to the configuration file by the previous
+        incremental run, and nothing is generated if no policy changed and
+        the configuration file is still the one that run wrote.
+
+        Returns a `GenerateResult`, which is False if the configuration file
+        was left unchanged, so callers can skip reloading the MTA.
         """
-        policy_list = self._load_config()
-        if util.is_expired(policy_list.expires):
+        with profiling.phase("load"):
+            policy_list = self._load_config()
+        expired = util.is_expired(policy_list.expires)
+        if expired:
             self._expired_warning()
-            result = self._generate_expired_fallback(policy_list)
-        else:
-            result = self._generate(policy_list)
-        with open(self._config_filename, "w") as config_file:
-            self._write_config(result, config_file)
+        delta = None
+        if incremental:
+            with profiling.phase("state"):
+                state = self._policy_state(policy_list, expired)
+                previous = self._load_state()
+                delta = self._state_delta(previous, state)
+            if not delta and self._unchanged_since(previous):
+                return GenerateResult(False, delta)
+        with profiling.phase("generate"):
+            if expired:
+                result = self._generate_expired_fallback(policy_list)
+            else:
+                result = self._generate(policy_list)
+        # Lines are generated as they are written; count that as generation.
+        result = profiling.iterate("generate", result)
+        with profiling.phase("write"):
+            with util.AtomicFile(self._config_filename, mode=self.file_mode, fsync=self._fsync,
+                                 keep_unchanged=True) as config_file:
+                self._write_config(result, config_file)
+            if incremental:
+                state["digest"] = util.file_digest(self._config_filename)
+                with util.AtomicFile(self._state_filename, fsync=self._fsync) as state_file:
+                    json.dump(state, state_file)
+        return GenerateResult(config_file.changed, delta)
+
+    def _options(self):
+        """Generator settings that affect the output, besides the policies."""
+        return {"enforce-testing": self._enforce_testing}
+
+    def _policy_state(self, policy_list, expired):
+        """Summary of everything the generated file depends on, in a form
+        that can be stored as JSON and compared between runs."""
+        policies = {}
+        if not expired:
+            for domain, tls_policy in policy_list.resolved_items():
+                policies[domain] = [tls_policy.mode, tls_policy.mxs]
+        return {"options": self._options(), "expired": expired, "policies": policies}
+
+    def _load_state(self):
+        """The state saved by the previous incremental run, or an empty
+        dict if there is none."""
+        try:
+            with io.open(self._state_filename, encoding="utf-8") as state_file:
+                previous = json.load(state_file)
+        except (IOError, ValueError):
+            return {}
+        return previous if isinstance(previous, dict) else {}
+
+    def _unchanged_since(self, previous):
+        """Whether the configuration file is still the one written by the
+        run that saved the state `previous`, and wasn't removed or rewritten
+        since, e.g. by a run that wasn't incremental."""
+        try:
+            return previous.get("digest") == util.file_digest(self._config_filename)
+        except (IOError, OSError):
+            return False
+
+    def _state_delta(self, previous, state):
+        """Compares `state` with the state `previous` saved by the previous run.
+        Every domain counts as changed if the generator options changed."""
+        old = previous.get("policies", {})
+        new = state["policies"]
+        same_options = (previous.get("options") == state["options"] and
+                        previous.get("expired") == state["expired"])
+        return PolicyDelta(
+            added=sorted(domain for domain in new if domain not in old),
+            removed=sorted(domain for domain in old if domain not in new),
+            changed=sorted(domain for domain in new
+                           if domain in old and (old[domain] != new[domain] or
+                                                 not same_options)))
 
     def manual_instructions(self):
         """Prints manual installation instructions to stdout.
@@ -66,9 +203,27 @@ class ConfigGenerator(object):
                     mta_name=self.mta_name,
                     instructions=self._instruct_string()))
 
+    @property
+    def policy_list(self):
+        """The `policy.Config` the configuration file is generated from,
+        loaded on first use."""
+        return self._load_config()
+
+    @policy_list.setter
+    def policy_list(self, value):
+        """Generates from `value` instead of loading the policy list, e.g.
+        to share one already loaded by another generator."""
+        self._policy_config = value
+
+    @property
+    def config_filename(self):
+        """Path of the generated configuration file."""
+        return self._config_filename
+
     @abc.abstractmethod
     def _generate(self, policy_list):
-        """Creates configuration file. Returns a unicode string (text to write to file)."""
+        """Creates configuration file. Returns an iterable of lines to write to
+        the file (without line endings), or a single unicode string."""
 
     @abc.abstractmethod
     def _generate_expired_fallback(self, policy_list):
@@ -87,16 +242,46 @@ class ConfigGenerator(object):
     def default_filename(self):
         """The expected default filename of the generated configuration file."""
 
+def generate_all(generators, incremental=False, threads=None):
+    """Runs `generate` on several generators for the same policy list.
+
+    The policy list is loaded once, by the first generator, and shared
+    with the others. The configuration files are then generated and
+    written concurrently on a pool of `threads` threads (by default, one
+    per generator); generators only read the shared policy list.
+
+    Returns the `GenerateResult` of each generator, in order.
+    """
+    generators = list(generators)
+    if not generators:
+        return []
+    with profiling.phase("load"):
+        policy_list = generators[0].policy_list
+        # Complete the alias-resolved view up front, so the threads only read it.
+        policy_list.resolved_items()
+    for generator in generators[1:]:
+        generator.policy_list = policy_list
+    if len(generators) == 1 or threads == 1:
+        return [generator.generate(incremental=incremental) for generator in generators]
+    from multiprocessing.pool import ThreadPool # pylint: disable=import-outside-toplevel
+    pool = ThreadPool(threads or len(generators))
+    try:
+        # Phases entered by the worker threads aren't timed, so count the wait.
+        with profiling.phase("generate"):
+            return pool.map(lambda generator: generator.generate(incremental=incremental),
+                            generators)
+    finally:
+        pool.close()
+        pool.join()
+
 class PostfixGenerator(ConfigGenerator):
     """Configuration generator for postfix.
     """
 
     def _generate(self, policy_list):
-        policies = []
-        max_domain_len = len(max(policy_list, key=len))
-        for domain, tls_policy in sorted(six.iteritems(policy_list)):
-            policies.append(self._policy_for_domain(domain, tls_policy, max_domain_len))
-        return "\n".join(policies)
+        max_domain_len = max(len(domain) for domain in policy_list) if policy_list else 0
+        for domain, tls_policy in sorted(policy_list.resolved_items(), key=_domain):
+            yield self._policy_for_domain(domain, tls_policy, max_domain_len)
 
     def _generate_expired_fallback(self, policy_list):
         return "# Policy list is outdated. Falling back to opportunistic encryption."
@@ -116,14 +301,30 @@ class PostfixGenerator(ConfigGenerator):
 
     def _policy_for_domain(self, domain, tls_policy, max_domain_len):
         line = ("{0:%d} " % max_domain_len).format(domain)
-        mode = tls_policy.mode
-        if mode == "enforce" or self._enforce_testing and mode == "testing":
-            line += " secure match="
-            line += ":".join(tls_policy.mxs)
-        elif mode == "testing":
+        value = self._policy_value(tls_policy)
+        if value is not None:
+            line += " " + value
+        elif tls_policy.mode == "testing":
             line = "# " + line + "undefined due to testing policy"
         return line
 
+    def _policy_value(self, tls_policy):
+        """The Postfix TLS policy for `tls_policy`, or None if the domain
+        should be left out of the table."""
+        mode = tls_policy.mode
+        if mode == "enforce" or self._enforce_testing and mode == "testing":
+            return "secure match=" + ":".join(tls_policy.mxs)
+        return None
+
+    def lookup_table(self, policy_list):
+        """Yields (domain, Postfix TLS policy) pairs for the domains of
+        `policy_list` that are in the table, sorted by domain. Domains are
+        folded to lowercase, as postmap does with table keys."""
+        for domain, tls_policy in sorted(policy_list.resolved_items(), key=_domain):
+            value = self._policy_value(tls_policy)
+            if value is not None:
+                yield domain.lower(), value
+
     @property
     def mta_name(self):
         return "Postfix"
@@ -131,3 +332,39 @@ class PostfixGenerator(ConfigGenerator):
     @property
     def default_filename(self):
         return "postfix_tls_policy"
+
+class PostfixCDBGenerator(PostfixGenerator):
+    """Configuration generator for postfix that writes a `cdb:` table
+    directly, so the table doesn't have to be compiled with postmap.
+    """
+    file_mode = "wb"
+
+    def _generate(self, policy_list):
+        return self.lookup_table(policy_list)
+
+    def _generate_expired_fallback(self, policy_list):
+        # Without any policies, Postfix falls back to opportunistic encryption.
+        return ()
+
+    def _write_config(self, result, output):
+        writer = cdb.Writer(output)
+        for domain, value in result:
+            writer.add(domain.encode("utf-8"), value.encode("utf-8"))
+        writer.finish()
+
+    def _instruct_string(self):
+        filename = self._config_filename
+        abs_path = os.path.abspath(filename)
+        table = abs_path[:-len(".cdb")]
+        return ("\nYou'll need to point your Postfix configuration to {filename}.\n"
+            "This requires Postfix with CDB support: check that `postconf -m` lists cdb.\n"
+            "Check if `postconf smtp_tls_policy_maps` includes this file.\n"
+            "If not, run:\n\n"
+            "postconf -e \"smtp_tls_policy_maps=$(postconf -h smtp_tls_policy_maps)"
+            " cdb:{table}\"\n\n"
+            "And finally:\n\n"
+            "postfix reload\n").format(table=table, filename=filename)
+
+    @property
+    def default_filename(self):
+        return "postfix_tls_policy.cdb"
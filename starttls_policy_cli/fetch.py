@@ -0,0 +1,102 @@
+""" Downloads the policy list, only when it changed.
+
+Requests are conditional: the ETag and Last-Modified headers of the last
+download are saved next to the policy list, and sent back as If-None-Match
+and If-Modified-Since, so an unchanged list costs a 304 response instead of
+a full download. A new list is streamed to a temporary file and validated
+before it atomically replaces the local copy, so a truncated or invalid
+download never replaces a good list.
+"""
+import collections
+import json
+
+from six.moves.urllib import error as urllib_error
+from six.moves.urllib import request as urllib_request
+
+from starttls_policy_cli import policy
+from starttls_policy_cli import profiling
+from starttls_policy_cli import util
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_TIMEOUT = 60
+
+class FetchResult(collections.namedtuple('FetchResult', ('changed', 'status'))):
+    """ Outcome of `fetch`: whether the local policy list was replaced, and
+    the HTTP status of the response (304 if the list wasn't modified since
+    the last download). True if the policy list changed.
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return self.changed
+
+    __nonzero__ = __bool__ # Python 2
+
+def _state_filename(filename):
+    return filename + ".fetch"
+
+def _load_state(url, filename):
+    """ The headers saved by the last download of `url` to `filename`,
+    unless the file has changed since, or the download was from elsewhere. """
+    try:
+        with open(_state_filename(filename)) as f:
+            state = json.load(f)
+        if state.get("url") != url or state.get("digest") != util.file_digest(filename):
+            return {}
+    except (IOError, OSError, ValueError):
+        return {}
+    return state
+
+def _validate(filename):
+    """ Raises `util.ConfigError` for the first error found in the policy
+    list `filename`, whatever its structure. """
+    errors = policy.Config(filename).collect_errors()
+    if errors:
+        location, message = errors[0]
+        raise util.ConfigError("Invalid policy list: {}{}".format(
+            "/".join(location) + ": " if location else "", message))
+
+def fetch(url, filename, timeout=DEFAULT_TIMEOUT, fsync=False):
+    """ Downloads the policy list at `url` to `filename`, unless the server
+    reports that it wasn't modified since the last download. The download
+    is validated with `policy.Config.collect_errors` before it replaces
+    `filename`; an invalid policy list raises `util.ConfigError` and leaves
+    `filename` as it was. HTTP and network errors are raised as well.
+    If `fsync` is set, the file is flushed to disk before the rename.
+    Returns a `FetchResult`.
+    """
+    state = _load_state(url, filename)
+    request = urllib_request.Request(url)
+    if state.get("etag"):
+        request.add_header("If-None-Match", state["etag"])
+    if state.get("last-modified"):
+        request.add_header("If-Modified-Since", state["last-modified"])
+    try:
+        response = urllib_request.urlopen(request, timeout=timeout)
+    except urllib_error.HTTPError as e:
+        if e.code != 304:
+            raise
+        e.close()
+        return FetchResult(False, 304)
+    try:
+        with util.AtomicFile(filename, mode="wb", fsync=fsync, keep_unchanged=True) as output:
+            with profiling.phase("download"):
+                chunk = response.read(CHUNK_SIZE)
+                while chunk:
+                    output.write(chunk)
+                    chunk = response.read(CHUNK_SIZE)
+                output.flush()
+            _validate(output.tmp_filename)
+        headers = response.info()
+        status = response.getcode()
+    finally:
+        response.close()
+    state = {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last-modified": headers.get("Last-Modified"),
+        "digest": util.file_digest(filename),
+    }
+    with util.AtomicFile(_state_filename(filename), fsync=fsync) as state_file:
+        json.dump(state, state_file)
+    return FetchResult(output.changed, status)
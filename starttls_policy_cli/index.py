@@ -0,0 +1,228 @@
+""" On-disk index of a policy list, for domain lookups without loading the list.
+
+The index is a single file that is memory-mapped by `PolicyIndex`, so
+lookups only touch the pages they need, and processes reading the same
+index share them through the page cache. Policy aliases are resolved when
+the index is built.
+
+Layout (all integers little-endian):
+
+    header:  magic "STPI", format version (u32), number of domains (u32),
+             length of the JSON-encoded config header fields (u32)
+    fields:  the JSON object of `author`, `expires` and `timestamp`
+    offsets: one u32 per domain, the offset of its record, sorted by domain
+    records: domain length (u16), domain (UTF-8), mode index into
+             `util.ENFORCE_MODES` (u8), min-tls-version length (u16,
+             0xffff if unset), min-tls-version, number of MXs (u16), and
+             each MX as length (u16) followed by the hostname
+"""
+import json
+import mmap
+import struct
+
+import six
+
+from starttls_policy_cli import policy
+from starttls_policy_cli import util
+
+try:
+    # Python 3.3+
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+MAGIC = b"STPI"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<4sIII")
+_OFFSET = struct.Struct("<I")
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_UNSET = 0xffff
+_MODE_IDS = dict((mode, i) for i, mode in enumerate(util.ENFORCE_MODES))
+
+class IndexFormatError(util.ConfigError):
+    """ Raised when an index file is invalid or can't hold a policy list. """
+
+def _pack_string(value):
+    data = value.encode("utf-8")
+    if len(data) >= _UNSET:
+        raise IndexFormatError("Value too long for the index: {}".format(value))
+    return _U16.pack(len(data)) + data
+
+def _pack_record(domain, tls_policy):
+    parts = [_pack_string(domain), _U8.pack(_MODE_IDS[tls_policy.mode])]
+    if tls_policy.min_tls_version is None:
+        parts.append(_U16.pack(_UNSET))
+    else:
+        parts.append(_pack_string(tls_policy.min_tls_version))
+    mxs = tls_policy.mxs
+    parts.append(_U16.pack(len(mxs)))
+    parts.extend(_pack_string(mx) for mx in mxs)
+    return b"".join(parts)
+
+def write_index(config, filename, fsync=False):
+    """ Builds the index of the policies in `config` and atomically
+    writes it to `filename`. """
+    domains = sorted(config.keys(), key=lambda domain: domain.encode("utf-8"))
+    fields = json.dumps(dict((key, getattr(config, util.as_attr(key)))
+                             for key in ("author", "expires", "timestamp")),
+                        cls=policy.ConfigEncoder).encode("utf-8")
+    offsets = []
+    pos = _HEADER.size + len(fields) + _OFFSET.size * len(domains)
+    with util.AtomicFile(filename, mode="wb", fsync=fsync) as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(domains), len(fields)))
+        f.write(fields)
+        f.write(b"\0" * (_OFFSET.size * len(domains)))
+        for domain in domains:
+            record = _pack_record(domain, config.get_policy_for(domain))
+            offsets.append(pos)
+            f.write(record)
+            pos += len(record)
+            if pos > 0xffffffff:
+                raise IndexFormatError("Policy list is too large for the index")
+        f.seek(_HEADER.size + len(fields))
+        f.write(struct.pack("<{}I".format(len(offsets)), *offsets))
+
+class PolicyIndex(Mapping):
+    """ Read-only mapping of mail domains to `Policy` objects,
+    backed by a memory-mapped index file written by `write_index`.
+    Policies are decoded on each lookup; nothing else is loaded.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise IndexFormatError("Index file {} is empty".format(filename))
+        try:
+            self._check_header()
+        except (IndexFormatError, struct.error):
+            self.close()
+            raise IndexFormatError("Index file {} is invalid".format(filename))
+        self._fields = None
+
+    def _check_header(self):
+        magic, version, self._count, self._fields_len = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise IndexFormatError("Unsupported index format")
+        self._offsets_pos = _HEADER.size + self._fields_len
+        if self._offsets_pos + _OFFSET.size * self._count > len(self._map):
+            raise IndexFormatError("Index is truncated")
+
+    def close(self):
+        """ Unmaps the index file. """
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _string(self, pos):
+        length, = _U16.unpack_from(self._map, pos)
+        pos += _U16.size
+        return self._map[pos:pos + length].decode("utf-8"), pos + length
+
+    def _key(self, i):
+        """ The UTF-8 encoded domain of the `i`th record, in sorted order. """
+        pos, = _OFFSET.unpack_from(self._map, self._offsets_pos + _OFFSET.size * i)
+        length, = _U16.unpack_from(self._map, pos)
+        return self._map[pos + _U16.size:pos + _U16.size + length], pos + _U16.size + length
+
+    def _find(self, domain):
+        """ Returns the offset of the policy for `domain` within its record, or None. """
+        if not isinstance(domain, six.string_types):
+            return None
+        key = domain.encode("utf-8")
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, pos = self._key(mid)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return pos
+        return None
+
+    def _policy(self, pos):
+        mode, = _U8.unpack_from(self._map, pos)
+        pos += _U8.size
+        length, = _U16.unpack_from(self._map, pos)
+        if length == _UNSET:
+            min_tls_version = None
+            pos += _U16.size
+        else:
+            min_tls_version, pos = self._string(pos)
+        count, = _U16.unpack_from(self._map, pos)
+        pos += _U16.size
+        mxs = []
+        for _ in range(count):
+            mx, pos = self._string(pos)
+            mxs.append(mx)
+        return policy.Policy._from_fields( # pylint: disable=protected-access
+            (mode, tuple(mxs), min_tls_version, None))
+
+    def __getitem__(self, domain):
+        pos = self._find(domain)
+        if pos is None:
+            raise KeyError(domain)
+        return self._policy(pos)
+
+    def __contains__(self, domain):
+        return self._find(domain) is not None
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._key(i)[0].decode("utf-8")
+
+    def __len__(self):
+        return self._count
+
+    def get_policy_for(self, mail_domain):
+        """ Returns the policy for `mail_domain`, with its alias resolved,
+        or None if the index has no policy for it. """
+        return self.get(mail_domain)
+
+    def get_policies_for(self, mail_domains):
+        """ Looks up the policies of many domains at once, decoding each
+        distinct domain's record only once per call. Returns a list with the
+        policy of each domain, in order, or `policy.NO_POLICY` for domains
+        without a policy. """
+        resolved = {}
+        results = []
+        for mail_domain in mail_domains:
+            found = resolved.get(mail_domain)
+            if found is None:
+                found = resolved[mail_domain] = self.get(mail_domain, policy.NO_POLICY)
+            results.append(found)
+        return results
+
+    def _field(self, key):
+        if self._fields is None:
+            data = self._map[_HEADER.size:self._offsets_pos]
+            self._fields = json.loads(data.decode("utf-8"))
+        return self._fields.get(key)
+
+    @property
+    def author(self):
+        """ Author of the indexed policy list.
+        :returns str: """
+        return self._field("author")
+
+    @property
+    def expires(self):
+        """ Expiry date of the indexed policy list.
+        :returns datetime.datetime: """
+        return util.parse_valid_date(self._field("expires"))
+
+    @property
+    def timestamp(self):
+        """ Timestamp of the indexed policy list.
+        :returns datetime.datetime: """
+        return util.parse_valid_date(self._field("timestamp"))
@@ -0,0 +1,145 @@
+""" Incremental reader for large JSON objects. """
+import json
+import re
+
+from starttls_policy_cli import util
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _Buffer(object):
+    # pylint: disable=useless-object-inheritance
+    """Window over a text stream, decoding one JSON value at a time.
+    Only the unconsumed tail of the stream is kept in memory.
+    """
+
+    def __init__(self, fileobj, chunk_size):
+        self._file = fileobj
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._text = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, grow=False):
+        """Reads the next chunk of the stream. If `grow` is set, reads at least
+        as much as is currently buffered, so a single large value is decoded
+        in amortized linear time. Returns False at end of stream."""
+        if self._eof:
+            return False
+        size = self._chunk_size
+        if grow:
+            size = max(size, len(self._text) - self._pos)
+        chunk = self._file.read(size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._text = self._text[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character,
+        or an empty string at end of stream."""
+        while True:
+            self._pos = _WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """Consumes the next character, which must be one of `chars`."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise util.ConfigError('Invalid JSON: expected one of {!r}, got {!r}'.format(
+                chars, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Decodes the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._text, self._pos)
+            except ValueError:
+                if self._fill(grow=True):
+                    continue
+                raise
+            # A number at the very end of the buffer may continue in the next chunk.
+            if end == len(self._text) and self._fill(grow=True):
+                continue
+            self._pos = end
+            return value
+
+
+class ObjectStream(object):
+    # pylint: disable=useless-object-inheritance
+    """Iterator over the (key, value) members of a JSON object
+    that is being read from a stream.
+    """
+
+    def __init__(self, buf, expand=()):
+        self._buf = buf
+        self._expand = expand
+        self._started = False
+        self._done = False
+        self._pending = None
+
+    def __iter__(self):
+        return self
+
+    def _finish_pending(self):
+        if self._pending is not None:
+            for _ in self._pending:
+                pass
+            self._pending = None
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        self._finish_pending()
+        buf = self._buf
+        if not self._started:
+            self._started = True
+            if buf.peek() == '}':
+                buf.expect('}')
+                self._done = True
+                raise StopIteration
+        elif buf.expect(',}') == '}':
+            self._done = True
+            raise StopIteration
+        if buf.peek() != '"':
+            raise util.ConfigError('Invalid JSON: object keys must be strings')
+        key = buf.value()
+        buf.expect(':')
+        if key in self._expand and buf.peek() == '{':
+            buf.expect('{')
+            self._pending = ObjectStream(buf)
+            return key, self._pending
+        return key, buf.value()
+
+    next = __next__ # Python 2
+
+
+def iterparse(fileobj, expand=(), chunk_size=CHUNK_SIZE):
+    """Iterates over the members of the JSON object stored in `fileobj`
+    without reading the whole stream into memory.
+
+    Yields (key, value) pairs in file order. If a key is listed in `expand`
+    and its value is an object, the value is yielded as an `ObjectStream`
+    over that object's members instead of being decoded at once. Members of
+    an `ObjectStream` that are not consumed before advancing are skipped.
+
+    Raises `ValueError` (or `util.ConfigError`) if the input is not a
+    single well-formed JSON object.
+    """
+    buf = _Buffer(fileobj, chunk_size)
+    buf.expect('{')
+    for key, value in ObjectStream(buf, expand):
+        yield key, value
+    if buf.peek():
+        raise util.ConfigError('Invalid JSON: trailing data after top-level object')
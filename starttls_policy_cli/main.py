@@ -1,25 +1,57 @@
-""" Main entrypoint for starttls-policy CLI tool """
+""" Main entrypoint for starttls-policy CLI tool
+
+This runs from cron jobs and timers, so only what argument parsing needs is
+imported up front: the policy and generator modules (and their dependencies)
+are imported once the arguments are known to be valid.
+"""
+from __future__ import print_function
+
 import argparse
 import os
+import sys
 
-from starttls_policy_cli import configure
+from starttls_policy_cli import constants
 
+# Generator classes, by name in `configure` so it is only imported when needed.
 GENERATORS = {
-    "postfix": configure.PostfixGenerator,
+    "postfix": "PostfixGenerator",
+    "postfix-cdb": "PostfixCDBGenerator",
 }
 
+# Exit status with --exit-code when the generated configuration didn't change.
+EXIT_UNCHANGED = 3
+
 def _argument_parser():
     parser = argparse.ArgumentParser(
         description="Generates MTA configuration file according to STARTTLS-Everywhere policy",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("-g", "--generate",
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("-g", "--generate",
                         choices=GENERATORS,
-                        help="The MTA you want to generate a configuration file for.",
-                        dest="generate", required=True)
+                        help="The MTA you want to generate a configuration file for. May be "
+                        "given several times, to generate files for several MTAs at once.",
+                        action="append", dest="generate")
+    action.add_argument("--validate",
+                        help="Check the policy list in the policy directory and report "
+                        "every error in it at once, instead of stopping at the first one.",
+                        action="store_true", dest="validate")
+    action.add_argument("--serve", metavar="ADDRESS",
+                        help="Serve Postfix TLS policy lookups over the socketmap protocol on "
+                        "ADDRESS (unix:PATH or inet:HOST:PORT), reloading the policy list "
+                        "whenever it (or an overlay) changes.",
+                        dest="serve")
+    action.add_argument("--fetch",
+                        help="Download the policy list from --url into the policy directory if "
+                        "it changed since the last download, validating it before replacing "
+                        "the local copy.",
+                        action="store_true", dest="fetch")
     # TODO: decide whether to use /etc/ for policy list home
     parser.add_argument("-d", "--policy-dir",
                         help="Policy file directory on this computer.",
                         default="/etc/starttls-policy/", dest="policy_dir")
+    parser.add_argument("--url",
+                        help="With --fetch, the URL to download the policy list from.",
+                        default=constants.POLICY_REMOTE_URL, dest="url")
     parser.add_argument("-e", "--early-adopter",
                         help="Early Adopter mode. Processes all \"testing\" domains in policy list "
                         "same way as domains in \"enforce\" mode, effectively requiring strong TLS "
@@ -29,6 +61,57 @@ def _argument_parser():
                         "degradation. Use this mode with awareness about all implications.",
                         action="store_true",
                         dest="early_adopter")
+    parser.add_argument("-o", "--overlay",
+                        help="Policy file to layer on top of the policy list, overriding its "
+                        "policies, aliases and header fields. May be given several times; "
+                        "later overlays override earlier ones.",
+                        action="append", default=[], metavar="FILE", dest="overlays")
+    parser.add_argument("-i", "--incremental",
+                        help="Only rewrite the configuration file if policies changed since the "
+                        "last incremental run, and report how many did.",
+                        action="store_true", dest="incremental")
+    parser.add_argument("--exit-code",
+                        help="Exit with status {} if the configuration file (or, with "
+                        "--fetch, the policy list) is unchanged, so update scripts can skip "
+                        "reloading the MTA.".format(EXIT_UNCHANGED),
+                        action="store_true", dest="exit_code")
+    parser.add_argument("--fsync",
+                        help="Flush the generated configuration file (or, with --fetch, the "
+                        "policy list) to disk before atomically moving it into place.",
+                        action="store_true", dest="fsync")
+    parser.add_argument("-j", "--processes",
+                        help="Number of worker processes to validate policies with.",
+                        type=int, default=1, dest="processes")
+    parser.add_argument("-w", "--watch",
+                        help="Keep running, and regenerate the configuration file whenever the "
+                        "policy list (or an overlay) changes, or when it expires.",
+                        action="store_true", dest="watch")
+    parser.add_argument("--debounce",
+                        help="With --watch or --serve, seconds to wait for changes to the "
+                        "policy list to settle before reloading it.",
+                        type=float, default=2.0, dest="debounce")
+    parser.add_argument("--interval",
+                        help="With --watch or --serve, the longest time in seconds between "
+                        "checks for changes, and the polling interval where inotify isn't "
+                        "available.",
+                        type=float, default=30.0, dest="interval")
+    parser.add_argument("--profile",
+                        help="Print how long each phase of the run took (reading, decoding, "
+                        "validation, date parsing, generation, writing) to stderr.",
+                        action="store_true", dest="profile")
+    parser.add_argument("--profile-dump", metavar="FILE",
+                        help="Also record the run with cProfile, save the statistics to FILE "
+                        "and print the functions with the highest cumulative time to stderr.",
+                        dest="profile_dump")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="With --generate, write metrics about the run (phase durations, "
+                        "domains by mode, aliases, output size, whether the output changed and "
+                        "seconds until the policy list expires) to FILE.",
+                        dest="metrics")
+    parser.add_argument("--metrics-format", choices=("prometheus", "json"),
+                        help="Format of the --metrics file: the Prometheus text format, as read "
+                        "by the node exporter's textfile collector, or JSON.",
+                        default="prometheus", dest="metrics_format")
     return parser
 
 
@@ -36,17 +119,141 @@ def _ensure_directory(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-def _generate(arguments):
+def _generator_class(name):
+    generator = GENERATORS[name]
+    if isinstance(generator, str):
+        from starttls_policy_cli import configure # pylint: disable=import-outside-toplevel
+        generator = getattr(configure, generator)
+    return generator
+
+def _report(arguments, generators, results, profiler=None, regenerations=None):
+    """ Reports the results of a run of `generators`, and returns the exit status. """
+    filenames = [os.path.join(arguments.policy_dir, config_generator.default_filename)
+                 for config_generator in generators]
+    if arguments.metrics:
+        from starttls_policy_cli import metrics # pylint: disable=import-outside-toplevel
+        metrics.write(metrics.collect(generators[0].policy_list, list(zip(filenames, results)),
+                                      profiler, regenerations=regenerations),
+                      arguments.metrics, arguments.metrics_format)
+    for config_generator, filename, result in zip(generators, filenames, results):
+        if arguments.incremental:
+            print("Policy changes since last run{}: {} added, {} removed, {} changed.".format(
+                " of " + filename if len(generators) > 1 else "",
+                len(result.delta.added), len(result.delta.removed), len(result.delta.changed)))
+        if not result:
+            print("Configuration file {} is unchanged.".format(filename))
+        if not regenerations or regenerations == 1:
+            config_generator.manual_instructions()
+    if arguments.exit_code and not any(results):
+        return EXIT_UNCHANGED
+    return 0
+
+def _policy_filenames(arguments):
+    """ The policy list and overlays to watch for changes. """
+    return [os.path.join(arguments.policy_dir, constants.POLICY_FILENAME)] + arguments.overlays
+
+def _watch(arguments, generators, profiler=None):
+    from starttls_policy_cli import watch # pylint: disable=import-outside-toplevel
+    filenames = _policy_filenames(arguments)
+    # Each run is timed on its own for the metrics, unless the whole process is profiled.
+    watcher = watch.PolicyWatcher(generators, filenames, incremental=arguments.incremental,
+                                  debounce=arguments.debounce, interval=arguments.interval,
+                                  profile=bool(arguments.metrics) and profiler is None)
+    watcher.on_generate = lambda results: _report(arguments, generators, results,
+                                                  watcher.profiler, watcher.regenerations)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def _generate(arguments, profiler=None):
+    from starttls_policy_cli import configure # pylint: disable=import-outside-toplevel
     _ensure_directory(arguments.policy_dir)
-    config_generator = GENERATORS[arguments.generate](arguments.policy_dir,
-                                                      arguments.early_adopter)
-    config_generator.generate()
-    config_generator.manual_instructions()
+    names = sorted(set(arguments.generate), key=arguments.generate.index)
+    generators = [_generator_class(name)(arguments.policy_dir, arguments.early_adopter,
+                                         fsync=arguments.fsync, overlays=arguments.overlays)
+                  for name in names]
+    if arguments.watch:
+        return _watch(arguments, generators, profiler)
+    results = configure.generate_all(generators, incremental=arguments.incremental)
+    return _report(arguments, generators, results, profiler)
+
+def _serve(arguments, profiler=None):
+    # pylint: disable=unused-argument
+    from starttls_policy_cli import configure # pylint: disable=import-outside-toplevel
+    from starttls_policy_cli import socketmap # pylint: disable=import-outside-toplevel
+    generator = configure.PostfixGenerator(arguments.policy_dir, arguments.early_adopter,
+                                           overlays=arguments.overlays)
+    server = socketmap.SocketmapServer(arguments.serve, generator)
+    watcher = socketmap.TableWatcher(server, _policy_filenames(arguments),
+                                     debounce=arguments.debounce, interval=arguments.interval)
+    watcher.on_generate = lambda results: print("Serving policies for {} domains on {}".format(
+        results[0], arguments.serve))
+    try:
+        socketmap.serve(server, watcher)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def _fetch(arguments, profiler=None):
+    # pylint: disable=unused-argument
+    from starttls_policy_cli import fetch # pylint: disable=import-outside-toplevel
+    _ensure_directory(arguments.policy_dir)
+    filename = os.path.join(arguments.policy_dir, constants.POLICY_FILENAME)
+    try:
+        result = fetch.fetch(arguments.url, filename, fsync=arguments.fsync)
+    except (IOError, OSError, ValueError) as e:
+        print("Couldn't update {} from {}: {}".format(filename, arguments.url, e),
+              file=sys.stderr)
+        return 1
+    if result:
+        print("Updated {} from {}.".format(filename, arguments.url))
+    else:
+        print("Policy list {} is unchanged.".format(filename))
+    if arguments.exit_code and not result:
+        return EXIT_UNCHANGED
+    return 0
+
+def _validate(arguments, profiler=None):
+    # pylint: disable=unused-argument
+    from starttls_policy_cli import policy # pylint: disable=import-outside-toplevel
+    filename = os.path.join(arguments.policy_dir, constants.POLICY_FILENAME)
+    errors = policy.Config(filename).collect_errors(processes=arguments.processes)
+    for location, message in errors:
+        print("{}: {}".format("/".join(location) or filename, message), file=sys.stderr)
+    if errors:
+        print("{} error(s) found in {}".format(len(errors), filename), file=sys.stderr)
+        return 1
+    print("{} is valid".format(filename))
+    return 0
 
 def main():
     """ Entrypoint for CLI tool. """
     parser = _argument_parser()
-    _generate(parser.parse_args())
+    arguments = parser.parse_args()
+    if arguments.metrics and not arguments.generate:
+        parser.error("--metrics can only be used with --generate")
+    if arguments.watch and (arguments.validate or arguments.fetch):
+        parser.error("--watch can only be used with --generate")
+    if arguments.validate:
+        action = _validate
+    elif arguments.fetch:
+        action = _fetch
+    elif arguments.serve:
+        action = _serve
+    else:
+        action = _generate
+    profile = arguments.profile or arguments.profile_dump
+    # In watch mode, the metrics of each run are timed by the watcher.
+    if not (profile or arguments.metrics) or (arguments.watch and not profile):
+        return action(arguments)
+    from starttls_policy_cli import profiling # pylint: disable=import-outside-toplevel
+    with profiling.Profiler(arguments.profile_dump) as profiler:
+        status = action(arguments, profiler)
+    if arguments.profile or arguments.profile_dump:
+        profiler.report(sys.stderr)
+    return status
 
 if __name__ == "__main__":
-    main()  # pragma: no cover
+    sys.exit(main())  # pragma: no cover
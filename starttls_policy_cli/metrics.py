@@ -0,0 +1,126 @@
+""" Machine-readable metrics about a configuration generation run.
+
+Metrics are written either in the Prometheus text exposition format, for
+the node exporter's textfile collector, or as JSON. Either way the file is
+replaced atomically, so collectors never read a partial file.
+"""
+import collections
+import datetime
+import json
+import os
+
+import six
+
+from starttls_policy_cli import util
+
+FORMATS = ("prometheus", "json")
+
+_PREFIX = "starttls_policy_"
+
+class Metric(collections.namedtuple("Metric", ("name", "help", "samples"))):
+    """ A metric's name (without the common prefix), its help text,
+    and its samples as a list of (labels dict, value) pairs. """
+    __slots__ = ()
+
+def _gauge(name, help_text, value):
+    return Metric(name, help_text, [({}, value)])
+
+def collect(policy_list, outputs, profiler=None, now=None, regenerations=None):
+    """ Gathers the metrics of a run that generated configuration files
+    from `policy_list` (a `policy.Config`). `outputs` is a list of
+    (filename, result) pairs of each generated file and the result
+    returned by `ConfigGenerator.generate`. Phase durations are included if the run
+    was timed by `profiler`, a `profiling.Profiler`, which may still be
+    active. In watch mode, `regenerations` is the number of runs so far.
+    Returns a list of `Metric`s. """
+    if now is None:
+        now = datetime.datetime.now(util.UTC)
+    metrics = []
+    if profiler is not None:
+        profiler.checkpoint()
+        metrics.append(Metric("phase_duration_seconds", "Time spent in each phase of the run.",
+                              [({"phase": name}, seconds)
+                               for name, seconds in six.iteritems(profiler.times)]))
+        metrics.append(_gauge("run_duration_seconds", "Duration of the run.", profiler.total))
+    modes = collections.OrderedDict((mode, 0) for mode in util.ENFORCE_MODES)
+    for _, tls_policy in policy_list.resolved_items():
+        modes[tls_policy.mode] = modes.get(tls_policy.mode, 0) + 1
+    metrics.append(Metric("domains", "Number of domains in the policy list, by mode.",
+                          [({"mode": mode}, count) for mode, count in six.iteritems(modes)]))
+    metrics.append(_gauge("policy_aliases", "Number of policy aliases in the policy list.",
+                          len(policy_list.policy_aliases)))
+    aliased = 0
+    if policy_list.policies is not None:
+        aliased = sum(1 for domain in policy_list.policies
+                      if policy_list.policies[domain].policy_alias is not None)
+    metrics.append(_gauge("aliased_domains", "Number of domains whose policy is an alias.",
+                          aliased))
+    metrics.append(Metric("output_bytes", "Size of each generated configuration file.",
+                          [({"file": filename},
+                            os.path.getsize(filename) if os.path.exists(filename) else 0)
+                           for filename, _ in outputs]))
+    metrics.append(Metric("output_changed",
+                          "1 if the configuration file was rewritten, 0 if it was unchanged.",
+                          [({"file": filename}, int(bool(result)))
+                           for filename, result in outputs]))
+    expires_in = policy_list.expires - now
+    metrics.append(_gauge("expires_in_seconds",
+                          "Seconds until the policy list expires; negative once it has expired.",
+                          expires_in.days * 86400 + expires_in.seconds))
+    if regenerations is not None:
+        metrics.append(_gauge("regenerations",
+                              "Number of times the configuration files were generated "
+                              "since watching started.", regenerations))
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=util.UTC)
+    elapsed = now - epoch
+    metrics.append(_gauge("last_run_timestamp_seconds", "Time this run finished.",
+                          elapsed.days * 86400 + elapsed.seconds))
+    return metrics
+
+def _label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _sample_value(value):
+    if isinstance(value, six.integer_types):
+        return str(value)
+    return repr(float(value))
+
+def format_prometheus(metrics):
+    """ Formats `metrics` in the Prometheus text exposition format. """
+    lines = []
+    for metric in metrics:
+        name = _PREFIX + metric.name
+        lines.append("# HELP {} {}".format(name, metric.help))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in metric.samples:
+            if labels:
+                name_labels = "{}{{{}}}".format(name, ",".join(
+                    '{}="{}"'.format(key, _label_value(labels[key])) for key in sorted(labels)))
+            else:
+                name_labels = name
+            lines.append("{} {}".format(name_labels, _sample_value(value)))
+    return "\n".join(lines) + "\n"
+
+def format_json(metrics):
+    """ Formats `metrics` as a JSON object mapping each metric's name to
+    its value, or, for labelled metrics, to an object mapping the label's
+    value to the sample's value. """
+    data = collections.OrderedDict()
+    for metric in metrics:
+        if len(metric.samples) == 1 and not metric.samples[0][0]:
+            data[metric.name] = metric.samples[0][1]
+        else:
+            data[metric.name] = collections.OrderedDict(
+                (",".join(str(labels[key]) for key in sorted(labels)), value)
+                for labels, value in metric.samples)
+    return json.dumps(data, indent=2) + "\n"
+
+def write(metrics, filename, output_format="prometheus"):
+    """ Atomically writes `metrics` to `filename` in `output_format`,
+    one of `FORMATS`. """
+    if output_format == "json":
+        text = format_json(metrics)
+    else:
+        text = format_prometheus(metrics)
+    with util.AtomicFile(filename) as f:
+        f.write(text)
@@ -1,32 +1,46 @@
 """ Policy config wrapper """
-import logging
+# pylint: disable=too-many-lines
 import datetime
 import io
 import json
 import six
 from starttls_policy_cli import util
 from starttls_policy_cli import constants
+from starttls_policy_cli import jsonstream
+from starttls_policy_cli import profiling
+from starttls_policy_cli import snapshot as snapshots
 
 try:
     # Python 3.3+
-    from collections.abc import Mapping
+    from collections.abc import Mapping, MutableMapping
 except ImportError:
-    from collections import Mapping
+    from collections import Mapping, MutableMapping
 
-logger = logging.getLogger(__name__)
-logger.addHandler(logging.StreamHandler())
+_logger = None
+
+def _debug(msg, *args):
+    """ Logs a debug message. `logging` is only imported on first use. """
+    global _logger # pylint: disable=global-statement
+    if _logger is None:
+        import logging # pylint: disable=import-outside-toplevel
+        _logger = logging.getLogger(__name__)
+        _logger.addHandler(logging.StreamHandler())
+    _logger.debug(msg, *args)
 
 
 # Encoder
 class ConfigEncoder(json.JSONEncoder):
     """ Defines serializations for objects in the configuration
     that are not natively supported by JSONEncoder.
-    Currently, this just includes `datetime` objects.
+    Currently, this includes `datetime` objects, configs and
+    policy mappings.
     """
     def default(self, o):
         # pylint: disable=method-hidden
         if isinstance(o, MergableConfig):
             return o.get_dict()
+        if isinstance(o, PolicyMap):
+            return dict(o)
         if isinstance(o, datetime.datetime):
             return o.strftime('%Y-%m-%dT%H:%M:%S%z')
         return json.JSONEncoder.default(self, o) # pragma: no cover
@@ -39,26 +53,35 @@ class MergableConfig(object):
     # pylint: disable=useless-object-inheritance
     """Top level config object class for merging properties.
     """
+    __slots__ = ('_schema', '_data')
 
     def __init__(self, schema):
-        self._schema = schema
+        self._schema = util.compile_schema(schema)
         self._data = {}
 
     def _set_attr(self, attr, value):
-        enforcer, _, _ = util.get_properties(self._schema[attr])
-        if not callable(enforcer):
+        enforcer = self._schema.enforcers[attr]
+        if enforcer is None:
             raise util.ConfigError('Attribute {} has no enforcer'.format(attr))
         try:
-            self._data[attr] = enforcer(value)
+            self._store(attr, enforcer(value))
         except util.ConfigError as e:
             raise util.ConfigError('Error for attribute {}: '.format(attr) + str(e))
 
+    def _store(self, attr, value):
+        """ Stores the already enforced `value` of schema field `attr`. """
+        self._data[attr] = value
+
+    def _is_set(self, attr):
+        """ Whether schema field `attr` has been set. """
+        return attr in self._data
+
     def _check_against_schema(self):
-        for key, subschema in six.iteritems(self._schema):
-            _, default, required = util.get_properties(subschema)
-            if key not in self._data and default:
+        for key, default in self._schema.defaults:
+            if not self._is_set(key):
                 setattr(self, util.as_attr(key), default)
-            if key not in self._data and required:
+        for key in self._schema.required:
+            if not self._is_set(key):
                 raise util.ConfigError('Attribute {} is required.'.format(key))
 
     def get_dict(self):
@@ -81,6 +104,24 @@ class MergableConfig(object):
         """
         return isinstance(newer_config, MergableConfig)
 
+    def _combine(self, attr, old_value, new_value):
+        """ Returns the merged value of field `attr`, without modifying
+        `old_value` or `new_value`. Mappings are merged key by key, with
+        the new entries winning, and lists are concatenated. """
+        # pylint: disable=unused-argument
+        if isinstance(new_value, Mapping) and isinstance(old_value, Mapping):
+            combined = dict(old_value)
+            combined.update(new_value)
+            return combined
+        if isinstance(new_value, list) and isinstance(old_value, list):
+            return old_value + new_value
+        return new_value
+
+    def _adopt(self, attr, value):
+        """ Sets field `attr` of a config being built by `update` to `value`,
+        which comes from (or was combined from) already validated configs. """
+        setattr(self, util.as_attr(attr), value)
+
     def update(self, newer_config, merge=False):
         """Create a fresh config combining the new and old configs.
 
@@ -99,6 +140,10 @@ class MergableConfig(object):
         customizations to override specific settings without having to re-create
         large portions of a config to override it.
 
+        Neither config is modified. Values are combined by `_combine` and
+        set on the fresh config by `_adopt`, which subclasses override to
+        share already validated parts of the configs instead of rebuilding them.
+
         Arguments:
           newer_config: A config object to combine with the current config.
           merge: Allows old values not overridden to survive into the fresh config.
@@ -108,8 +153,8 @@ class MergableConfig(object):
         """
         # removed 'merge' kw arg - and it was passed to constructor
         # make a note to not do that, consume it on the param list
-        fresh_config = self.__class__(schema=self._schema)
-        logger.debug('from parent update merge %s', merge)
+        fresh_config = self._fresh_config()
+        _debug('from parent update merge %s', merge)
         if not isinstance(newer_config, MergableConfig):
             raise util.ConfigError('Attempting to update a %s with a %s' % (
                 self.__class__,
@@ -120,17 +165,19 @@ class MergableConfig(object):
             assert prop
             new_value = prop.fget(newer_config)
             old_value = prop.fget(self)
-            if merge and new_value is not None:
-                if isinstance(new_value, dict) and isinstance(old_value, dict):
-                    new_value = old_value.update(new_value)
-                elif isinstance(new_value, list) and isinstance(old_value, list):
-                    new_value = old_value.extend(new_value)
+            if merge and old_value is not None:
+                if new_value is None:
+                    new_value = old_value
+                else:
+                    new_value = self._combine(prop_name, old_value, new_value)
             if new_value is not None:
-                prop.fset(fresh_config, new_value)
-            elif merge and old_value is not None:
-                prop.fset(fresh_config, old_value)
+                fresh_config._adopt(prop_name, new_value) # pylint: disable=protected-access
         return fresh_config
 
+    def _fresh_config(self):
+        """ Returns an empty config of the same sort, used by `update`. """
+        return self.__class__(schema=self._schema)
+
     def merge(self, newer_config, **kwargs):
         """Combines configs and keeps old values if they are not overridden.
 
@@ -144,25 +191,195 @@ class MergableConfig(object):
           A config object of the same sort as called upon.
         """
         kwargs['merge'] = True
-        logger.debug('from parent merge: %s', kwargs)
+        _debug('from parent merge: %s', kwargs)
         return self.update(newer_config, **kwargs)
 
+# Modes from the default schema are stored as their index into this tuple.
+_MODE_IDS = dict((mode, i) for i, mode in enumerate(util.ENFORCE_MODES))
+
+# Maps each schema field of a Policy to the slot it's stored in.
+_POLICY_SLOTS = {
+    'mode': '_mode',
+    'mxs': '_mxs',
+    'min-tls-version': '_min_tls_version',
+    'policy-alias': '_policy_alias',
+}
+
+# Per-class cache for `Policy._setters`.
+_policy_setters = {}
+
+class _NoPolicy(object):
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+    """ Type of `NO_POLICY`. """
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__ # Python 2
+
+    def __repr__(self):
+        return 'NO_POLICY'
+
+# Returned by `Config.get_policies_for` for domains without a policy.
+NO_POLICY = _NoPolicy()
+
+class MXMatcher(object):
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+    """Precompiled matcher for a list of MX patterns, as found in a policy's
+    `mxs`. A pattern starting with a dot, like `.eff.org`, matches any
+    subdomain of `eff.org` (but not `eff.org` itself); any other pattern
+    matches that exact hostname. Matching ignores case and a trailing dot.
+
+    Exact names are kept in a set and wildcard suffixes in a trie keyed by
+    labels from right to left, so a check costs one step per label of the
+    hostname, however many patterns there are.
+    """
+    __slots__ = ('_exact', '_suffixes')
+
+    # Key marking a trie node that ends a wildcard pattern.
+    _WILDCARD = ''
+
+    def __init__(self, patterns):
+        exact = set()
+        suffixes = {}
+        for pattern in patterns:
+            pattern = self._normalize(pattern)
+            if not pattern.startswith('.'):
+                exact.add(pattern)
+                continue
+            node = suffixes
+            for label in reversed(pattern[1:].split('.')):
+                node = node.setdefault(label, {})
+            node[self._WILDCARD] = True
+        self._exact = frozenset(exact)
+        self._suffixes = suffixes
+
+    @staticmethod
+    def _normalize(hostname):
+        hostname = hostname.lower()
+        if hostname.endswith('.'):
+            hostname = hostname[:-1]
+        return hostname
+
+    def matches(self, hostname):
+        """ Whether `hostname` matches any of the patterns. """
+        hostname = self._normalize(hostname)
+        if hostname in self._exact:
+            return True
+        labels = hostname.split('.')
+        node = self._suffixes
+        # The leftmost label can't end a wildcard match: `.eff.org` doesn't match `eff.org`.
+        for i in range(len(labels) - 1, 0, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return False
+            if self._WILDCARD in node:
+                return True
+        return False
+
 class Policy(MergableConfig):
+    # pylint: disable=too-many-instance-attributes
     """Class containing a single TLS policy information for a particular e-mail domain.
+
+    Policies are kept compact, since a config may hold hundreds of thousands
+    of them: fields live in slots rather than a per-instance dict, `mode` is
+    stored as a small integer and `mxs` as a tuple. If an `interned` dict is
+    given, equal MX tuples and hostnames are shared through it, so domains
+    with identical MX sets share a single object.
     """
-    def __init__(self, data=None, aliases=None, schema=util.POLICY_SCHEMA):
-    # pylint: disable=dangerous-default-value
-        super(Policy, self).__init__(schema)
+    __slots__ = ('aliases', '_interned', '_mx_matcher') + tuple(sorted(_POLICY_SLOTS.values()))
+
+    def __init__(self, data=None, aliases=None, schema=util.POLICY_SCHEMA, interned=None):
+    # pylint: disable=dangerous-default-value,super-init-not-called
+        # Fields are stored in slots, so MergableConfig's `_data` dict isn't set up.
+        self._schema = util.compile_schema(schema)
         self.aliases = aliases
-        self._data = {}
+        self._interned = interned
+        self._mode = None
+        self._mxs = None
+        self._min_tls_version = None
+        self._policy_alias = None
+        self._mx_matcher = None
         if data is not None:
             self.load_from_dict(data)
+        # The intern table is only needed while loading.
+        self._interned = None
+
+    @property
+    def _data(self):
+        """ Dictionary of the fields that are set, as they'd appear in JSON. """
+        data = {}
+        for key in _POLICY_SLOTS:
+            if self._is_set(key):
+                data[key] = getattr(self, util.as_attr(key))
+        return data
+
+    def _store(self, attr, value):
+        if attr == 'mode':
+            value = _MODE_IDS.get(value, value)
+        elif attr == 'mxs' and isinstance(value, (list, tuple)):
+            interned = self._interned
+            if interned is None:
+                value = tuple(value)
+            else:
+                # pylint: disable=consider-using-generator
+                value = tuple([interned.setdefault(mx, mx) for mx in value])
+                value = interned.setdefault(value, value)
+            self._mx_matcher = None
+        setattr(self, _POLICY_SLOTS[attr], value)
+
+    def _is_set(self, attr):
+        return getattr(self, _POLICY_SLOTS[attr], None) is not None
+
+    def _fields(self):
+        """ The stored fields of this policy as a tuple, for snapshots. """
+        return (self._mode, self._mxs, self._min_tls_version, self._policy_alias)
+
+    @classmethod
+    def _from_fields(cls, fields, aliases=None, schema=util.POLICY_SCHEMA):
+        """ Rebuilds a policy from the tuple returned by `_fields`,
+        without validating it again. """
+        # pylint: disable=dangerous-default-value
+        policy = cls.__new__(cls)
+        policy._schema = util.compile_schema(schema)
+        policy.aliases = aliases
+        policy._interned = None
+        policy._mx_matcher = None
+        (policy._mode, policy._mxs,
+         policy._min_tls_version, policy._policy_alias) = fields
+        return policy
+
+    @classmethod
+    def _setters(cls):
+        """ Returns a dict mapping schema keys to property setters of this class. """
+        setters = _policy_setters.get(cls)
+        if setters is None:
+            setters = {}
+            for key in _POLICY_SLOTS:
+                prop = getattr(cls, util.as_attr(key))
+                setters[key] = prop.fset
+            _policy_setters[cls] = setters
+        return setters
+
+    def load_from_dict(self, dict_):
+        """ Sets Policy attributes from key/values in dict_.
+        Keys that aren't policy fields are ignored. """
+        setters = self._setters()
+        for key, value in six.iteritems(dict_):
+            setter = setters.get(key)
+            if setter is not None:
+                setter(self, value)
+        self._check_against_schema()
 
     @property
     def mode(self):
         """ Getter for this policy's minimum TLS version.
         :returns str: """
-        return self._data.get('mode', None)
+        mode = self._mode
+        if isinstance(mode, int):
+            return util.ENFORCE_MODES[mode]
+        return mode
 
     @mode.setter
     def mode(self, value):
@@ -174,7 +391,7 @@ class Policy(MergableConfig):
     def min_tls_version(self):
         """ Getter for this policy's minimum TLS version.
         :returns str: """
-        return self._data.get('min-tls-version', None)
+        return self._min_tls_version
 
     @min_tls_version.setter
     def min_tls_version(self, value):
@@ -186,7 +403,12 @@ class Policy(MergableConfig):
     def mxs(self):
         """ Getter for the mx hosts that this domain's certs can be valid for.
         :returns list: """
-        return self._data.get('mxs', [])
+        mxs = self._mxs
+        if mxs is None:
+            return []
+        if isinstance(mxs, tuple):
+            return list(mxs)
+        return mxs
 
     @mxs.setter
     def mxs(self, value):
@@ -194,11 +416,21 @@ class Policy(MergableConfig):
         :returns list: """
         self._set_attr('mxs', value)
 
+    def matches_mx(self, hostname):
+        """ Whether `hostname` is one of the mx hosts allowed by this policy,
+        either exactly or through a wildcard pattern like `.eff.org`.
+        The patterns are compiled into an `MXMatcher` on first use.
+        :returns bool: """
+        matcher = self._mx_matcher
+        if matcher is None:
+            matcher = self._mx_matcher = MXMatcher(self.mxs)
+        return matcher.matches(hostname)
+
     @property
     def policy_alias(self):
         """ Getter for this policy's alias, if it exists.
         :returns str: """
-        return self._data.get('policy-alias', None)
+        return self._policy_alias
 
     @policy_alias.setter
     def policy_alias(self, value):
@@ -212,6 +444,7 @@ class Policy(MergableConfig):
 class PolicyNoAlias(Policy):
     """ Same as Policy, but forbids setting policy_alias field.
     """
+    __slots__ = ()
     @property
     def policy_alias(self):
         """ This type of policy can't be aliased. Returns None."""
@@ -222,17 +455,126 @@ class PolicyNoAlias(Policy):
         # pylint: disable=unused-argument
         raise util.ConfigError('PolicyNoAlias object cannot have policy-alias field!')
 
+def _policy_errors(args):
+    """ Validates a chunk of (name, policy dict) pairs, building each one as
+    `policy_class` with the given alias names. Returns a list of
+    (name, error message) pairs for invalid policies.
+    Takes a single tuple argument so it can be mapped over a process pool. """
+    policy_class, items, alias_names = args
+    errors = []
+    for name, obj in items:
+        try:
+            if not isinstance(obj, dict):
+                raise util.ConfigError('Configuration value {} is not an object'.format(obj))
+            policy_class(obj, alias_names)
+        except (util.ConfigError, TypeError) as e:
+            errors.append((name, str(e)))
+    return errors
+
+def _collect_policy_errors(policy_class, entries, alias_names, processes=None):
+    """ Runs `_policy_errors` over the items of `entries`, in a pool of
+    `processes` worker processes if that's more than one. """
+    items = list(six.iteritems(entries))
+    if not processes or processes <= 1 or len(items) < 2:
+        return _policy_errors((policy_class, items, alias_names))
+    size = -(-len(items) // (processes * 4))
+    chunks = [(policy_class, items[i:i + size], alias_names)
+              for i in six.moves.range(0, len(items), size)]
+    import multiprocessing # pylint: disable=import-outside-toplevel
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_policy_errors, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [error for result in results for error in result]
+
+class PolicyMap(MutableMapping):
+    """Mapping of mail domains to `Policy` objects.
+    In lazy mode, entries are kept as the raw dicts they were set with and
+    `factory` turns each one into a validated `Policy` the first time it is
+    accessed. Iteration, `len()` and membership tests never build policies.
+    If given, `on_change` is called with the domain whenever an entry is
+    set or deleted after construction.
+    """
+
+    def __init__(self, factory, entries=None, lazy=False, on_change=None):
+        self._factory = factory
+        self._entries = {}
+        self._on_change = None
+        self.lazy = lazy
+        if isinstance(entries, PolicyMap):
+            # Don't materialize the other map's raw entries just to copy them.
+            entries = entries._entries # pylint: disable=protected-access
+        if entries is not None and lazy:
+            self._entries.update(entries)
+        elif entries is not None:
+            for domain, obj in six.iteritems(entries):
+                self[domain] = obj
+        self._on_change = on_change
+
+    def __getitem__(self, domain):
+        obj = self._entries[domain]
+        if not isinstance(obj, Policy):
+            obj = self._factory(obj)
+            self._entries[domain] = obj
+        return obj
+
+    def __setitem__(self, domain, obj):
+        if not self.lazy and not isinstance(obj, Policy):
+            obj = self._factory(obj)
+        self._entries[domain] = obj
+        if self._on_change is not None:
+            self._on_change(domain)
+
+    def __delitem__(self, domain):
+        del self._entries[domain]
+        if self._on_change is not None:
+            self._on_change(domain)
+
+    def __contains__(self, domain):
+        return domain in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def materialize(self):
+        """ Builds and validates every entry that hasn't been accessed yet.
+        Raises `util.ConfigError` for the first invalid entry. """
+        for domain, obj in list(six.iteritems(self._entries)):
+            if not isinstance(obj, Policy):
+                self._entries[domain] = self._factory(obj)
+
 class Config(MergableConfig, Mapping):
+    # pylint: disable=too-many-instance-attributes
     """Class for retrieving properties in TLS Policy config.
     If `policy_aliases` is specified, they must be set before `policies`,
     so policy format validation can work properly.
+
+    If `lazy` is set, policies are validated the first time they are
+    accessed rather than when they are set, so errors in individual policies
+    surface on access. Call `validate_all` to check everything up front.
+
+    Lookups go through a view mapping each domain to its policy with any
+    alias already resolved. It is rebuilt whenever `policies` or
+    `policy_aliases` is set, and updated when entries of `policies` are
+    set or deleted. In lazy mode, it is filled in as policies are accessed.
     """
 
     def __getitem__(self, key):
-        return self.get_policy_for(key)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            policy = self._resolve(key)
+        if policy is None:
+            raise KeyError(key)
+        return policy
 
     def __len__(self):
-        return len(self.policies)
+        return len(self.keys())
 
     def __iter__(self):
         """ Iterates TLS policies in the configuration file.
@@ -247,16 +589,259 @@ class Config(MergableConfig, Mapping):
             return set([])
         return self.policies.keys()
 
-    def __init__(self, filename=constants.POLICY_LOCAL_FILE, schema=util.CONFIG_SCHEMA):
+    def __init__(self, filename=constants.POLICY_LOCAL_FILE, schema=util.CONFIG_SCHEMA,
+                 lazy=False):
     # pylint: disable=dangerous-default-value
         super(Config, self).__init__(schema)
         self.filename = filename
+        self.lazy = lazy
+        # Shared by this config's policies to deduplicate MX hostnames and lists.
+        self._interned = {}
+        # Alias-resolved policy of each domain, see `_resolve`.
+        self._resolved = {}
+        # Layer each value came from, for configs built by `merge_all`.
+        self.sources = None
+
+    def _fresh_config(self):
+        return self.__class__(schema=self._schema, lazy=self.lazy)
+
+    def _combine(self, attr, old_value, new_value):
+        if attr == 'policies':
+            # Share the entries of both maps: built policies, or raw dicts in lazy mode.
+            # pylint: disable=protected-access
+            combined = dict(old_value._entries)
+            combined.update(new_value._entries)
+            return combined
+        return super(Config, self)._combine(attr, old_value, new_value)
+
+    def _adopt(self, attr, value):
+        """ Policies and aliases from the combined configs were validated
+        already, so they are shared as they are. Unvalidated raw entries
+        from lazy configs are kept raw until `update` is done, since the
+        aliases they refer to may not be set yet. """
+        if attr == 'policies':
+            self._data['policies'] = PolicyMap(self._new_policy, value, lazy=True,
+                                               on_change=self._policy_changed)
+        elif attr == 'policy-aliases':
+            self._data['policy-aliases'] = dict(value)
+        else:
+            super(Config, self)._adopt(attr, value)
+
+    def _adopted(self, inputs):
+        """ Called once all fields were set by `_adopt` from the configs
+        `inputs`. If this config is eager, validates the raw entries that
+        came from lazy inputs. """
+        policies = self.policies
+        if policies is not None and not self.lazy:
+            if any(config.lazy for config in inputs):
+                policies.materialize()
+            policies.lazy = False
+
+    def update(self, newer_config, merge=False):
+        """Create a fresh config combining the new and old configs.
+        See `MergableConfig.update`.
+
+        Policies, aliases and the alias-resolved view are shared with the
+        combined configs rather than rebuilt, and only the domains of
+        `newer_config` are resolved again. So merging a small config into a
+        large one takes time proportional to the small one, apart from
+        copying the dictionaries. If the merge replaces a policy alias, the
+        view is rebuilt, since any domain may refer to that alias.
+        """
+        # Not `super`, through which pylint infers a MergableConfig.
+        fresh_config = MergableConfig.update(self, newer_config, merge)
+        if not isinstance(newer_config, Config):
+            return fresh_config
+        # pylint: disable=protected-access
+        fresh_config._adopted((self, newer_config))
+        view = {}
+        aliases = fresh_config.policy_aliases
+        if merge and all(aliases.get(name) is alias
+                         for name, alias in six.iteritems(self.policy_aliases)):
+            view = dict(self._resolved)
+            if newer_config.policies is not None:
+                for mail_domain in newer_config.policies:
+                    view.pop(mail_domain, None)
+        view.update(newer_config._resolved)
+        fresh_config._resolved = view
+        if not fresh_config.lazy:
+            fresh_config._resolve_all()
+        return fresh_config
 
-    def load(self):
+    def validate_all(self):
+        """ Validates every policy, including ones not accessed yet in lazy mode.
+        Raises `util.ConfigError` for the first invalid policy. """
+        if self.policies is not None:
+            self.policies.materialize()
+
+    @staticmethod
+    def _collect_section_errors(dict_, section, errors):
+        """ Returns the object stored under `section` in `dict_`, or an empty
+        dict if it's missing or isn't an object (recording an error in `errors`). """
+        entries = dict_.get(section)
+        if entries is None:
+            return {}
+        if not isinstance(entries, dict):
+            errors.append(((section,), 'Configuration value {} is not an object'.format(entries)))
+            return {}
+        return entries
+
+    def collect_errors(self, dict_=None, processes=None):
+        """Validates every header field, policy alias and policy in `dict_`
+        (by default, the JSON file at `filename`) without stopping at the
+        first error. Doesn't modify this config.
+
+        Arguments:
+          dict_: Configuration dictionary to validate.
+          processes: If greater than one, policies are validated in a pool
+            of this many worker processes.
+
+        Returns:
+          A list of (location, message) pairs, where location is a tuple like
+          ('expires',), ('policy-aliases', name) or ('policies', mail_domain).
+          The list is empty if the configuration is valid.
+        """
+        if dict_ is None:
+            try:
+                with io.open(self.filename, encoding='utf-8') as f:
+                    dict_ = json.loads(f.read())
+            except (IOError, ValueError) as e:
+                return [((), str(e))]
+        if not isinstance(dict_, dict):
+            return [((), 'Configuration value {} is not an object'.format(dict_))]
+        errors = []
+        scratch = self._fresh_config()
+        for key, value in six.iteritems(dict_):
+            if key in ('policies', 'policy-aliases'):
+                continue
+            try:
+                setattr(scratch, util.as_attr(key), value)
+            except util.ConfigError as e:
+                errors.append(((key,), str(e)))
+        defaults = dict(self._schema.defaults)
+        for key in self._schema.required:
+            if key not in dict_ and key not in defaults:
+                errors.append(((key,), 'Attribute {} is required.'.format(key)))
+        aliases = self._collect_section_errors(dict_, 'policy-aliases', errors)
+        for name, message in _collect_policy_errors(PolicyNoAlias, aliases, frozenset()):
+            errors.append((('policy-aliases', name), message))
+        policies = self._collect_section_errors(dict_, 'policies', errors)
+        for domain, message in _collect_policy_errors(Policy, policies, frozenset(aliases),
+                                                      processes):
+            errors.append((('policies', domain), message))
+        return errors
+
+    def load(self, stream=False, snapshot=False):
         """Loads JSON configuration from file specified by `filename` property.
+        If `stream` is set, the file is parsed incrementally and policies are
+        built one domain at a time, so the raw text, the parsed dictionary and
+        the `Policy` objects are never all held in memory at once.
+
+        If `snapshot` is set, the configuration is loaded from the snapshot
+        stored next to the file (see `snapshot.py`) when it is up to date,
+        without parsing or validating the JSON again. Otherwise the file is
+        loaded as usual and the snapshot is rebuilt.
         """
+        if snapshot:
+            with profiling.phase('snapshot'):
+                key = snapshots.source_key(self.filename)
+                payload = snapshots.load(self.filename, key)
+                if payload is not None:
+                    self._restore_snapshot(payload)
+                    return
         with io.open(self.filename, encoding='utf-8') as f:
-            self.load_from_dict(json.loads(f.read()))
+            if stream:
+                # Reading, decoding and validation are interleaved.
+                with profiling.phase('stream'):
+                    self._load_stream(f)
+            else:
+                with profiling.phase('read'):
+                    text = f.read()
+                with profiling.phase('decode'):
+                    dict_ = json.loads(text)
+                del text
+                with profiling.phase('validate'):
+                    self.load_from_dict(dict_)
+        if snapshot:
+            with profiling.phase('snapshot'):
+                try:
+                    payload = self._snapshot()
+                except util.ConfigError:
+                    # Invalid policies in lazy mode: don't validate them ahead of access.
+                    return
+                snapshots.save(self.filename, key, payload)
+
+    def _snapshot(self):
+        """ This configuration's fields, in a form that can be stored with `marshal`. """
+        fields = {}
+        for key, value in six.iteritems(self._data):
+            if key in ('policies', 'policy-aliases'):
+                continue
+            if isinstance(value, datetime.datetime):
+                value = ('datetime', snapshots.pack_datetime(value))
+            fields[key] = value
+        policies = None
+        if self.policies is not None:
+            policies = dict((domain, self.policies[domain]._fields()) # pylint: disable=protected-access
+                            for domain in self.policies)
+        aliases = None
+        if 'policy-aliases' in self._data:
+            aliases = dict((name, alias._fields()) # pylint: disable=protected-access
+                           for name, alias in six.iteritems(self.policy_aliases))
+        return {'fields': fields, 'policy-aliases': aliases, 'policies': policies}
+
+    def _restore_snapshot(self, payload):
+        """ Sets this configuration's fields from the result of `_snapshot`.
+        The fields were validated before the snapshot was taken. """
+        for key, value in six.iteritems(payload['fields']):
+            if isinstance(value, tuple) and value[0] == 'datetime':
+                value = snapshots.unpack_datetime(value[1])
+            self._data[key] = value
+        if payload['policy-aliases'] is not None:
+            self._data['policy-aliases'] = dict(
+                (name, PolicyNoAlias._from_fields(fields)) # pylint: disable=protected-access
+                for name, fields in six.iteritems(payload['policy-aliases']))
+        if payload['policies'] is not None:
+            aliases = self.policy_aliases
+            schema = util.compile_schema(util.POLICY_SCHEMA)
+            from_fields = Policy._from_fields # pylint: disable=protected-access
+            policies = PolicyMap(self._new_policy, lazy=self.lazy,
+                                 on_change=self._policy_changed)
+            # Bypass PolicyMap.__setitem__: these are Policy objects already.
+            policies._entries = dict( # pylint: disable=protected-access
+                (domain, from_fields(fields, aliases, schema))
+                for domain, fields in six.iteritems(payload['policies']))
+            self._data['policies'] = policies
+        self._reset_resolved()
+
+    def _load_stream(self, f):
+        """ Sets Config attributes while reading JSON from file object `f`.
+        Policies that refer to an alias are only validated once all of the
+        header fields (including `policy-aliases`) have been read. """
+        policies = None
+        deferred = []
+        for key, value in jsonstream.iterparse(f, expand=('policies',)):
+            if key != 'policies':
+                setattr(self, util.as_attr(key), value)
+            elif isinstance(value, jsonstream.ObjectStream):
+                policies = {}
+                for domain, obj in value:
+                    if ('policy-aliases' not in self._data and isinstance(obj, dict)
+                            and 'policy-alias' in obj):
+                        deferred.append(domain)
+                        policies[domain] = obj
+                    elif self.lazy:
+                        policies[domain] = obj
+                    else:
+                        policies[domain] = self._new_policy(obj)
+            else:
+                policies = value
+        self._check_against_schema()
+        if not self.lazy:
+            for domain in deferred:
+                policies[domain] = self._new_policy(policies[domain])
+        if policies is not None:
+            self.policies = policies
 
     def load_from_dict(self, dict_):
         """ Sets Config attributes from key/values in dict_
@@ -319,7 +904,7 @@ class Config(MergableConfig, Mapping):
     @property
     def policies(self):
         """ Getter for TLS policies in this configuration file.
-        :returns list: """
+        :returns PolicyMap: """
         return self._data.get('policies')
 
     @policies.setter
@@ -327,15 +912,16 @@ class Config(MergableConfig, Mapping):
         """ Setter for TLS policies in this configuration file.
         If policies refer to policy_aliases, note
         that these fields should be set *first* so the policies can
-        validate correctly.
-        :returns list: """
-        policies = {}
-        for domain, obj in six.iteritems(value):
-            if isinstance(obj, Policy):
-                policies[domain] = obj
-            else:
-                policies[domain] = Policy(obj, self.policy_aliases)
-        self._set_attr('policies', policies)
+        validate correctly. In lazy mode, policies given as dicts are
+        validated the first time they are accessed.
+        :returns PolicyMap: """
+        self._set_attr('policies', PolicyMap(self._new_policy, value, lazy=self.lazy,
+                                             on_change=self._policy_changed))
+        self._reset_resolved()
+
+    def _new_policy(self, obj):
+        """ Builds a validated Policy for this configuration from a raw dict. """
+        return Policy(obj, self.policy_aliases, interned=self._interned)
 
     @property
     def policy_aliases(self):
@@ -346,18 +932,158 @@ class Config(MergableConfig, Mapping):
     @policy_aliases.setter
     def policy_aliases(self, value):
         """ Setter for policy aliases in this configuration file.
+        Aliases that are already `PolicyNoAlias` objects, as when
+        merging configs, are kept as they are.
         :returns: policy_aliases """
         policies = {}
         for domain, obj in six.iteritems(value):
-            policies[domain] = PolicyNoAlias(obj)
+            if not isinstance(obj, PolicyNoAlias):
+                obj = PolicyNoAlias(obj, interned=self._interned)
+            policies[domain] = obj
         self._set_attr('policy-aliases', policies)
+        self._reset_resolved()
+
+    def _reset_resolved(self):
+        """ Rebuilds the alias-resolved view of the policies. In lazy mode,
+        it is only filled in as policies are accessed. """
+        self._resolved = {}
+        if not self.lazy:
+            self._resolve_all()
+
+    def _policy_changed(self, domain):
+        self._resolved.pop(domain, None)
+
+    def _resolve(self, mail_domain):
+        """ Resolves the policy of `mail_domain` and adds it to the view.
+        Returns None if there is no policy for `mail_domain`. """
+        policies = self.policies
+        if policies is None or mail_domain not in policies:
+            return None
+        policy = policies[mail_domain]
+        if policy.policy_alias is not None:
+            policy = self.policy_aliases[policy.policy_alias]
+        self._resolved[mail_domain] = policy
+        return policy
+
+    def _resolve_all(self):
+        """ Adds every policy missing from the view, building and validating
+        policies that haven't been accessed yet in lazy mode. Policies whose
+        alias isn't set yet (as while `update` copies fields one by one)
+        are left out until `policy_aliases` is set. """
+        policies = self.policies
+        if policies is None or len(self._resolved) == len(policies):
+            return
+        resolved = self._resolved
+        aliases = self.policy_aliases
+        for mail_domain in policies:
+            if mail_domain not in resolved:
+                policy = policies[mail_domain]
+                if policy.policy_alias is not None:
+                    policy = aliases.get(policy.policy_alias)
+                    if policy is None:
+                        continue
+                resolved[mail_domain] = policy
+
+    def resolved_items(self):
+        """ Iterates over (mail domain, policy) pairs of all policies in this
+        configuration, with aliases resolved to the original policy.
+        Builds and validates every policy in lazy mode. """
+        self._resolve_all()
+        return six.iteritems(self._resolved)
+
+    def match_mxs(self, pairs):
+        """ Checks many (mail domain, mx hostname) pairs at once, such as
+        deliveries read from a mail log. Aliases are resolved and each
+        policy's matcher is compiled once, however often its domain appears.
+        :param pairs: Iterable of (mail_domain, hostname) tuples.
+        :returns: Generator of True or False for each pair, depending on
+            whether the hostname is allowed by the domain's policy, or None
+            if the domain has no policy. """
+        for mail_domain, hostname in pairs:
+            policy = self.get_policy_for(mail_domain)
+            yield None if policy is None else policy.matches_mx(hostname)
 
     def get_policy_for(self, mail_domain):
         """ Getter for TLS policies in this configuration file.
         If policy is an alias, returns the original policy.
         :param mail_domain str: The e-mail domain (portion after @ sign) to retrieve policy for.
-        :returns: Policy dictionary. """
-        policy = self.policies.get(mail_domain)
-        if policy.policy_alias is not None:
-            return self.policy_aliases[policy.policy_alias]
+        :returns: Policy dictionary, or None if there is no policy for `mail_domain`. """
+        policy = self._resolved.get(mail_domain)
+        if policy is None:
+            policy = self._resolve(mail_domain)
         return policy
+
+    def get_policies_for(self, mail_domains):
+        """ Looks up the TLS policies of many e-mail domains at once.
+        Like `get_policy_for`, aliases are resolved to the original policy.
+        :param mail_domains: Iterable of e-mail domains.
+        :returns: List with the policy of each domain, in order, or
+            `NO_POLICY` for domains without a policy. """
+        resolved_get = self._resolved.get
+        resolve = self._resolve
+        results = []
+        append = results.append
+        for mail_domain in mail_domains:
+            policy = resolved_get(mail_domain)
+            if policy is None:
+                policy = resolve(mail_domain)
+                if policy is None:
+                    policy = NO_POLICY
+            append(policy)
+        return results
+
+def merge_all(configs, lazy=False):
+    """Merges any number of configs in one pass, like chaining `merge`
+    calls on them in order, so each config's values override those of the
+    configs before it.
+
+    The policies of all configs are collected first and only the winning
+    entry of each domain is kept, so loading the layers with `lazy=True`
+    validates each domain once, when the merged config is built (or, if
+    `lazy` is set, when it's accessed). Policies and aliases that are
+    already built are shared rather than rebuilt.
+
+    The `sources` attribute of the merged config records where each value
+    came from, as the index into `configs` of its layer: a dict mapping
+    each header field to an index, and 'policies' and 'policy-aliases' to
+    dicts mapping each mail domain or alias name to an index.
+
+    Arguments:
+      configs: Non-empty sequence of `Config` objects, lowest layer first.
+      lazy: Whether the merged config validates policies on access.
+
+    Returns:
+      A new `Config`. None of `configs` is modified.
+    """
+    # pylint: disable=protected-access
+    configs = list(configs)
+    if not configs:
+        raise ValueError('merge_all needs at least one config')
+    merged = Config(filename=configs[0].filename, schema=configs[0]._schema, lazy=lazy)
+    fields = {}
+    aliases = None
+    entries = None
+    sources = {'policies': {}, 'policy-aliases': {}}
+    for layer, config in enumerate(configs):
+        for key, value in six.iteritems(config._data):
+            if key == 'policies':
+                entries = entries or {}
+                entries.update(value._entries)
+                sources['policies'].update(dict.fromkeys(value._entries, layer))
+            elif key == 'policy-aliases':
+                aliases = aliases or {}
+                aliases.update(value)
+                sources['policy-aliases'].update(dict.fromkeys(value, layer))
+            else:
+                fields[key] = value
+                sources[key] = layer
+    for key, value in six.iteritems(fields):
+        merged._adopt(key, value)
+    if aliases is not None:
+        merged._adopt('policy-aliases', aliases)
+    if entries is not None:
+        merged._adopt('policies', entries)
+    merged._adopted(configs)
+    merged._reset_resolved()
+    merged.sources = sources
+    return merged
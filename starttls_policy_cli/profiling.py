@@ -0,0 +1,161 @@
+""" Per-phase timing of policy list loading and configuration generation.
+
+Code marks its phases with `phase(name)`, which does nothing unless a
+`Profiler` is active. Phases may nest: time spent in an inner phase is only
+counted for that phase, so the times of all phases add up to the time spent
+in any of them. Only the thread that activated the profiler is timed;
+phases entered by other threads are ignored.
+
+    with profiling.Profiler() as profiler:
+        generator.generate()
+    profiler.report(sys.stderr)
+"""
+from __future__ import print_function
+
+import collections
+import threading
+import timeit
+
+import six
+
+_timer = timeit.default_timer
+
+# The active Profiler, if any.
+_active = None
+
+class _NullPhase(object):
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+    """ Context manager that does nothing, used when profiling is off. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    # pylint: disable=useless-object-inheritance,too-few-public-methods
+    """ Context manager timing one phase of `profiler`. """
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._profiler.enter(self._name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profiler.leave()
+        return False
+
+def phase(name):
+    """ Returns a context manager that counts the time spent in it towards
+    phase `name` of the active profiler, if there is one. """
+    profiler = _active
+    if profiler is None or threading.current_thread() is not profiler.thread:
+        return _NULL_PHASE
+    return _Phase(profiler, name)
+
+def iterate(name, iterable):
+    """ Iterates over `iterable`, counting the time spent producing each
+    item towards phase `name`, for lazily generated results. Returns
+    `iterable` itself when profiling is off. """
+    profiler = _active
+    if (profiler is None or threading.current_thread() is not profiler.thread or
+            isinstance(iterable, (six.string_types, bytes))):
+        return iterable
+    return _iterate(profiler, name, iter(iterable))
+
+def _iterate(profiler, name, iterator):
+    while True:
+        profiler.enter(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            profiler.leave()
+        yield item
+
+class Profiler(object):
+    # pylint: disable=useless-object-inheritance,too-many-instance-attributes
+    """ Accumulates the time spent in each phase while it is active.
+    Time spent outside any phase is counted as "other".
+
+    If `cprofile_filename` is given, the run is also recorded with
+    `cProfile`, and the statistics are saved to that file on exit.
+    """
+
+    def __init__(self, cprofile_filename=None):
+        self.times = collections.OrderedDict()
+        self.total = 0.0
+        self.cprofile_filename = cprofile_filename
+        # The thread being timed, set when the profiler is activated.
+        self.thread = None
+        self._stack = []
+        self._since = None
+        self._start = None
+        self._cprofile = None
+
+    def _charge(self):
+        now = _timer()
+        name = self._stack[-1] if self._stack else "other"
+        self.times[name] = self.times.get(name, 0.0) + now - self._since
+        self._since = now
+
+    def enter(self, name):
+        """ Starts phase `name`, pausing the current one. """
+        self._charge()
+        self._stack.append(name)
+
+    def leave(self):
+        """ Ends the current phase, resuming the one it interrupted. """
+        self._charge()
+        self._stack.pop()
+
+    def checkpoint(self):
+        """ Brings `times` and `total` up to date while the profiler is
+        still active, for reporting before the run has finished. """
+        if _active is self:
+            self._charge()
+            self.total = self._since - self._start
+
+    def __enter__(self):
+        global _active # pylint: disable=global-statement
+        if _active is not None:
+            raise RuntimeError("A profiler is already active")
+        _active = self
+        self.thread = threading.current_thread()
+        if self.cprofile_filename is not None:
+            import cProfile # pylint: disable=import-outside-toplevel
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._start = self._since = _timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active # pylint: disable=global-statement
+        self.checkpoint()
+        _active = None
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_filename)
+        return False
+
+    def report(self, output, limit=20):
+        """ Prints the time spent in each phase to `output`, and, if a
+        cProfile dump was recorded, the `limit` functions with the highest
+        cumulative time. """
+        print("Time per phase:", file=output)
+        for name, seconds in self.times.items():
+            share = seconds / self.total if self.total else 0.0
+            print("  {:<12} {:9.4f}s {:6.1%}".format(name, seconds, share), file=output)
+        print("  {:<12} {:9.4f}s".format("total", self.total), file=output)
+        if self._cprofile is not None:
+            import pstats # pylint: disable=import-outside-toplevel
+            print("\ncProfile data saved to {}".format(self.cprofile_filename), file=output)
+            stats = pstats.Stats(self.cprofile_filename, stream=output)
+            stats.sort_stats("cumulative").print_stats(limit)
@@ -0,0 +1,70 @@
+""" Persistent snapshots of parsed policy lists.
+
+A snapshot is stored next to the policy file it was built from, and holds
+the already validated contents of that file in `marshal` format, so loading
+it skips JSON parsing, date parsing and policy validation. It is keyed by the
+size, modification time and SHA-256 digest of the policy file (and by the
+Python version, since the `marshal` format is version-specific), and is
+ignored as soon as any of these change.
+"""
+import datetime
+import marshal
+import os
+import sys
+
+from starttls_policy_cli import util
+
+FORMAT_VERSION = 1
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def snapshot_filename(filename):
+    """ Where the snapshot of the policy file `filename` is stored. """
+    return filename + ".snapshot"
+
+def source_key(filename):
+    """ Identifies the current contents of the policy file `filename`.
+    Take the key *before* reading the file, so a snapshot saved under it
+    is invalidated if the file changes while it is being parsed. """
+    stat = os.stat(filename)
+    return (FORMAT_VERSION, sys.version, marshal.version,
+            stat.st_size, stat.st_mtime, util.file_digest(filename))
+
+def load(filename, key):
+    """ Returns the payload of the snapshot of `filename` if it was saved
+    under `key`, otherwise (or if it can't be read) None. """
+    try:
+        with open(snapshot_filename(filename), "rb") as f:
+            saved_key, payload = marshal.loads(f.read())
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if saved_key != key:
+        return None
+    return payload
+
+def save(filename, key, payload):
+    """ Saves `payload` (made of types supported by `marshal`) as the
+    snapshot of `filename` under `key`. Failing to write the snapshot,
+    e.g. in a read-only directory, isn't an error. Returns whether the
+    snapshot was saved. """
+    try:
+        data = marshal.dumps((key, payload))
+        with util.AtomicFile(snapshot_filename(filename), mode="wb") as f:
+            f.write(data)
+    except (IOError, OSError, ValueError):
+        return False
+    return True
+
+def pack_datetime(value):
+    """ Converts an aware datetime into a tuple `marshal` can store. """
+    offset = value.utcoffset()
+    local = value.replace(tzinfo=None)
+    offset_seconds = offset.days * 86400 + offset.seconds
+    delta = local - _EPOCH
+    return (delta.days, delta.seconds, delta.microseconds, offset_seconds)
+
+def unpack_datetime(packed):
+    """ Inverse of `pack_datetime`. """
+    days, seconds, microseconds, offset_seconds = packed
+    local = _EPOCH + datetime.timedelta(days, seconds, microseconds)
+    return local.replace(tzinfo=util.fixed_timezone(offset_seconds))
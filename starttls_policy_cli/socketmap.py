@@ -0,0 +1,276 @@
+""" Serves TLS policy lookups to Postfix over its socketmap protocol.
+
+Instead of generating a table and compiling it with postmap, Postfix can
+query the policies straight from memory:
+
+    smtp_tls_policy_maps = socketmap:unix:/run/starttls-policy.sock:tls_policy
+
+Each request is a netstring holding the map name and the key, and each reply
+a netstring holding the status and the value. The replies are computed once
+for every domain when the policy list is loaded, and the whole table is
+replaced when it is reloaded, so open connections keep being answered.
+
+This module also runs a load test against a server:
+
+    python -m starttls_policy_cli.socketmap unix:/run/starttls-policy.sock --requests 100000
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import stat
+import sys
+import threading
+import timeit
+
+from six.moves import socketserver
+
+from starttls_policy_cli import constants
+from starttls_policy_cli import policy
+from starttls_policy_cli import util
+from starttls_policy_cli import watch
+
+# Name of the map in Postfix's socketmap table, after the socket address.
+MAP_NAME = "tls_policy"
+
+# Longest request accepted; Postfix keys are domain names.
+_MAX_REQUEST = 10000
+
+_NOT_FOUND = b"NOTFOUND "
+_NOT_LOADED = b"TEMP policy list not loaded yet"
+_UNKNOWN_MAP = b"PERM unknown map"
+
+def netstring(data):
+    """ Encodes the bytes `data` as a netstring. """
+    return str(len(data)).encode("ascii") + b":" + data + b","
+
+def read_netstring(stream, max_length=_MAX_REQUEST):
+    """ Reads one netstring from the binary file object `stream`. Returns
+    its contents, or None at the end of the stream. Raises ValueError if
+    it is malformed or longer than `max_length`. """
+    length = b""
+    while True:
+        char = stream.read(1)
+        if not char:
+            if length:
+                raise ValueError("Truncated netstring")
+            return None
+        if char == b":":
+            break
+        if not char.isdigit() or len(length) > len(str(max_length)):
+            raise ValueError("Invalid netstring length")
+        length += char
+    if not length or int(length) > max_length:
+        raise ValueError("Invalid netstring length")
+    data = stream.read(int(length))
+    if len(data) != int(length) or stream.read(1) != b",":
+        raise ValueError("Truncated netstring")
+    return data
+
+def parse_address(address):
+    """ Parses a socket address in Postfix's notation, `unix:/path` or
+    `inet:host:port` (a bare path is a Unix socket). Returns the address
+    family and the address to bind or connect to. """
+    kind, _, rest = address.partition(":")
+    if kind == "inet":
+        host, _, port = rest.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError("Invalid inet address: {}".format(address))
+        host = host.strip("[]")
+        return (socket.AF_INET6 if ":" in host else socket.AF_INET), (host, int(port))
+    if kind == "unix":
+        return socket.AF_UNIX, rest
+    if not rest:
+        return socket.AF_UNIX, address
+    raise ValueError("Invalid socket address: {}".format(address))
+
+class _Handler(socketserver.StreamRequestHandler):
+    """ Answers the requests of one connection until it is closed. """
+
+    def handle(self):
+        while True:
+            try:
+                request = read_netstring(self.rfile)
+            except ValueError:
+                # Postfix reconnects after a protocol error.
+                return
+            if request is None:
+                return
+            self.wfile.write(netstring(self.server.lookup(request)))
+
+class SocketmapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ Socketmap server answering lookups in the Postfix TLS policy table
+    of `generator`, a `configure.PostfixGenerator`, on `address` (see
+    `parse_address`). Each connection is served by its own thread.
+
+    The table is empty until `update` is first called; lookups are
+    answered with a temporary failure until then.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, generator):
+        self.address_family, server_address = parse_address(address)
+        self.generator = generator
+        # The replies by lowercase domain, and the expiry date of the policy list.
+        self.table = None
+        if self.address_family == socket.AF_UNIX:
+            _remove_stale_socket(server_address)
+        socketserver.TCPServer.__init__(self, server_address, _Handler)
+
+    def update(self):
+        """ Rebuilds the table from the generator's policy list. Returns
+        the number of domains with a policy. """
+        policy_list = self.generator.policy_list
+        replies = dict((domain.encode("utf-8"), b"OK " + value.encode("utf-8"))
+                       for domain, value in self.generator.lookup_table(policy_list))
+        # Replaced in one assignment, so lookups see either table in full.
+        self.table = (replies, policy_list.expires)
+        return len(replies)
+
+    def lookup(self, request):
+        """ Returns the reply to a socketmap `request`: the map name, a
+        space and the key. """
+        name, _, key = request.partition(b" ")
+        if name != MAP_NAME.encode("ascii"):
+            return _UNKNOWN_MAP
+        table = self.table
+        if table is None:
+            return _NOT_LOADED
+        replies, expires = table
+        if util.is_expired(expires):
+            # Like the table generated for an expired policy list.
+            return _NOT_FOUND
+        return replies.get(key.lower(), _NOT_FOUND)
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        if self.address_family == socket.AF_UNIX:
+            _remove_stale_socket(self.server_address)
+
+def _remove_stale_socket(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except OSError:
+        pass
+
+class TableWatcher(watch.PolicyWatcher):
+    """ Keeps the table of `server`, a `SocketmapServer`, up to date with
+    the policy files `filenames`, reloading the policy list when they
+    change. The results passed to `on_generate` are the number of domains
+    served. """
+
+    def __init__(self, server, filenames, **kwargs):
+        watch.PolicyWatcher.__init__(self, [server.generator], filenames, **kwargs)
+        self.server = server
+
+    def _run(self):
+        return [self.server.update()]
+
+def serve(server, watcher, stop=None):
+    """ Serves requests on a background thread while `watcher` keeps the
+    table up to date, until `stop` (a `threading.Event`) is set, if given,
+    or forever. Closes the server on the way out. """
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        watcher.run(stop)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+class Client(object):
+    # pylint: disable=useless-object-inheritance
+    """ Connection to a socketmap server at `address`. """
+
+    def __init__(self, address, timeout=10):
+        family, server_address = parse_address(address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(server_address)
+        self._reader = self._socket.makefile("rb")
+
+    def lookup(self, key, name=MAP_NAME):
+        """ Looks up `key` in map `name`. Returns the status of the reply
+        and its value (or reason), as text. """
+        self._socket.sendall(netstring(u"{} {}".format(name, key).encode("utf-8")))
+        reply = read_netstring(self._reader, max_length=100000)
+        if reply is None:
+            raise ValueError("Connection closed by the server")
+        status, _, value = reply.decode("utf-8").partition(" ")
+        return status, value
+
+    def close(self):
+        """ Closes the connection. """
+        self._reader.close()
+        self._socket.close()
+
+def load_test(address, keys, requests=10000, connections=4):
+    """ Looks up `keys` in turn `requests` times in total, spread over
+    `connections` concurrent connections to the server at `address`.
+    Returns the number of replies by status and the time taken. """
+    keys = list(keys)
+    counts = {}
+    lock = threading.Lock()
+    errors = []
+    def worker(index):
+        seen = {}
+        try:
+            client = Client(address)
+            try:
+                for i in range(index, requests, connections):
+                    status, _ = client.lookup(keys[i % len(keys)])
+                    seen[status] = seen.get(status, 0) + 1
+            finally:
+                client.close()
+        except (IOError, OSError, ValueError) as e:
+            errors.append(e)
+        with lock:
+            for status, count in seen.items():
+                counts[status] = counts.get(status, 0) + count
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(connections)]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = timeit.default_timer() - start
+    if errors:
+        raise errors[0]
+    return counts, seconds
+
+def _argument_parser():
+    parser = argparse.ArgumentParser(
+        description="Load-tests a socketmap server with the domains of a policy list",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("address", help="Address of the server, unix:PATH or inet:HOST:PORT.")
+    parser.add_argument("-d", "--policy-dir", default="/etc/starttls-policy/",
+                        dest="policy_dir", help="Directory of the policy list to take "
+                        "domains from. Every other lookup is for a domain not in the list.")
+    parser.add_argument("--requests", type=int, default=10000,
+                        help="Total number of lookups.")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="Number of concurrent connections.")
+    return parser
+
+def main(argv=None):
+    """ Entrypoint for the load-test client. """
+    arguments = _argument_parser().parse_args(argv)
+    config = policy.Config(os.path.join(arguments.policy_dir, constants.POLICY_FILENAME))
+    config.load()
+    keys = []
+    for domain in sorted(config):
+        keys.extend((domain, "unknown." + domain))
+    counts, seconds = load_test(arguments.address, keys or ["unknown.example"],
+                                arguments.requests, arguments.connections)
+    print("{} lookups over {} connections in {:.3f}s: {:.0f} lookups/s".format(
+        arguments.requests, arguments.connections, seconds, arguments.requests / seconds))
+    for status in sorted(counts):
+        print("  {:<8} {}".format(status, counts[status]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,85 @@
+""" Tests for benchmark.py """
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from starttls_policy_cli import benchmark
+from starttls_policy_cli import policy
+
+class TestSyntheticPolicyList(unittest.TestCase):
+    """Tests for the synthetic policy list generator"""
+
+    def test_deterministic(self):
+        self.assertEqual(benchmark.synthetic_policy_list(100, seed=3),
+                         benchmark.synthetic_policy_list(100, seed=3))
+        self.assertNotEqual(benchmark.synthetic_policy_list(100, seed=3),
+                            benchmark.synthetic_policy_list(100, seed=4))
+
+    def test_valid(self):
+        data = benchmark.synthetic_policy_list(500, alias_ratio=0.2, mx_count=3)
+        conf = policy.Config()
+        conf.load_from_dict(data)
+        self.assertEqual(len(conf), 500)
+        self.assertEqual(conf.collect_errors(data), [])
+        aliased = [domain for domain in conf if conf.policies[domain].policy_alias]
+        self.assertTrue(50 < len(aliased) < 150)
+        for domain in conf:
+            self.assertEqual(len(conf[domain].mxs), 3)
+
+    def test_no_aliases(self):
+        data = benchmark.synthetic_policy_list(50, alias_ratio=0.5, aliases=0)
+        self.assertFalse(any("policy-alias" in obj for obj in data["policies"].values()))
+
+class TestBenchmarks(unittest.TestCase):
+    """Tests for running and comparing benchmarks"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_all(self):
+        results = benchmark.run_benchmarks(sizes=[20, 40], repeat=2)
+        self.assertEqual(results["version"], benchmark.RESULTS_VERSION)
+        self.assertEqual([(r["benchmark"], r["domains"]) for r in results["results"]],
+                         [(name, size) for size in (20, 40) for name in benchmark.BENCHMARKS])
+        for result in results["results"]:
+            self.assertEqual(len(result["runs"]), 2)
+            self.assertEqual(result["seconds"], min(result["runs"]))
+        json.dumps(results)
+
+    def test_compare(self):
+        baseline = {"results": [
+            {"benchmark": "load", "domains": 10, "alias_ratio": 0.1, "mx_count": 2,
+             "seconds": 1.0},
+            {"benchmark": "dump", "domains": 10, "alias_ratio": 0.1, "mx_count": 2,
+             "seconds": 1.0},
+        ]}
+        current = {"results": [
+            dict(baseline["results"][0], seconds=1.2),
+            dict(baseline["results"][1], seconds=1.3),
+            dict(baseline["results"][1], domains=20, seconds=5.0),
+        ]}
+        regressions = benchmark.compare(baseline, current, threshold=0.25)
+        self.assertEqual([(r["benchmark"], old) for r, old in regressions], [("dump", 1.0)])
+        self.assertEqual(benchmark.compare(baseline, current, threshold=0.5), [])
+
+    def test_main(self):
+        output = os.path.join(self.tmpdir, "results.json")
+        args = ["--sizes", "10", "--repeat", "1", "--benchmark", "load",
+                "--benchmark", "generate"]
+        with mock.patch("starttls_policy_cli.benchmark.print", create=True):
+            self.assertEqual(benchmark.main(args + ["--output", output]), 0)
+            with open(output) as f:
+                saved = json.load(f)
+            self.assertEqual([r["benchmark"] for r in saved["results"]], ["load", "generate"])
+            for result in saved["results"]:
+                result["seconds"] = 0.0
+            with open(output, "w") as f:
+                json.dump(saved, f)
+            self.assertEqual(benchmark.main(args + ["--compare", output]), 1)
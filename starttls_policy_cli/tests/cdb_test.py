@@ -0,0 +1,64 @@
+""" Tests for cdb.py """
+import io
+import unittest
+
+from starttls_policy_cli import cdb
+
+def _build(records):
+    output = io.BytesIO()
+    writer = cdb.Writer(output)
+    for key, value in records:
+        writer.add(key, value)
+    writer.finish()
+    return output.getvalue()
+
+class TestCDB(unittest.TestCase):
+    """Tests for the CDB writer and reader"""
+
+    def test_hash(self):
+        self.assertEqual(cdb.cdb_hash(b""), 5381)
+        self.assertEqual(cdb.cdb_hash(b"a"), 177604)
+        self.assertEqual(cdb.cdb_hash(b"example.com"), 0xe8b78f82)
+
+    def test_empty(self):
+        data = _build([])
+        self.assertEqual(len(data), 2048)
+        table = cdb.Reader(data)
+        self.assertEqual(list(table.items()), [])
+        self.assertEqual(table.get(b"missing"), None)
+
+    def test_known_layout(self):
+        # Same bytes as `cdbmake` produces for the record "+1,1:a->b".
+        data = _build([(b"a", b"b")])
+        self.assertEqual(len(data), 2048 + 10 + 16)
+        self.assertEqual(data[8 * 0xc4:8 * 0xc4 + 8], b"\x0a\x08\0\0\x02\0\0\0")
+        self.assertEqual(data[2048:2058], b"\x01\0\0\0\x01\0\0\0ab")
+
+    def test_round_trip(self):
+        records = [(u"domain{}.example".format(i).encode("ascii"),
+                    u"secure match=mx{}.example".format(i).encode("ascii"))
+                   for i in range(2000)]
+        table = cdb.Reader(_build(records))
+        self.assertEqual(list(table.items()), records)
+        for key, value in records:
+            self.assertEqual(table[key], value)
+            self.assertTrue(key in table)
+        self.assertFalse(b"domain2000.example" in table)
+        with self.assertRaises(KeyError):
+            table[b"domain2000.example"] # pylint: disable=pointless-statement
+
+    def test_duplicate_keys(self):
+        table = cdb.Reader(_build([(b"k", b"1"), (b"other", b""), (b"k", b"2")]))
+        self.assertEqual(table.get_all(b"k"), [b"1", b"2"])
+        self.assertEqual(table[b"k"], b"1")
+        self.assertEqual(table[b"other"], b"")
+
+    def test_truncated(self):
+        data = _build([(b"key", b"value")])
+        with self.assertRaises(cdb.CDBError):
+            cdb.Reader(data[:100])
+        with self.assertRaises(cdb.CDBError):
+            cdb.Reader(data[:2052]).get(b"key")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,17 @@
 """ Tests for configure.py """
 
 import unittest
+import json
 import tempfile
 import os
+import shutil
 
 import mock
 
+from starttls_policy_cli import cdb
 from starttls_policy_cli import configure
+from starttls_policy_cli import policy
+from starttls_policy_cli import profiling
 from starttls_policy_cli.tests.util import param, parametrize_over
 
 class MockGenerator(configure.ConfigGenerator):
@@ -68,8 +73,7 @@ class TempPolicyDir(object):
         return self._tmpdir
 
     def __exit__(self, exc_type, exc_value, traceback):
-        os.remove(self._policy_filename)
-        os.rmdir(self._tmpdir)
+        shutil.rmtree(self._tmpdir)
 
 test_json = '{\
     "author": "Electronic Frontier Foundation",\
@@ -116,6 +120,148 @@ testgen_data = [
                                                "Falling back to opportunistic encryption.\n"),
 ]
 
+class TestStreamedOutput(unittest.TestCase):
+    """Test that output is streamed into place atomically"""
+
+    def test_generate_yields_lines(self):
+        with TempPolicyDir(test_json) as testdir:
+            generator = configure.PostfixGenerator(testdir)
+            lines = generator._generate(generator._load_config()) # pylint: disable=protected-access
+            self.assertFalse(isinstance(lines, (list, str)))
+            self.assertEqual(len(list(lines)), 2)
+
+    def test_failed_generation_keeps_old_file(self):
+        with TempPolicyDir(test_json) as testdir:
+            pol_filename = os.path.join(testdir, "default_filename")
+            with open(pol_filename, "w") as pol_file:
+                pol_file.write("old")
+            generator = MockGenerator(testdir)
+            def failing(policy_list):
+                # pylint: disable=unused-argument
+                yield "partial"
+                raise RuntimeError
+            generator._generate = failing # pylint: disable=protected-access
+            with self.assertRaises(RuntimeError):
+                generator.generate()
+            with open(pol_filename) as pol_file:
+                self.assertEqual(pol_file.read(), "old")
+            self.assertEqual(sorted(os.listdir(testdir)),
+                             ["default_filename", "policy.json", "policy.json.snapshot"])
+
+    def test_empty_policy_list(self):
+        empty = json.loads(test_json)
+        empty["policies"] = {}
+        with TempPolicyDir(json.dumps(empty)) as testdir:
+            configure.PostfixGenerator(testdir).generate()
+            self.assertEqual(_read_output(testdir), "\n")
+
+    def test_fsync(self):
+        with TempPolicyDir(test_json) as testdir:
+            with mock.patch("os.fsync") as fsync:
+                configure.PostfixGenerator(testdir, fsync=True).generate()
+            self.assertTrue(fsync.called)
+            self.assertEqual(_read_output(testdir), testgen_data[0].args[2])
+
+class TestUnchangedOutput(unittest.TestCase):
+    """Test that unchanged output is not rewritten"""
+
+    def test_unchanged_keeps_file(self):
+        with TempPolicyDir(test_json) as testdir:
+            self.assertTrue(configure.PostfixGenerator(testdir).generate())
+            pol_filename = os.path.join(testdir, "postfix_tls_policy")
+            os.utime(pol_filename, (0, 0))
+            result = configure.PostfixGenerator(testdir).generate()
+            self.assertFalse(result)
+            self.assertEqual(os.stat(pol_filename).st_mtime, 0)
+            self.assertEqual(sorted(os.listdir(testdir)),
+                             ["policy.json", "policy.json.snapshot", "postfix_tls_policy"])
+
+    def test_changed_rewrites_file(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate()
+            self.assertTrue(configure.PostfixGenerator(testdir, True).generate())
+            self.assertEqual(_read_output(testdir), testgen_data[1].args[2])
+
+    def test_same_size_different_content(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate()
+            expected = _read_output(testdir)
+            with open(os.path.join(testdir, "postfix_tls_policy"), "w") as output:
+                output.write("x" * len(expected))
+            self.assertTrue(configure.PostfixGenerator(testdir).generate())
+            self.assertEqual(_read_output(testdir), expected)
+
+class TestOverlays(unittest.TestCase):
+    """Test generating from a policy list with overlays"""
+
+    def test_overlays(self):
+        with TempPolicyDir(test_json) as testdir:
+            overlays = [os.path.join(testdir, name) for name in ("org.json", "host.json")]
+            with open(overlays[0], "w") as f:
+                json.dump({"policy-aliases": {"org": {"mode": "enforce", "mxs": [".org.example"]}},
+                           "policies": {".testing.example-recipient.com": {"mode": "none"},
+                                        "org.example": {"policy-alias": "org"}}}, f)
+            with open(overlays[1], "w") as f:
+                json.dump({"policies": {".testing.example-recipient.com": {
+                    "mode": "enforce", "mxs": ["mx.example-recipient.com"]}}}, f)
+            generator = configure.PostfixGenerator(testdir, overlays=overlays)
+            generator.generate()
+            self.assertEqual(_read_output(testdir),
+                             ".testing.example-recipient.com  "
+                             "secure match=mx.example-recipient.com\n"
+                             ".valid.example-recipient.com    "
+                             "secure match=.valid.example-recipient.com\n"
+                             "org.example                     "
+                             "secure match=.org.example\n")
+            self.assertEqual(generator.policy_list.sources["policies"]["org.example"], 1)
+
+class TestGenerateAll(unittest.TestCase):
+    """Test generating files for several MTAs from one policy list"""
+
+    def test_generate_all(self):
+        with TempPolicyDir(test_json) as testdir:
+            for threads in (None, 1):
+                generators = [configure.PostfixGenerator(testdir),
+                              configure.PostfixCDBGenerator(testdir)]
+                with mock.patch("starttls_policy_cli.policy.Config.load",
+                                autospec=True, side_effect=policy.Config.load) as load:
+                    results = configure.generate_all(generators, threads=threads)
+                load.assert_called_once_with(mock.ANY, snapshot=True)
+                self.assertTrue(generators[1].policy_list is generators[0].policy_list)
+                self.assertEqual([bool(result) for result in results], [threads is None] * 2)
+                self.assertEqual(_read_output(testdir), testgen_data[0].args[2])
+                with open(os.path.join(testdir, "postfix_tls_policy.cdb"), "rb") as f:
+                    self.assertEqual(dict(cdb.Reader(f.read()).items()), {
+                        b".valid.example-recipient.com":
+                            b"secure match=.valid.example-recipient.com"})
+
+    def test_incremental(self):
+        with TempPolicyDir(test_json) as testdir:
+            generators = [configure.PostfixGenerator(testdir),
+                          configure.PostfixCDBGenerator(testdir)]
+            results = configure.generate_all(generators, incremental=True)
+            self.assertEqual([len(result.delta.added) for result in results], [2, 2])
+
+    def test_empty(self):
+        self.assertEqual(configure.generate_all([]), [])
+
+class TestProfiledGenerate(unittest.TestCase):
+    """Test that generation reports the time spent in each phase"""
+
+    def test_phases(self):
+        with TempPolicyDir(test_json) as testdir:
+            with profiling.Profiler() as profiler:
+                configure.PostfixGenerator(testdir).generate()
+            self.assertEqual(_read_output(testdir), testgen_data[0].args[2])
+            # "dates" is missing if the dates were already parsed by another test.
+            self.assertEqual(set(profiler.times) - set(["dates"]),
+                             set(["other", "load", "read", "decode", "validate", "snapshot",
+                                  "generate", "write"]))
+            with profiling.Profiler() as profiler:
+                configure.PostfixGenerator(testdir).generate()
+            self.assertFalse("decode" in profiler.times)
+            self.assertTrue("snapshot" in profiler.times)
+
 class TestPostfixGenerator(unittest.TestCase):
     """Test Postfix config generator"""
 
@@ -144,5 +290,168 @@ class TestPostfixGenerator(unittest.TestCase):
 
 parametrize_over(TestPostfixGenerator, TestPostfixGenerator.config_test, testgen_data)
 
+testgen_cdb_data = [
+    param("cdb_simple_policy", test_json, False, [
+        (b".valid.example-recipient.com", b"secure match=.valid.example-recipient.com"),
+    ]),
+    param("cdb_simple_policy_early", test_json, True, [
+        (b".testing.example-recipient.com", b"secure match=.testing.example-recipient.com"),
+        (b".valid.example-recipient.com", b"secure match=.valid.example-recipient.com"),
+    ]),
+    param("cdb_expired_policy", test_json_expired, False, []),
+]
+
+class TestPostfixCDBGenerator(unittest.TestCase):
+    """Test Postfix CDB table generator"""
+
+    def test_instruct_string(self):
+        generator = configure.PostfixCDBGenerator("./")
+        instructions = generator._instruct_string() # pylint: disable=protected-access
+        self.assertFalse("postmap" in instructions)
+        self.assertTrue(" cdb:" + os.path.abspath("postfix_tls_policy\"") in instructions)
+        self.assertTrue("postfix reload" in instructions)
+        self.assertTrue(generator.default_filename in instructions)
+
+    def config_test(self, conf, enforce_testing, expected):
+        """PostfixCDBGenerator test parameterized over various policies"""
+        with TempPolicyDir(conf) as testdir:
+            generator = configure.PostfixCDBGenerator(testdir, enforce_testing)
+            generator.generate()
+            with open(os.path.join(testdir, generator.default_filename), "rb") as pol_file:
+                table = cdb.Reader(pol_file.read())
+        self.assertEqual(list(table.items()), expected)
+        for key, value in expected:
+            self.assertEqual(table[key], value)
+        self.assertFalse(b".testing.example-recipient.com" in table and not enforce_testing)
+
+    def test_keys_are_lowercase(self):
+        conf = json.loads(test_json)
+        conf["policies"]["Mixed.Example"] = {"mode": "enforce", "mxs": [".Mixed.Example"]}
+        with TempPolicyDir(json.dumps(conf)) as testdir:
+            configure.PostfixCDBGenerator(testdir).generate()
+            with open(os.path.join(testdir, "postfix_tls_policy.cdb"), "rb") as pol_file:
+                table = cdb.Reader(pol_file.read())
+        self.assertEqual(table[b"mixed.example"], b"secure match=.Mixed.Example")
+
+    def test_unchanged_keeps_file(self):
+        with TempPolicyDir(test_json) as testdir:
+            self.assertTrue(configure.PostfixCDBGenerator(testdir).generate())
+            self.assertFalse(configure.PostfixCDBGenerator(testdir).generate())
+            self.assertTrue(configure.PostfixCDBGenerator(testdir, True).generate())
+
+parametrize_over(TestPostfixCDBGenerator, TestPostfixCDBGenerator.config_test, testgen_cdb_data)
+
+def _write_policy(testdir, conf):
+    with open(os.path.join(testdir, "policy.json"), "w") as pol_file:
+        pol_file.write(conf)
+
+def _read_output(testdir):
+    with open(os.path.join(testdir, "postfix_tls_policy")) as output:
+        return output.read()
+
+class TestIncrementalGenerate(unittest.TestCase):
+    """Test incremental regeneration from policy list changes"""
+
+    def test_first_run(self):
+        with TempPolicyDir(test_json) as testdir:
+            result = configure.PostfixGenerator(testdir).generate(incremental=True)
+            self.assertTrue(result)
+            delta = result.delta
+            self.assertEqual(delta.added, [".testing.example-recipient.com",
+                                           ".valid.example-recipient.com"])
+            self.assertEqual(delta.removed, [])
+            self.assertEqual(delta.changed, [])
+            self.assertTrue(delta)
+            self.assertEqual(_read_output(testdir), testgen_data[0].args[2])
+            self.assertTrue(os.path.exists(os.path.join(testdir, "postfix_tls_policy.state")))
+
+    def test_unchanged_is_not_rewritten(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate(incremental=True)
+            with mock.patch("starttls_policy_cli.util.AtomicFile") as atomic_file:
+                result = configure.PostfixGenerator(testdir).generate(incremental=True)
+            self.assertFalse(result)
+            self.assertFalse(result.delta)
+            atomic_file.assert_not_called()
+
+    def test_modified_output_is_regenerated(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate(incremental=True)
+            with open(os.path.join(testdir, "postfix_tls_policy"), "w") as output:
+                output.write("sentinel")
+            result = configure.PostfixGenerator(testdir).generate(incremental=True)
+            self.assertTrue(result)
+            self.assertFalse(result.delta)
+            self.assertEqual(_read_output(testdir), testgen_data[0].args[2])
+
+    def test_run_in_between_is_not_incremental(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate(incremental=True)
+            conf = json.loads(test_json)
+            conf["policies"] = {"other.example.com": {"mode": "enforce", "mxs": ["mx"]}}
+            _write_policy(testdir, json.dumps(conf))
+            configure.PostfixGenerator(testdir).generate()
+            self.assertTrue("other.example.com" in _read_output(testdir))
+            _write_policy(testdir, test_json)
+            # Same policies as the last incremental run, but not what the file holds.
+            result = configure.PostfixGenerator(testdir).generate(incremental=True)
+            self.assertTrue(result)
+            self.assertFalse(result.delta)
+            self.assertEqual(_read_output(testdir), testgen_data[0].args[2])
+
+    def test_missing_output_is_regenerated(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate(incremental=True)
+            os.remove(os.path.join(testdir, "postfix_tls_policy"))
+            result = configure.PostfixGenerator(testdir).generate(incremental=True)
+            self.assertTrue(result)
+            self.assertFalse(result.delta)
+            self.assertEqual(_read_output(testdir), testgen_data[0].args[2])
+
+    def test_policy_changes(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate(incremental=True)
+            conf = json.loads(test_json)
+            del conf["policies"][".testing.example-recipient.com"]
+            conf["policies"][".valid.example-recipient.com"]["mxs"] = ["mx.example.com"]
+            conf["policies"]["new.example.com"] = {"mode": "enforce", "mxs": ["mx"]}
+            _write_policy(testdir, json.dumps(conf))
+            delta = configure.PostfixGenerator(testdir).generate(incremental=True).delta
+            self.assertEqual(delta, configure.PolicyDelta(
+                added=["new.example.com"],
+                removed=[".testing.example-recipient.com"],
+                changed=[".valid.example-recipient.com"]))
+            self.assertTrue("secure match=mx.example.com" in _read_output(testdir))
+
+    def test_option_change(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate(incremental=True)
+            delta = configure.PostfixGenerator(testdir, True).generate(incremental=True).delta
+            self.assertEqual(delta.changed, [".testing.example-recipient.com",
+                                             ".valid.example-recipient.com"])
+            self.assertEqual(_read_output(testdir), testgen_data[1].args[2])
+
+    def test_expired(self):
+        with TempPolicyDir(test_json) as testdir:
+            configure.PostfixGenerator(testdir).generate(incremental=True)
+            _write_policy(testdir, test_json_expired)
+            with mock.patch.object(configure.PostfixGenerator, "_expired_warning"):
+                delta = configure.PostfixGenerator(testdir).generate(incremental=True).delta
+                self.assertEqual(len(delta.removed), 2)
+                self.assertFalse(configure.PostfixGenerator(testdir).generate(incremental=True))
+            self.assertEqual(_read_output(testdir), testgen_data[2].args[2])
+
+    def test_corrupt_state(self):
+        with TempPolicyDir(test_json) as testdir:
+            with open(os.path.join(testdir, "postfix_tls_policy.state"), "w") as state:
+                state.write("{")
+            delta = configure.PostfixGenerator(testdir).generate(incremental=True).delta
+            self.assertEqual(len(delta.added), 2)
+
+    def test_not_incremental(self):
+        with TempPolicyDir(test_json) as testdir:
+            self.assertIsNone(configure.PostfixGenerator(testdir).generate().delta)
+            self.assertFalse(os.path.exists(os.path.join(testdir, "postfix_tls_policy.state")))
+
 if __name__ == "__main__":
     unittest.main()
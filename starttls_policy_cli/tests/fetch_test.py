@@ -0,0 +1,175 @@
+""" Tests for fetch.py """
+import unittest
+import errno
+import json
+import os
+import shutil
+import threading
+import tempfile
+
+import mock
+from six.moves import BaseHTTPServer
+from six.moves.urllib import error as urllib_error
+
+from starttls_policy_cli import fetch
+from starttls_policy_cli import main
+from starttls_policy_cli import util
+
+test_json = json.dumps({
+    "timestamp": "2018-06-18T09:41:50-07:00",
+    "expires": "2038-01-16T09:41:50-07:00",
+    "policies": {
+        "a.com": {"mode": "enforce", "mxs": ["mx.a.com"]},
+    },
+}).encode("utf-8")
+
+# Valid JSON, but not a policy list.
+wrong_structure_json = json.dumps({
+    "timestamp": "2018-06-18T09:41:50-07:00",
+    "expires": "2038-01-16T09:41:50-07:00",
+    "policies": {"a.com": 5},
+}).encode("utf-8")
+
+LAST_MODIFIED = "Mon, 18 Jun 2018 16:41:50 GMT"
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's `body`, honoring If-None-Match if it has an `etag`."""
+
+    def do_GET(self):
+        # pylint: disable=invalid-name,missing-docstring
+        server = self.server
+        # Header names are lowercased on Python 2, so they're stored lowercase.
+        server.requests.append(dict((name.lower(), value)
+                                    for name, value in self.headers.items()))
+        if server.status != 200:
+            self.send_error(server.status)
+            return
+        if server.etag is not None and self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(server.body)))
+        if server.etag is not None:
+            self.send_header("ETag", server.etag)
+            self.send_header("Last-Modified", LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        # pylint: disable=arguments-differ,missing-docstring
+        pass
+
+class TestFetch(unittest.TestCase):
+    """Tests for downloading the policy list from a local HTTP server"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "policy.json")
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.requests = []
+        self.server.status = 200
+        self.server.etag = '"v1"'
+        self.server.body = test_json
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/policy.json".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with open(self.filename, "rb") as f:
+            return f.read()
+
+    def test_conditional(self):
+        self.assertEqual(fetch.fetch(self.url, self.filename), fetch.FetchResult(True, 200))
+        self.assertEqual(self._read(), test_json)
+        self.assertFalse("if-none-match" in self.server.requests[0])
+        mtime = os.stat(self.filename).st_mtime
+        result = fetch.fetch(self.url, self.filename)
+        self.assertFalse(result)
+        self.assertEqual(result.status, 304)
+        self.assertEqual(self.server.requests[1]["if-none-match"], '"v1"')
+        self.assertEqual(self.server.requests[1]["if-modified-since"], LAST_MODIFIED)
+        self.assertEqual(os.stat(self.filename).st_mtime, mtime)
+        # A new version is downloaded.
+        self.server.etag = '"v2"'
+        self.server.body = test_json.replace(b"mx.a.com", b"mx2.a.com")
+        self.assertTrue(fetch.fetch(self.url, self.filename))
+        self.assertEqual(self._read(), self.server.body)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["policy.json", "policy.json.fetch"])
+
+    def test_without_validators(self):
+        self.server.etag = None
+        self.assertTrue(fetch.fetch(self.url, self.filename))
+        result = fetch.fetch(self.url, self.filename)
+        self.assertEqual(result, fetch.FetchResult(False, 200))
+        self.assertFalse("if-none-match" in self.server.requests[1])
+
+    def test_local_copy_changed(self):
+        fetch.fetch(self.url, self.filename)
+        with open(self.filename, "wb") as f:
+            f.write(test_json.replace(b"a.com", b"b.com"))
+        self.assertTrue(fetch.fetch(self.url, self.filename))
+        self.assertFalse("if-none-match" in self.server.requests[1])
+        self.assertEqual(self._read(), test_json)
+        # Nor are the validators sent to another URL.
+        fetch.fetch(self.url + "?mirror", self.filename)
+        self.assertFalse("if-none-match" in self.server.requests[2])
+
+    def test_invalid_download(self):
+        fetch.fetch(self.url, self.filename)
+        self.server.etag = '"v2"'
+        for body in (test_json[:-10], test_json.replace(b"enforce", b"bogus"),
+                     wrong_structure_json, b"[]"):
+            self.server.body = body
+            self.assertRaises(util.ConfigError, fetch.fetch, self.url, self.filename)
+            self.assertEqual(self._read(), test_json)
+            self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                             ["policy.json", "policy.json.fetch"])
+
+    def test_http_error(self):
+        self.server.status = 500
+        self.assertRaises(urllib_error.HTTPError, fetch.fetch, self.url, self.filename)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_network_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(urllib_error.URLError) as context:
+            fetch.fetch(self.url, self.filename, timeout=5)
+        self.assertEqual(context.exception.reason.errno, errno.ECONNREFUSED)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_main(self):
+        argv = ["_", "--fetch", "--url", self.url, "--policy-dir", self.tmpdir, "--exit-code"]
+        with mock.patch("sys.argv", argv):
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main.main(), 0)
+                mock_print.assert_called_once_with(
+                    "Updated {} from {}.".format(self.filename, self.url))
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main.main(), main.EXIT_UNCHANGED)
+                mock_print.assert_called_once_with(
+                    "Policy list {} is unchanged.".format(self.filename))
+            self.server.status = 404
+            self.server.etag = None
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main.main(), 1)
+            message = mock_print.call_args[0][0]
+            self.assertTrue(message.startswith("Couldn't update {} from {}: ".format(
+                self.filename, self.url)))
+            self.assertTrue("404" in message)
+            self.server.status = 200
+            self.server.body = wrong_structure_json
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main.main(), 1)
+            self.assertTrue(mock_print.call_args[0][0].endswith(
+                "Invalid policy list: policies/a.com: Configuration value 5 is not an object"))
+
+if __name__ == '__main__':
+    unittest.main()
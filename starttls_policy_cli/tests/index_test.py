@@ -0,0 +1,107 @@
+""" Tests for index.py """
+import os
+import shutil
+import tempfile
+import unittest
+
+from starttls_policy_cli import index
+from starttls_policy_cli import policy
+from starttls_policy_cli.tests.util import param, parametrize_over
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+
+class TestPolicyIndex(unittest.TestCase):
+    """Tests for the memory-mapped policy index"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'policy.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _config(self, name):
+        conf = policy.Config(os.path.join(TESTDATA_DIR, name))
+        conf.load()
+        return conf
+
+    def same_as_config_test(self, name):
+        """Parametrized test that the index answers like the config it was built from"""
+        conf = self._config(name)
+        index.write_index(conf, self.filename)
+        with index.PolicyIndex(self.filename) as idx:
+            self.assertEqual(len(idx), len(conf))
+            self.assertEqual(sorted(idx), sorted(conf))
+            for domain in conf:
+                self.assertTrue(domain in idx)
+                self.assertEqual(idx[domain].get_dict(), conf.get_policy_for(domain).get_dict())
+            self.assertEqual(idx.author, conf.author)
+            self.assertEqual(idx.expires, conf.expires)
+            self.assertEqual(idx.timestamp, conf.timestamp)
+
+    def test_alias_resolved(self):
+        index.write_index(self._config('config.json'), self.filename)
+        with index.PolicyIndex(self.filename) as idx:
+            gmail = idx.get_policy_for('gmail.com')
+            self.assertEqual(gmail.mode, 'testing')
+            self.assertEqual(gmail.mxs, ['.mail.google.com'])
+            self.assertEqual(gmail.policy_alias, None)
+
+    def test_missing(self):
+        index.write_index(self._config('config.json'), self.filename)
+        with index.PolicyIndex(self.filename) as idx:
+            for domain in ('', 'aaa.com', 'eff.or', 'eff.orgg', 'zzz.com', None, 5):
+                self.assertFalse(domain in idx)
+                self.assertEqual(idx.get_policy_for(domain), None)
+            with self.assertRaises(KeyError):
+                idx['missing.com'] # pylint: disable=pointless-statement
+
+    def test_get_policies_for(self):
+        index.write_index(self._config('config.json'), self.filename)
+        with index.PolicyIndex(self.filename) as idx:
+            results = idx.get_policies_for(['eff.org', 'missing.com', 'gmail.com', 'eff.org'])
+            self.assertEqual(results[0].mxs, ['.eff.org'])
+            self.assertTrue(results[1] is policy.NO_POLICY)
+            self.assertEqual(results[2].mxs, ['.mail.google.com'])
+            self.assertTrue(results[3] is results[0])
+
+    def test_empty(self):
+        conf = self._config('config.json')
+        conf.policies = {}
+        index.write_index(conf, self.filename)
+        with index.PolicyIndex(self.filename) as idx:
+            self.assertEqual(len(idx), 0)
+            self.assertEqual(list(idx), [])
+            self.assertFalse('eff.org' in idx)
+
+    def test_min_tls_version(self):
+        conf = self._config('config.json')
+        conf.policies = {'a.com': {'mode': 'enforce', 'mxs': ['mx.a.com']}}
+        conf.policies['a.com']._min_tls_version = 'TLSv1.2' # pylint: disable=protected-access
+        index.write_index(conf, self.filename)
+        with index.PolicyIndex(self.filename) as idx:
+            self.assertEqual(idx['a.com'].min_tls_version, 'TLSv1.2')
+
+    def invalid_test(self, data):
+        """Parametrized test for files that aren't valid indexes"""
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+        with self.assertRaises(index.IndexFormatError):
+            index.PolicyIndex(self.filename)
+
+parametrize_over(TestPolicyIndex, TestPolicyIndex.same_as_config_test, [
+    param('same_as_config', 'config.json'),
+    param('same_as_bigger_config', 'bigger_test_config.json'),
+    param('same_as_utf8_config', 'utf8.json'),
+])
+
+parametrize_over(TestPolicyIndex, TestPolicyIndex.invalid_test, [
+    param('invalid_empty', b''),
+    param('invalid_short', b'STPI'),
+    param('invalid_magic', b'XXXX\x01\0\0\0\0\0\0\0\0\0\0\0'),
+    param('invalid_version', b'STPI\x02\0\0\0\0\0\0\0\0\0\0\0'),
+    param('invalid_truncated', b'STPI\x01\0\0\0\x05\0\0\0\0\0\0\0'),
+])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+""" Tests for jsonstream.py """
+import io
+import json
+import unittest
+
+from starttls_policy_cli import jsonstream
+from starttls_policy_cli import util
+from starttls_policy_cli.tests.util import param, parametrize_over
+
+test_json = u'''{
+    "author": "Electronic Frontier Foundation",
+    "version": 12345678901234567890,
+    "empty": {},
+    "policies": {
+        "eff.org": {"mode": "enforce", "mxs": [".eff.org"]},
+        "example.com": {"mode": "testing", "mxs": ["mail.example.com"]},
+        "\\u00fcber.example": {"mxs": []}
+    },
+    "trailer": [1, 2.5, null, true]
+}'''
+
+
+def _materialize(pairs):
+    result = []
+    for key, value in pairs:
+        if isinstance(value, jsonstream.ObjectStream):
+            value = dict(value)
+        result.append((key, value))
+    return result
+
+
+class TestIterparse(unittest.TestCase):
+    """Tests for the incremental JSON object reader"""
+
+    def chunked_test(self, chunk_size):
+        """Parametrized test over stream chunk sizes"""
+        pairs = _materialize(jsonstream.iterparse(io.StringIO(test_json),
+                                                  expand=('policies', 'empty'),
+                                                  chunk_size=chunk_size))
+        self.assertEqual(dict(pairs), json.loads(test_json))
+        self.assertEqual([key for key, _ in pairs],
+                         ["author", "version", "empty", "policies", "trailer"])
+
+    def test_expanded_members_are_streams(self):
+        for key, value in jsonstream.iterparse(io.StringIO(test_json), expand=('policies',)):
+            if key == 'policies':
+                self.assertTrue(isinstance(value, jsonstream.ObjectStream))
+                self.assertEqual(next(value)[0], "eff.org")
+            else:
+                self.assertFalse(isinstance(value, jsonstream.ObjectStream))
+
+    def test_unconsumed_members_are_skipped(self):
+        keys = [key for key, _ in jsonstream.iterparse(io.StringIO(test_json),
+                                                       expand=('policies',),
+                                                       chunk_size=3)]
+        self.assertEqual(keys, ["author", "version", "empty", "policies", "trailer"])
+
+    def test_non_object_expand(self):
+        pairs = list(jsonstream.iterparse(io.StringIO(u'{"policies": null}'),
+                                          expand=('policies',)))
+        self.assertEqual(pairs, [("policies", None)])
+
+    def test_empty_object(self):
+        self.assertEqual(list(jsonstream.iterparse(io.StringIO(u' { } '))), [])
+
+    def invalid_test(self, text):
+        """Parametrized test for malformed input"""
+        with self.assertRaises(ValueError):
+            list(jsonstream.iterparse(io.StringIO(text), expand=('policies',), chunk_size=2))
+
+    def test_invalid_is_config_error(self):
+        with self.assertRaises(util.ConfigError):
+            list(jsonstream.iterparse(io.StringIO(u'[]')))
+
+parametrize_over(TestIterparse, TestIterparse.chunked_test,
+                 [param("chunk_size_{}".format(size), size) for size in (1, 2, 3, 7, 64, 65536)])
+
+parametrize_over(TestIterparse, TestIterparse.invalid_test,
+                 [
+                     param("invalid_empty", u""),
+                     param("invalid_array", u"[1, 2]"),
+                     param("invalid_unterminated", u'{"a": 1'),
+                     param("invalid_missing_colon", u'{"a" 1}'),
+                     param("invalid_missing_comma", u'{"a": 1 "b": 2}'),
+                     param("invalid_key", u'{1: 2}'),
+                     param("invalid_value", u'{"a": nope}'),
+                     param("invalid_nested", u'{"policies": {"a": {"mode": }}}'),
+                     param("invalid_trailing", u'{"a": 1} {}'),
+                 ])
+
+if __name__ == '__main__':
+    unittest.main()
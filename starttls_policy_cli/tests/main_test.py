@@ -1,10 +1,61 @@
 """ Tests for main.py """
 import unittest
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 import mock
 
+from starttls_policy_cli import configure
 from starttls_policy_cli import main
 
+# Modules that must not be imported before the arguments are parsed.
+DEFERRED_MODULES = ("starttls_policy_cli.configure", "starttls_policy_cli.policy",
+                    "dateutil", "six", "json", "logging", "multiprocessing")
+
+# The only modules `starttls_policy_cli.main` may import on top of `argparse`.
+STARTUP_MODULES = set(["__future__", "starttls_policy_cli", "starttls_policy_cli.constants",
+                       "starttls_policy_cli.main"])
+
+def _import_times(module):
+    """Runs `python -X importtime` on `module`, returning the cumulative
+    import time in microseconds of each module it imports."""
+    process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import " + module],
+                               stderr=subprocess.PIPE, universal_newlines=True)
+    _, output = process.communicate()
+    times = {}
+    for line in output.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+def _loaded_modules(module):
+    """Names of the modules loaded after importing `module` in a new interpreter."""
+    code = ("import sys; import {}; "
+            "print('\\n'.join(name for name, loaded in sys.modules.items() if loaded))")
+    output = subprocess.check_output([sys.executable, "-c", code.format(module)],
+                                     universal_newlines=True)
+    return set(output.split())
+
+class TestStartup(unittest.TestCase):
+    """Testing that the CLI starts quickly"""
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires Python 3.7")
+    def test_deferred_imports(self):
+        imported = _import_times("starttls_policy_cli.main")
+        self.assertTrue("starttls_policy_cli.main" in imported)
+        for module in DEFERRED_MODULES:
+            self.assertFalse(module in imported, module + " is imported at startup")
+
+    def test_startup_modules(self):
+        # Counting modules rather than timing the import keeps this deterministic.
+        extra = _loaded_modules("starttls_policy_cli.main") - _loaded_modules("argparse")
+        self.assertEqual(extra - STARTUP_MODULES, set())
+        self.assertTrue("starttls_policy_cli.main" in extra)
+
 class TestArguments(unittest.TestCase):
     """Testing argument parser"""
 
@@ -27,7 +78,7 @@ class TestArguments(unittest.TestCase):
         sys.argv = ["_", "--generate", "postfix"]
         parser = main._argument_parser()
         arguments = parser.parse_args()
-        self.assertEqual(arguments.generate, "postfix")
+        self.assertEqual(arguments.generate, ["postfix"])
 
     def test_default_dir(self):
         # pylint: disable=protected-access
@@ -36,6 +87,27 @@ class TestArguments(unittest.TestCase):
         arguments = parser.parse_args()
         self.assertEqual(arguments.policy_dir, "/etc/starttls-policy/")
 
+    def test_validate_arg(self):
+        # pylint: disable=protected-access
+        sys.argv = ["_", "--validate", "-j", "4"]
+        arguments = main._argument_parser().parse_args()
+        self.assertTrue(arguments.validate)
+        self.assertEqual(arguments.processes, 4)
+        self.assertIsNone(arguments.generate)
+
+    def test_validate_excludes_generate(self):
+        # pylint: disable=protected-access
+        sys.argv = ["_", "--validate", "--generate", "postfix"]
+        parser = main._argument_parser()
+        parser.error = mock.MagicMock(side_effect=Exception)
+        self.assertRaises(Exception, parser.parse_args)
+
+    def test_overlays(self):
+        # pylint: disable=protected-access
+        sys.argv = ["_", "--generate", "postfix", "-o", "org.json", "--overlay", "host.json"]
+        arguments = main._argument_parser().parse_args()
+        self.assertEqual(arguments.overlays, ["org.json", "host.json"])
+
     def test_policy_dir(self):
         # pylint: disable=protected-access
         sys.argv = ["_", "--generate", "postfix", "--policy-dir", "lmao"]
@@ -55,11 +127,208 @@ class TestPerform(unittest.TestCase):
     @mock.patch("starttls_policy_cli.main._ensure_directory")
     def test_generate(self, ensure_directory):
         # pylint: disable=protected-access, unused-argument
-        main.GENERATORS = {"exists": mock.MagicMock()}
-        sys.argv = ["_", "--generate", "exists"]
-        parser = main._argument_parser()
-        main._generate(parser.parse_args())
-        self.assertTrue(main.GENERATORS["exists"].called_with("/etc/starttls-policy"))
+        generator = mock.MagicMock()
+        with mock.patch.dict(main.GENERATORS, {"exists": generator}):
+            sys.argv = ["_", "--generate", "exists"]
+            parser = main._argument_parser()
+            main._generate(parser.parse_args())
+        generator.assert_called_with("/etc/starttls-policy/", False, fsync=False, overlays=[])
+
+    def test_validate(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "policy.json")
+            with open(filename, "w") as f:
+                json.dump({"timestamp": 0, "expires": 0,
+                           "policies": {"a.com": {"mode": "none"}, "b.com": {"mxs": [0]}}}, f)
+            sys.argv = ["_", "--validate", "--policy-dir", tmpdir]
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main.main(), 1)
+            printed = [call[0][0] for call in mock_print.call_args_list]
+            self.assertTrue(printed[0].startswith("policies/"))
+            self.assertTrue(printed[2].startswith("2 error(s) found"))
+            with open(filename, "w") as f:
+                json.dump({"timestamp": 0, "expires": 0}, f)
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main.main(), 0)
+            mock_print.assert_called_once_with(filename + " is valid")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch("starttls_policy_cli.main._ensure_directory")
+    def test_generate_incremental(self, ensure_directory):
+        # pylint: disable=protected-access, unused-argument
+        generator = mock.MagicMock()
+        generator.return_value.generate.return_value = configure.GenerateResult(
+            True, configure.PolicyDelta([], ["a"], []))
+        sys.argv = ["_", "--generate", "postfix", "--incremental"]
+        arguments = main._argument_parser().parse_args()
+        with mock.patch.dict(main.GENERATORS, {"postfix": generator}):
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main._generate(arguments), 0)
+        generator.return_value.generate.assert_called_once_with(incremental=True)
+        mock_print.assert_called_once_with(
+            "Policy changes since last run: 0 added, 1 removed, 0 changed.")
+
+    @mock.patch("starttls_policy_cli.main._ensure_directory")
+    def test_generate_unchanged_exit_code(self, ensure_directory):
+        # pylint: disable=protected-access, unused-argument
+        generator = mock.MagicMock()
+        generator.return_value.default_filename = "output"
+        generator.return_value.generate.return_value = configure.GenerateResult(False, None)
+        with mock.patch.dict(main.GENERATORS, {"postfix": generator}):
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                sys.argv = ["_", "--generate", "postfix", "--policy-dir", "dir"]
+                self.assertEqual(main.main(), 0)
+                mock_print.assert_called_once_with(
+                    "Configuration file " + os.path.join("dir", "output") + " is unchanged.")
+                sys.argv.append("--exit-code")
+                self.assertEqual(main.main(), main.EXIT_UNCHANGED)
+                generator.return_value.generate.return_value = configure.GenerateResult(True, None)
+                self.assertEqual(main.main(), 0)
+
+    @mock.patch("starttls_policy_cli.main._ensure_directory")
+    def test_generate_several(self, ensure_directory):
+        # pylint: disable=unused-argument
+        postfix, cdb = mock.MagicMock(), mock.MagicMock()
+        postfix.return_value.default_filename = "postfix"
+        cdb.return_value.default_filename = "cdb"
+        postfix.return_value.generate.return_value = configure.GenerateResult(False, None)
+        cdb.return_value.generate.return_value = configure.GenerateResult(True, None)
+        sys.argv = ["_", "-g", "postfix", "-g", "postfix-cdb", "-g", "postfix",
+                    "--policy-dir", "dir", "--exit-code"]
+        with mock.patch.dict(main.GENERATORS, {"postfix": postfix, "postfix-cdb": cdb}):
+            with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                self.assertEqual(main.main(), 0)
+                mock_print.assert_called_once_with(
+                    "Configuration file " + os.path.join("dir", "postfix") + " is unchanged.")
+                cdb.return_value.generate.return_value = configure.GenerateResult(False, None)
+                self.assertEqual(main.main(), main.EXIT_UNCHANGED)
+        postfix.assert_called_with("dir", False, fsync=False, overlays=[])
+        self.assertEqual(postfix.call_count, 2)
+        self.assertEqual(cdb.return_value.manual_instructions.call_count, 2)
+        self.assertTrue(cdb.return_value.policy_list is postfix.return_value.policy_list)
+
+    @mock.patch("starttls_policy_cli.main._ensure_directory")
+    def test_generate_profile(self, ensure_directory):
+        # pylint: disable=unused-argument
+        generator = mock.MagicMock()
+        generator.return_value.generate.return_value = configure.GenerateResult(True, None)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dump = os.path.join(tmpdir, "profile.out")
+            with mock.patch.dict(main.GENERATORS, {"postfix": generator}):
+                for extra in (["--profile"], ["--profile-dump", dump]):
+                    sys.argv = ["_", "--generate", "postfix"] + extra
+                    with mock.patch("sys.stderr") as stderr:
+                        self.assertEqual(main.main(), 0)
+                    written = "".join(call[0][0] for call in stderr.write.call_args_list)
+                    self.assertTrue(written.startswith("Time per phase:"))
+            self.assertTrue(os.path.exists(dump))
+            self.assertTrue("cProfile data saved to " + dump in written)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_generate_metrics(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "policy.json"), "w") as f:
+                json.dump({"timestamp": "2018-06-18T09:41:50-07:00",
+                           "expires": "2038-01-16T09:41:50-07:00",
+                           "policies": {"a.com": {"mode": "enforce", "mxs": ["mx.a.com"]}}}, f)
+            filename = os.path.join(tmpdir, "metrics.json")
+            sys.argv = ["_", "--generate", "postfix", "--policy-dir", tmpdir,
+                        "--metrics", filename, "--metrics-format", "json"]
+            with mock.patch("starttls_policy_cli.main.print", create=True):
+                with mock.patch("sys.stdout"):
+                    self.assertEqual(main.main(), 0)
+            with open(filename) as f:
+                values = json.load(f)
+            self.assertEqual(values["domains"], {"enforce": 1, "testing": 0})
+            self.assertEqual(values["output_changed"],
+                             {os.path.join(tmpdir, "postfix_tls_policy"): 1})
+            self.assertTrue(values["run_duration_seconds"] > 0)
+            self.assertTrue("write" in values["phase_duration_seconds"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_validate_metrics(self):
+        sys.argv = ["_", "--validate", "--metrics", "metrics.prom"]
+        with mock.patch("argparse.ArgumentParser.error", side_effect=Exception) as error:
+            self.assertRaises(Exception, main.main)
+        error.assert_called_once_with("--metrics can only be used with --generate")
+
+    @mock.patch("starttls_policy_cli.main._ensure_directory")
+    def test_watch(self, ensure_directory):
+        generator = mock.MagicMock()
+        generator.return_value.default_filename = "postfix"
+        sys.argv = ["_", "-g", "postfix", "--policy-dir", "dir", "--watch",
+                    "--debounce", "1", "--overlay", "local.json"]
+        with mock.patch.dict(main.GENERATORS, {"postfix": generator}):
+            with mock.patch("starttls_policy_cli.watch.PolicyWatcher") as watcher:
+                watcher.return_value.run.side_effect = KeyboardInterrupt
+                self.assertEqual(main.main(), 0)
+                watcher.assert_called_once_with(
+                    [generator.return_value], [os.path.join("dir", "policy.json"), "local.json"],
+                    incremental=False, debounce=1.0, interval=30.0, profile=False)
+                on_generate = watcher.return_value.on_generate
+                watcher.return_value.regenerations = 2
+                with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+                    on_generate([configure.GenerateResult(False, None)])
+                mock_print.assert_called_once_with(
+                    "Configuration file " + os.path.join("dir", "postfix") + " is unchanged.")
+                generator.return_value.manual_instructions.assert_not_called()
+        ensure_directory.assert_called_once_with("dir")
+
+    @mock.patch("starttls_policy_cli.main._ensure_directory")
+    def test_watch_metrics(self, ensure_directory):
+        # pylint: disable=unused-argument
+        generator = mock.MagicMock()
+        sys.argv = ["_", "-g", "postfix", "--policy-dir", "dir", "--watch",
+                    "--metrics", "metrics.prom"]
+        with mock.patch.dict(main.GENERATORS, {"postfix": generator}), \
+                mock.patch("starttls_policy_cli.profiling.Profiler") as profiler, \
+                mock.patch("starttls_policy_cli.watch.PolicyWatcher") as watcher:
+            watcher.return_value.run.side_effect = KeyboardInterrupt
+            self.assertEqual(main.main(), 0)
+        # Each run is timed by the watcher rather than by one profiler for the process.
+        profiler.assert_not_called()
+        self.assertTrue(watcher.call_args[1]["profile"])
+
+    def test_validate_watch(self):
+        sys.argv = ["_", "--validate", "--watch"]
+        with mock.patch("argparse.ArgumentParser.error", side_effect=Exception) as error:
+            self.assertRaises(Exception, main.main)
+        error.assert_called_once_with("--watch can only be used with --generate")
+
+    def test_serve(self):
+        sys.argv = ["_", "--serve", "unix:/run/x.sock", "--policy-dir", "dir", "-e",
+                    "--interval", "5"]
+        with mock.patch("starttls_policy_cli.socketmap.SocketmapServer") as server, \
+                mock.patch("starttls_policy_cli.socketmap.TableWatcher") as watcher, \
+                mock.patch("starttls_policy_cli.socketmap.serve",
+                           side_effect=KeyboardInterrupt) as serve:
+            self.assertEqual(main.main(), 0)
+        address, generator = server.call_args[0]
+        self.assertEqual(address, "unix:/run/x.sock")
+        self.assertTrue(isinstance(generator, configure.PostfixGenerator))
+        # Early adopter mode: testing policies are served too.
+        testing = mock.Mock(mode="testing", mxs=["mx.a.com"])
+        self.assertEqual(list(generator.lookup_table(
+            mock.Mock(resolved_items=lambda: [("a.com", testing)]))),
+                         [("a.com", "secure match=mx.a.com")])
+        watcher.assert_called_once_with(server.return_value, [os.path.join("dir", "policy.json")],
+                                        debounce=2.0, interval=5.0)
+        serve.assert_called_once_with(server.return_value, watcher.return_value)
+        with mock.patch("starttls_policy_cli.main.print", create=True) as mock_print:
+            watcher.return_value.on_generate([3])
+        mock_print.assert_called_once_with("Serving policies for 3 domains on unix:/run/x.sock")
+
+    def test_serve_metrics(self):
+        sys.argv = ["_", "--serve", "unix:/run/x.sock", "--metrics", "metrics.prom"]
+        with mock.patch("argparse.ArgumentParser.error", side_effect=Exception) as error:
+            self.assertRaises(Exception, main.main)
+        error.assert_called_once_with("--metrics can only be used with --generate")
 
     @mock.patch("os.path.exists")
     @mock.patch("os.makedirs")
@@ -0,0 +1,128 @@
+""" Tests for metrics.py """
+import unittest
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+from starttls_policy_cli import configure
+from starttls_policy_cli import metrics
+from starttls_policy_cli import policy
+from starttls_policy_cli import profiling
+from starttls_policy_cli import util
+
+test_config = {
+    "author": "Electronic Frontier Foundation",
+    "timestamp": "2018-06-18T09:41:50-07:00",
+    "expires": "2038-01-16T09:41:50-07:00",
+    "policy-aliases": {
+        "provider": {"mode": "enforce", "mxs": [".provider.example"]},
+    },
+    "policies": {
+        "a.example": {"mode": "enforce", "mxs": ["mx.a.example"]},
+        "b.example": {"mode": "testing", "mxs": ["mx.b.example"]},
+        "c.example": {"policy-alias": "provider"},
+        "d.example": {"policy-alias": "provider"},
+    },
+}
+
+NOW = datetime.datetime(2038, 1, 16, 16, 41, 40, tzinfo=util.UTC)
+
+def _values(collected):
+    return dict((metric.name, metric.samples) for metric in collected)
+
+class TestCollect(unittest.TestCase):
+    """Tests for gathering metrics"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmpdir, "output")
+        with open(self.output, "w") as f:
+            f.write("x" * 42)
+        self.config = policy.Config()
+        self.config.load_from_dict(test_config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_collect(self):
+        result = configure.GenerateResult(True, None)
+        values = _values(metrics.collect(self.config, [(self.output, result)], now=NOW))
+        self.assertFalse("phase_duration_seconds" in values)
+        self.assertEqual(values["domains"], [({"mode": "testing"}, 1),
+                                             ({"mode": "enforce"}, 3)])
+        self.assertEqual(values["policy_aliases"], [({}, 1)])
+        self.assertEqual(values["aliased_domains"], [({}, 2)])
+        self.assertEqual(values["output_bytes"], [({"file": self.output}, 42)])
+        self.assertEqual(values["output_changed"], [({"file": self.output}, 1)])
+        self.assertEqual(values["expires_in_seconds"], [({}, 10)])
+        self.assertEqual(values["last_run_timestamp_seconds"], [({}, 2147272900)])
+
+    def test_unchanged_expired_missing_output(self):
+        unchanged = configure.GenerateResult(False, None)
+        changed = configure.GenerateResult(True, None)
+        missing = self.output + ".missing"
+        now = NOW + datetime.timedelta(seconds=70)
+        values = _values(metrics.collect(self.config, [(missing, unchanged),
+                                                       (self.output, changed)], now=now))
+        self.assertEqual(values["output_bytes"], [({"file": missing}, 0),
+                                                  ({"file": self.output}, 42)])
+        self.assertEqual(values["output_changed"], [({"file": missing}, 0),
+                                                    ({"file": self.output}, 1)])
+        self.assertEqual(values["expires_in_seconds"], [({}, -60)])
+
+    def test_phases(self):
+        clock = [0.0]
+        with mock.patch("starttls_policy_cli.profiling._timer", lambda: clock[0]):
+            with profiling.Profiler() as profiler:
+                with profiling.phase("load"):
+                    clock[0] += 2
+                clock[0] += 0.5
+                values = _values(metrics.collect(self.config, [], profiler))
+        self.assertEqual(values["phase_duration_seconds"],
+                         [({"phase": "other"}, 0.5), ({"phase": "load"}, 2)])
+        self.assertEqual(values["run_duration_seconds"], [({}, 2.5)])
+
+class TestFormats(unittest.TestCase):
+    """Tests for writing metrics files"""
+
+    collected = [
+        metrics.Metric("phase_duration_seconds", "Phases.",
+                       [({"phase": "load"}, 0.25), ({"phase": 'a"b'}, 1)]),
+        metrics.Metric("output_changed", "Changed.", [({}, 1)]),
+    ]
+
+    def test_prometheus(self):
+        self.assertEqual(metrics.format_prometheus(self.collected),
+                         "# HELP starttls_policy_phase_duration_seconds Phases.\n"
+                         "# TYPE starttls_policy_phase_duration_seconds gauge\n"
+                         "starttls_policy_phase_duration_seconds{phase=\"load\"} 0.25\n"
+                         "starttls_policy_phase_duration_seconds{phase=\"a\\\"b\"} 1\n"
+                         "# HELP starttls_policy_output_changed Changed.\n"
+                         "# TYPE starttls_policy_output_changed gauge\n"
+                         "starttls_policy_output_changed 1\n")
+
+    def test_json(self):
+        self.assertEqual(json.loads(metrics.format_json(self.collected)), {
+            "phase_duration_seconds": {"load": 0.25, 'a"b': 1},
+            "output_changed": 1,
+        })
+
+    def test_write(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "starttls_policy.prom")
+            for output_format, formatter in (("prometheus", metrics.format_prometheus),
+                                             ("json", metrics.format_json)):
+                metrics.write(self.collected, filename, output_format)
+                with open(filename) as f:
+                    self.assertEqual(f.read(), formatter(self.collected))
+            self.assertEqual(os.listdir(tmpdir), ["starttls_policy.prom"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
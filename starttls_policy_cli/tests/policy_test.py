@@ -2,7 +2,10 @@
 import unittest
 
 import datetime
+from functools import partial
 import json
+import os
+import tempfile
 import mock
 import dateutil.tz
 
@@ -22,6 +25,8 @@ test_json = '{\
         }\
     }'
 
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+
 class TestConfigEncoder(unittest.TestCase):
     """Tests extensions to JSON serializer for dumping configs"""
 
@@ -198,11 +203,294 @@ class TestConfig(unittest.TestCase):
             conf.policy_aliases = {'valid': {},
                                    'valid2': {'policy-alias': 'valid'}}
 
+    def test_lazy_defers_validation(self):
+        conf = policy.Config(lazy=True)
+        conf.policies = {'invalid': {'mode': 'none'}, 'valid': self.other_policy}
+        self.assertEqual(len(conf), 2)
+        self.assertTrue('invalid' in conf.policies)
+        self.assertEqual(conf.get_policy_for('valid').mode, 'enforce')
+        with self.assertRaises(util.ConfigError):
+            conf.get_policy_for('invalid')
+        with self.assertRaises(util.ConfigError):
+            conf.validate_all()
+
+    def test_lazy_builds_on_first_access(self):
+        conf = policy.Config(lazy=True)
+        conf.policy_aliases = {'alias': {'mode': 'enforce'}}
+        # pylint: disable=protected-access
+        with mock.patch.object(conf, '_new_policy', wraps=conf._new_policy) as new_policy:
+            conf.policies = {'a.com': self.sample_policy, 'b.com': {'policy-alias': 'alias'}}
+            self.assertEqual(sorted(conf), ['a.com', 'b.com'])
+            self.assertEqual(len(conf), 2)
+            self.assertEqual(new_policy.call_count, 0)
+            self.assertEqual(conf['b.com'].mode, 'enforce')
+            self.assertEqual(conf['b.com'].mode, 'enforce')
+            self.assertEqual(new_policy.call_count, 1)
+            conf.validate_all()
+            self.assertEqual(new_policy.call_count, 2)
+
+    def test_lazy_matches_eager(self):
+        conf = policy.Config(lazy=True)
+        conf.load_from_dict(json.loads(test_json))
+        self.conf.load_from_dict(json.loads(test_json))
+        self.assertEqual(json.loads(conf.dump()), json.loads(self.conf.dump()))
+
+    def test_lazy_merge(self):
+        conf = policy.Config(lazy=True)
+        conf.policies = {'eff.org': self.sample_policy}
+        conf2 = policy.Config(lazy=True)
+        conf2.policies = {'example.com': self.other_policy}
+        new_conf = conf.merge(conf2)
+        self.assertTrue(new_conf.lazy)
+        self.assertEqual(sorted(new_conf), ['eff.org', 'example.com'])
+        self.assertEqual(new_conf['example.com'].mode, 'enforce')
+
+    def test_validate_all_empty(self):
+        policy.Config(lazy=True).validate_all()
+
+    def test_policy_map_copy(self):
+        conf = policy.Config(lazy=True)
+        conf.policies = {'eff.org': self.sample_policy}
+        copied = policy.PolicyMap(conf._new_policy, conf.policies) # pylint: disable=protected-access
+        self.assertEqual(copied['eff.org'].mxs, ['eff.org', '.eff.org'])
+        del copied['eff.org']
+        self.assertEqual(len(copied), 0)
+        self.assertEqual(len(conf.policies), 1)
+
     def test_bad_schema(self):
         conf = policy.Config(schema={"author": "Author field here"})
         with self.assertRaises(util.ConfigError):
             conf.author = "Me"
 
+class TestConfigLoad(unittest.TestCase):
+    """Testing loading configuration from files
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, name))
+        os.rmdir(self.tmpdir)
+
+    def _write(self, obj):
+        filename = os.path.join(self.tmpdir, 'policy.json')
+        with open(filename, 'w') as f:
+            f.write(obj if isinstance(obj, str) else json.dumps(obj))
+        return filename
+
+    def stream_test(self, filename):
+        """Streaming load gives the same config as a regular load"""
+        conf = policy.Config(filename)
+        conf.load()
+        streamed = policy.Config(filename)
+        streamed.load(stream=True)
+        self.assertEqual(json.loads(streamed.dump()), json.loads(conf.dump()))
+        self.assertEqual(sorted(streamed), sorted(conf))
+        for domain in conf:
+            self.assertEqual(streamed[domain].get_dict(), conf[domain].get_dict())
+
+    def test_stream_aliases_after_policies(self):
+        filename = self._write('{"policies": {"a.com": {"policy-alias": "al"},'
+                               ' "b.com": {"mode": "enforce"}},'
+                               ' "policy-aliases": {"al": {"mode": "enforce", "mxs": ["mx"]}},'
+                               ' "timestamp": 0, "expires": 0}')
+        conf = policy.Config(filename)
+        conf.load(stream=True)
+        self.assertEqual(list(conf.policies), ["a.com", "b.com"])
+        self.assertEqual(conf.get_policy_for("a.com").mxs, ["mx"])
+
+    def test_stream_unknown_alias(self):
+        filename = self._write({'policies': {'a.com': {'policy-alias': 'nope'}},
+                                'timestamp': 0, 'expires': 0})
+        with self.assertRaises(util.ConfigError):
+            policy.Config(filename).load(stream=True)
+
+    def test_stream_required_fields(self):
+        filename = self._write({'policies': {}, 'timestamp': 0})
+        with self.assertRaises(util.ConfigError):
+            policy.Config(filename).load(stream=True)
+
+    def test_stream_invalid_policy(self):
+        filename = self._write({'policies': {'a.com': {'mode': 'none'}},
+                                'timestamp': 0, 'expires': 0})
+        with self.assertRaises(util.ConfigError):
+            policy.Config(filename).load(stream=True)
+
+    def test_stream_lazy(self):
+        filename = self._write({'policies': {'a.com': {'policy-alias': 'al'},
+                                             'b.com': {'mode': 'none'}},
+                                'policy-aliases': {'al': {'mode': 'enforce'}},
+                                'timestamp': 0, 'expires': 0})
+        conf = policy.Config(filename, lazy=True)
+        conf.load(stream=True)
+        self.assertEqual(conf['a.com'].mode, 'enforce')
+        with self.assertRaises(util.ConfigError):
+            conf.validate_all()
+
+    def test_stream_null_policies(self):
+        filename = self._write({'policies': None, 'timestamp': 0, 'expires': 0})
+        conf = policy.Config(filename)
+        conf.load(stream=True)
+        self.assertEqual(len(conf), 0)
+
+class TestConfigSnapshot(unittest.TestCase):
+    """Testing loading configuration through a snapshot
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'policy.json')
+        with open(os.path.join(TESTDATA_DIR, 'bigger_test_config.json')) as f:
+            self.source = f.read()
+        with open(self.filename, 'w') as f:
+            f.write(self.source)
+
+    def tearDown(self):
+        for name in os.listdir(self.tmpdir):
+            os.remove(os.path.join(self.tmpdir, name))
+        os.rmdir(self.tmpdir)
+
+    def _load(self, **kwargs):
+        conf = policy.Config(self.filename, **kwargs)
+        conf.load(snapshot=True)
+        return conf
+
+    def test_snapshot_matches_json(self):
+        first = self._load()
+        self.assertTrue(os.path.exists(self.filename + '.snapshot'))
+        with mock.patch('starttls_policy_cli.policy.json.loads') as loads:
+            second = self._load()
+        self.assertFalse(loads.called)
+        self.assertEqual(json.loads(second.dump()), json.loads(first.dump()))
+        self.assertEqual(second.expires, first.expires)
+        self.assertEqual(sorted(second), sorted(first))
+        for domain in first:
+            self.assertEqual(second.get_policy_for(domain).get_dict(),
+                             first.get_policy_for(domain).get_dict())
+        self.assertEqual(second.policy_aliases.keys(), first.policy_aliases.keys())
+
+    def test_snapshot_rebuilt_on_change(self):
+        self._load()
+        stat = os.stat(self.filename)
+        changed = json.loads(self.source)
+        changed['author'] = 'Somebody Else'
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps(changed))
+        # Restoring the mtime leaves the content hash to detect the change.
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(self._load().author, 'Somebody Else')
+        with mock.patch('starttls_policy_cli.policy.json.loads') as loads:
+            self.assertEqual(self._load().author, 'Somebody Else')
+        self.assertFalse(loads.called)
+
+    def test_corrupt_snapshot(self):
+        expected = json.loads(self._load().dump())
+        with open(self.filename + '.snapshot', 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(json.loads(self._load().dump()), expected)
+
+    def test_invalid_policy_lazy(self):
+        conf = json.loads(self.source)
+        conf['policies']['invalid.example'] = {'mode': 'none'}
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps(conf))
+        conf = self._load(lazy=True)
+        self.assertFalse(os.path.exists(self.filename + '.snapshot'))
+        with self.assertRaises(util.ConfigError):
+            conf.validate_all()
+
+class TestCollectErrors(unittest.TestCase):
+    """Testing bulk validation of configurations
+    """
+
+    def setUp(self):
+        self.config = {
+            'author': 0,
+            'timestamp': 'not a date',
+            'policy-aliases': {
+                'good': {'mode': 'enforce'},
+                'bad': {'mode': 'none'},
+                'aliased': {'policy-alias': 'good'},
+            },
+            'policies': {
+                'a.com': {'mode': 'enforce', 'mxs': ['mx.a.com']},
+                'b.com': {'mode': 'none'},
+                'c.com': {'mxs': [0]},
+                'd.com': {'policy-alias': 'good'},
+                'e.com': {'policy-alias': 'missing'},
+                'f.com': 'not an object',
+                'g.com': {'policy-alias': []},
+            },
+        }
+        self.expected = [
+            ('author',), ('timestamp',), ('expires',),
+            ('policy-aliases', 'aliased'), ('policy-aliases', 'bad'),
+            ('policies', 'b.com'), ('policies', 'c.com'), ('policies', 'e.com'),
+            ('policies', 'f.com'), ('policies', 'g.com'),
+        ]
+
+    def test_collects_all_errors(self):
+        errors = policy.Config().collect_errors(self.config)
+        self.assertEqual(sorted(location for location, _ in errors), sorted(self.expected))
+        messages = dict(errors)
+        self.assertTrue('mode' in messages[('policies', 'b.com')])
+        self.assertEqual(messages[('expires',)], 'Attribute expires is required.')
+
+    def test_process_pool(self):
+        errors = policy.Config().collect_errors(self.config)
+        self.assertEqual(policy.Config().collect_errors(self.config, processes=2), errors)
+
+    def test_valid(self):
+        self.assertEqual(policy.Config().collect_errors(json.loads(test_json)), [])
+
+    def test_does_not_modify_config(self):
+        conf = policy.Config()
+        conf.collect_errors(json.loads(test_json))
+        self.assertIsNone(conf.author)
+        self.assertIsNone(conf.policies)
+
+    def test_bad_sections(self):
+        errors = policy.Config().collect_errors({'timestamp': 0, 'expires': 0,
+                                                 'policies': [], 'policy-aliases': 1})
+        self.assertEqual(sorted(location for location, _ in errors),
+                         [('policies',), ('policy-aliases',)])
+
+    def test_date_offset_out_of_range(self):
+        config = json.loads(test_json)
+        config['expires'] = '2019-01-01T00:00:00+99:00'
+        errors = policy.Config().collect_errors(config)
+        self.assertEqual([location for location, _ in errors], [('expires',)])
+
+    def test_timestamp_out_of_range(self):
+        config = json.loads(test_json)
+        config['timestamp'] = 10 ** 20
+        errors = policy.Config().collect_errors(config)
+        self.assertEqual([location for location, _ in errors], [('timestamp',)])
+
+    def test_not_an_object(self):
+        self.assertEqual([location for location, _ in policy.Config().collect_errors([])], [()])
+
+    def test_from_file(self):
+        conf = policy.Config(os.path.join(TESTDATA_DIR, 'config.json'))
+        self.assertEqual(conf.collect_errors(), [])
+
+    def test_invalid_file(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json') as f:
+            f.write('{"policies": ')
+            f.flush()
+            errors = policy.Config(f.name).collect_errors()
+        self.assertEqual([location for location, _ in errors], [()])
+
+    def test_missing_file(self):
+        errors = policy.Config('/nonexistent/policy.json').collect_errors()
+        self.assertEqual([location for location, _ in errors], [()])
+
+parametrize_over(TestConfigLoad, TestConfigLoad.stream_test,
+                 [param("stream_" + os.path.splitext(name)[0], os.path.join(TESTDATA_DIR, name))
+                  for name in ('config.json', 'bigger_test_config.json', 'utf8.json')])
+
 class TestPolicy(unittest.TestCase):
     """Testing policy configuration
     """
@@ -219,6 +507,13 @@ class TestPolicy(unittest.TestCase):
         self.assertTrue('eff.org' in new_conf.mxs)
         self.assertTrue('example.com' in new_conf.mxs)
 
+    def test_merge_keeps_inputs(self):
+        p = policy.Policy({'mxs': ['eff.org']})
+        newer = policy.Policy({'mxs': ['example.com']})
+        p.merge(newer)
+        self.assertEqual(p.mxs, ['eff.org'])
+        self.assertEqual(newer.mxs, ['example.com'])
+
     def test_update_drops_old_mxs(self):
         p = policy.Policy({'mxs': ['eff.org']})
         new_conf = p.update(policy.Policy({'mxs': ['example.com']}))
@@ -257,6 +552,40 @@ class TestPolicy(unittest.TestCase):
         p.mxs = ['eff.org', '.eff.org']
         self.assertEqual(p.mxs, ['eff.org', '.eff.org'])
 
+    def test_compact_storage(self):
+        p = policy.Policy(self.sample_policy)
+        self.assertFalse(hasattr(p, '__dict__'))
+        self.assertEqual(p.mode, 'testing')
+        self.assertEqual(p.mxs, ['eff.org', '.eff.org'])
+        self.assertEqual(p.get_dict(), self.sample_policy)
+        with self.assertRaises(AttributeError):
+            p.unknown = True
+
+    def test_unknown_fields_ignored(self):
+        p = policy.Policy({'mode': 'enforce', 'unknown-field': 1, '_mode': 0})
+        self.assertEqual(p.get_dict(), {'mode': 'enforce'})
+
+    def test_mxs_returns_copy(self):
+        p = policy.Policy(self.sample_policy)
+        p.mxs.append('example.com')
+        self.assertEqual(p.mxs, ['eff.org', '.eff.org'])
+
+    def test_custom_mode(self):
+        schema = dict(util.POLICY_SCHEMA)
+        schema['mode'] = partial(util.enforce_in, ('custom',))
+        p = policy.Policy({'mode': 'custom'}, schema=schema)
+        self.assertEqual(p.mode, 'custom')
+
+    def test_interned_mxs(self):
+        conf = policy.Config()
+        conf.policies = {'a.com': self.sample_policy,
+                         'b.com': {'mxs': ['eff.org', '.eff.org'], 'mode': 'enforce'},
+                         'c.com': {'mxs': ['.eff.org']}}
+        # pylint: disable=protected-access
+        self.assertTrue(conf['a.com']._mxs is conf['b.com']._mxs)
+        self.assertTrue(conf['a.com']._mxs[1] is conf['c.com']._mxs[0])
+        self.assertEqual(conf['b.com'].mxs, ['eff.org', '.eff.org'])
+
     def test_no_alias_policy_setter(self):
         p = policy.PolicyNoAlias({}, aliases={'valid': self.sample_policy})
         with self.assertRaises(util.ConfigError):
@@ -266,5 +595,308 @@ class TestPolicy(unittest.TestCase):
         p = policy.PolicyNoAlias({}, aliases={'valid': self.sample_policy})
         self.assertIsNone(p.policy_alias)
 
+    def test_matches_mx(self):
+        p = policy.Policy(self.sample_policy)
+        self.assertTrue(p.matches_mx('eff.org'))
+        self.assertTrue(p.matches_mx('mail.eff.org'))
+        self.assertFalse(p.matches_mx('example.com'))
+        p.mxs = ['example.com']
+        self.assertTrue(p.matches_mx('example.com'))
+        self.assertFalse(p.matches_mx('mail.eff.org'))
+
+    def test_matches_mx_empty(self):
+        self.assertFalse(policy.Policy({}).matches_mx('eff.org'))
+
+class TestBulkLookup(unittest.TestCase):
+    """Testing policy lookups for many domains at once
+    """
+
+    def setUp(self):
+        self.conf = policy.Config(os.path.join(TESTDATA_DIR, 'config.json'))
+        self.conf.load()
+
+    def test_get_policies_for(self):
+        domains = ['eff.org', 'unknown.com', 'gmail.com', 'eff.org', 'unknown.com']
+        results = self.conf.get_policies_for(iter(domains))
+        self.assertEqual(len(results), 5)
+        self.assertTrue(results[0] is self.conf.get_policy_for('eff.org'))
+        self.assertTrue(results[1] is policy.NO_POLICY)
+        self.assertTrue(results[2] is self.conf.policy_aliases['gmail'])
+        self.assertTrue(results[3] is results[0])
+        self.assertTrue(results[4] is policy.NO_POLICY)
+
+    def test_get_policies_for_lazy(self):
+        conf = policy.Config(os.path.join(TESTDATA_DIR, 'config.json'), lazy=True)
+        conf.load()
+        self.assertEqual([p.mxs for p in conf.get_policies_for(['gmail.com', 'yahoo.com'])],
+                         [['.mail.google.com'], ['.yahoodns.net']])
+
+    def test_get_policies_for_no_policies(self):
+        self.assertEqual(policy.Config().get_policies_for(['eff.org', 'a.com']),
+                         [policy.NO_POLICY, policy.NO_POLICY])
+
+    def test_get_policies_for_empty(self):
+        self.assertEqual(self.conf.get_policies_for([]), [])
+
+    def test_no_policy_sentinel(self):
+        self.assertFalse(policy.NO_POLICY)
+        self.assertEqual(repr(policy.NO_POLICY), 'NO_POLICY')
+
+    def test_unknown_domain(self):
+        self.assertIsNone(self.conf.get_policy_for('unknown.com'))
+        self.assertIsNone(policy.Config().get_policy_for('unknown.com'))
+        self.assertIsNone(self.conf.get('unknown.com'))
+        self.assertFalse('unknown.com' in self.conf)
+        with self.assertRaises(KeyError):
+            self.conf['unknown.com'] # pylint: disable=pointless-statement
+
+class TestResolvedView(unittest.TestCase):
+    """Testing the alias-resolved view of a configuration's policies
+    """
+
+    def _config(self, lazy=False):
+        conf = policy.Config(os.path.join(TESTDATA_DIR, 'config.json'), lazy=lazy)
+        conf.load()
+        return conf
+
+    def test_resolved_items(self):
+        conf = self._config()
+        items = dict(conf.resolved_items())
+        self.assertEqual(sorted(items), sorted(conf))
+        self.assertTrue(items['gmail.com'] is conf.policy_aliases['gmail'])
+        self.assertTrue(items['eff.org'] is conf.policies['eff.org'])
+
+    def test_policy_changes(self):
+        conf = self._config()
+        conf.policies['new.com'] = {'mode': 'enforce', 'mxs': ['mx.new.com']}
+        self.assertEqual(conf['new.com'].mxs, ['mx.new.com'])
+        conf.policies['eff.org'] = {'policy-alias': 'gmail'}
+        self.assertTrue(conf['eff.org'] is conf.policy_aliases['gmail'])
+        del conf.policies['yahoo.com']
+        self.assertFalse('yahoo.com' in conf)
+        self.assertEqual(sorted(dict(conf.resolved_items())), sorted(conf))
+
+    def test_alias_changes(self):
+        conf = self._config()
+        conf.policy_aliases = {'gmail': {'mode': 'enforce', 'mxs': ['.google.com']}}
+        self.assertEqual(conf['gmail.com'].mxs, ['.google.com'])
+        self.assertEqual(conf.get_policies_for(['gmail.com'])[0].mode, 'enforce')
+
+    def test_policies_replaced(self):
+        conf = self._config()
+        conf.policies = {'other.com': {'mode': 'enforce'}}
+        self.assertFalse('eff.org' in conf)
+        self.assertEqual(list(dict(conf.resolved_items())), ['other.com'])
+
+    def test_lazy(self):
+        conf = self._config(lazy=True)
+        conf.policies['invalid.com'] = {'mode': 'none'}
+        self.assertEqual(conf['gmail.com'].mxs, ['.mail.google.com'])
+        with self.assertRaises(util.ConfigError):
+            dict(conf.resolved_items())
+        del conf.policies['invalid.com']
+        self.assertEqual(len(dict(conf.resolved_items())), 4)
+
+    def test_merge_updates_view(self):
+        conf = policy.Config()
+        conf.policies = {'eff.org': {'mode': 'enforce', 'mxs': ['.eff.org']},
+                         'example.com': {'mode': 'enforce'}}
+        newer = policy.Config()
+        newer.policies = {'eff.org': {'mode': 'testing', 'mxs': ['mx.eff.org']}}
+        merged = conf.merge(newer)
+        self.assertEqual(merged['eff.org'].mxs, ['mx.eff.org'])
+        self.assertEqual(merged['example.com'].mode, 'enforce')
+
+    def test_merge_shares_policies(self):
+        conf = self._config()
+        newer = policy.Config()
+        newer.policies = {'eff.org': {'mode': 'testing', 'mxs': ['mx.eff.org']},
+                          'new.com': {'mode': 'enforce', 'mxs': ['mx.new.com']}}
+        before = (conf.dump(), newer.dump())
+        with mock.patch.object(policy.Policy, 'load_from_dict') as load_from_dict:
+            merged = conf.merge(newer)
+        load_from_dict.assert_not_called()
+        self.assertEqual((conf.dump(), newer.dump()), before)
+        self.assertTrue(merged.policies['yahoo.com'] is conf.policies['yahoo.com'])
+        self.assertTrue(merged.policies['eff.org'] is newer.policies['eff.org'])
+        self.assertTrue(merged['gmail.com'] is conf.policy_aliases['gmail'])
+        self.assertEqual(sorted(dict(merged.resolved_items())), sorted(list(conf) + ['new.com']))
+
+    def test_merged_configs_are_independent(self):
+        conf = self._config()
+        merged = conf.merge(policy.Config())
+        merged.policies['new.com'] = {'mode': 'enforce', 'mxs': ['mx.new.com']}
+        del merged.policies['eff.org']
+        self.assertFalse('new.com' in conf)
+        self.assertTrue('eff.org' in conf)
+        conf.policies['eff.org'] = {'policy-alias': 'gmail'}
+        self.assertFalse('eff.org' in merged)
+        self.assertFalse('eff.org' in merged.policies)
+
+    def test_merge_replaces_alias(self):
+        conf = self._config()
+        newer = policy.Config()
+        newer.policy_aliases = {'gmail': {'mode': 'enforce', 'mxs': ['.google.com']}}
+        merged = conf.merge(newer)
+        self.assertEqual(merged['gmail.com'].mxs, ['.google.com'])
+        self.assertEqual(conf['gmail.com'].mxs, ['.mail.google.com'])
+        self.assertTrue(merged['eff.org'] is conf['eff.org'])
+
+    def test_merge_lazy_into_eager(self):
+        conf = self._config()
+        newer = policy.Config(lazy=True)
+        newer.policy_aliases = {'other': {'mode': 'enforce', 'mxs': ['.other.com']}}
+        newer.policies = {'new.com': {'policy-alias': 'other'}}
+        merged = conf.merge(newer)
+        self.assertFalse(merged.lazy)
+        self.assertTrue(isinstance(merged.policies._entries['new.com'], # pylint: disable=protected-access
+                                   policy.Policy))
+        self.assertEqual(merged['new.com'].mxs, ['.other.com'])
+        self.assertEqual(len(dict(merged.resolved_items())), 5)
+
+    def test_update_shares_policies(self):
+        conf = self._config()
+        newer = self._config()
+        updated = conf.update(newer)
+        self.assertTrue(updated.policies['eff.org'] is newer.policies['eff.org'])
+        self.assertTrue(updated['gmail.com'] is newer.policy_aliases['gmail'])
+
+class TestMergeAll(unittest.TestCase):
+    """Testing merging many layers of configs at once
+    """
+
+    org = {
+        'author': 'Example Org',
+        'policy-aliases': {'gmail': {'mode': 'enforce', 'mxs': ['.mail.google.com']}},
+        'policies': {'eff.org': {'mode': 'testing', 'mxs': ['mx.eff.org']},
+                     'org.example': {'mode': 'enforce', 'mxs': ['mx.org.example']}},
+    }
+    host = {
+        'expires': '2038-01-16T09:41:50-07:00',
+        'policies': {'eff.org': {'policy-alias': 'gmail'},
+                     'host.example': {'mode': 'testing', 'mxs': ['mx.host.example']}},
+    }
+
+    def _layers(self):
+        base = policy.Config(os.path.join(TESTDATA_DIR, 'config.json'))
+        base.load()
+        layers = [base]
+        for overlay in (self.org, self.host):
+            conf = policy.Config(schema=util.OVERLAY_SCHEMA, lazy=True)
+            conf.load_from_dict(overlay)
+            layers.append(conf)
+        return layers
+
+    def test_merge_all(self):
+        layers = self._layers()
+        # pylint: disable=protected-access
+        before = [dict(conf.policies._entries) for conf in layers]
+        merged = policy.merge_all(layers)
+        self.assertEqual([dict(conf.policies._entries) for conf in layers], before)
+        self.assertFalse(merged.lazy)
+        self.assertEqual(merged.author, 'Example Org')
+        self.assertEqual(merged.expires.year, 2038)
+        self.assertEqual(merged.timestamp, layers[0].timestamp)
+        self.assertEqual(sorted(merged), ['eff.org', 'example.com', 'gmail.com',
+                                          'host.example', 'org.example', 'yahoo.com'])
+        self.assertTrue(merged['eff.org'] is merged.policy_aliases['gmail'])
+        self.assertEqual(merged['gmail.com'].mode, 'enforce')
+        self.assertTrue(merged.policies['yahoo.com'] is layers[0].policies['yahoo.com'])
+        self.assertEqual(merged.sources['author'], 1)
+        self.assertEqual(merged.sources['expires'], 2)
+        self.assertEqual(merged.sources['timestamp'], 0)
+        self.assertEqual(merged.sources['policy-aliases'], {'gmail': 1})
+        self.assertEqual(merged.sources['policies'], {
+            'yahoo.com': 0, 'example.com': 0, 'gmail.com': 0,
+            'org.example': 1, 'eff.org': 2, 'host.example': 2})
+
+    def test_same_as_chained_merge(self):
+        # `host` refers to an alias of `org`, so it's only valid once merged.
+        chained = self._layers()
+        chained = chained[0].merge(chained[1]).merge(chained[2])
+        self.assertEqual(json.loads(policy.merge_all(self._layers()).dump()),
+                         json.loads(chained.dump()))
+
+    def test_validates_winners_once(self):
+        layers = self._layers()
+        with mock.patch.object(policy.Policy, 'load_from_dict',
+                               autospec=True,
+                               side_effect=policy.Policy.load_from_dict) as load_from_dict:
+            merged = policy.merge_all(layers)
+        # org.example and the two policies of `host`. The policy of
+        # eff.org in `org` is overridden, so it's never validated.
+        validated = [call[0][1] for call in load_from_dict.call_args_list]
+        self.assertEqual(sorted(validated, key=json.dumps),
+                         sorted([self.org['policies']['org.example'],
+                                 self.host['policies']['eff.org'],
+                                 self.host['policies']['host.example']], key=json.dumps))
+        self.assertEqual(merged['org.example'].mxs, ['mx.org.example'])
+
+    def test_invalid_winner(self):
+        layers = self._layers()
+        invalid = policy.Config(schema=util.OVERLAY_SCHEMA, lazy=True)
+        invalid.policies = {'eff.org': {'mode': 'none'}}
+        # Overridden by a later layer, so it isn't validated.
+        policy.merge_all(layers[:1] + [invalid] + layers[1:])
+        layers.append(invalid)
+        self.assertRaises(util.ConfigError, policy.merge_all, layers)
+        merged = policy.merge_all(layers, lazy=True)
+        self.assertTrue(merged.lazy)
+        self.assertRaises(util.ConfigError, merged.__getitem__, 'eff.org')
+
+    def test_single_and_empty(self):
+        base = self._layers()[0]
+        merged = policy.merge_all([base])
+        self.assertEqual(json.loads(merged.dump()), json.loads(base.dump()))
+        self.assertRaises(ValueError, policy.merge_all, [])
+
+class TestMXMatcher(unittest.TestCase):
+    """Testing MX hostname matching
+    """
+
+    def match_test(self, patterns, hostname, expected):
+        """Parametrized test over MX patterns and hostnames"""
+        self.assertEqual(policy.MXMatcher(patterns).matches(hostname), expected)
+        # The linear scan every consumer used to write.
+        hostname = hostname.lower().rstrip('.')
+        linear = any(hostname.endswith(pattern.lower()) and len(hostname) > len(pattern)
+                     if pattern.startswith('.') else hostname == pattern.lower()
+                     for pattern in patterns)
+        self.assertEqual(linear, expected)
+
+parametrize_over(TestMXMatcher, TestMXMatcher.match_test, [
+    param('exact', ['mx.eff.org'], 'mx.eff.org', True),
+    param('exact_other', ['mx.eff.org'], 'mx2.eff.org', False),
+    param('exact_not_subdomain', ['eff.org'], 'mx.eff.org', False),
+    param('wildcard', ['.eff.org'], 'mx.eff.org', True),
+    param('wildcard_deep', ['.eff.org'], 'a.b.mx.eff.org', True),
+    param('wildcard_not_apex', ['.eff.org'], 'eff.org', False),
+    param('wildcard_label_boundary', ['.eff.org'], 'mxeff.org', False),
+    param('wildcard_other_tld', ['.eff.org'], 'mx.eff.org.uk', False),
+    param('wildcard_nested', ['.mail.eff.org'], 'mx.eff.org', False),
+    param('wildcard_shorter', ['.mail.eff.org', '.org'], 'mx.eff.org', True),
+    param('case_insensitive', ['.EFF.org', 'MX.example.COM'], 'Mx.Example.com', True),
+    param('trailing_dot', ['.eff.org'], 'mx.eff.org.', True),
+    param('mixed', ['mx.example.com', '.eff.org', '.google.com'], 'alt1.google.com', True),
+    param('none', [], 'mx.eff.org', False),
+])
+
+class TestMatchMXs(unittest.TestCase):
+    """Testing matching many deliveries against a configuration
+    """
+
+    def test_match_mxs(self):
+        conf = policy.Config(os.path.join(TESTDATA_DIR, 'config.json'))
+        conf.load()
+        pairs = [('eff.org', 'mail.eff.org'),
+                 ('eff.org', 'mail.example.com'),
+                 ('gmail.com', 'alt1.gmail-smtp-in.l.mail.google.com'),
+                 ('gmail.com', 'gmail.com'),
+                 ('unknown.com', 'mail.unknown.com')]
+        self.assertEqual(list(conf.match_mxs(pairs)), [True, False, True, False, None])
+
+    def test_match_mxs_no_policies(self):
+        self.assertEqual(list(policy.Config().match_mxs([('eff.org', 'mx.eff.org')])), [None])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,119 @@
+""" Tests for profiling.py """
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+import six
+
+from starttls_policy_cli import profiling
+
+class TestProfiler(unittest.TestCase):
+    """Tests for timing phases"""
+
+    def setUp(self):
+        self.clock = [0.0]
+        patcher = mock.patch("starttls_policy_cli.profiling._timer", lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _tick(self, seconds):
+        self.clock[0] += seconds
+
+    def test_inactive(self):
+        with profiling.phase("load") as phase:
+            self.assertIs(phase, profiling._NULL_PHASE) # pylint: disable=protected-access
+        items = [1, 2]
+        self.assertIs(profiling.iterate("generate", items), items)
+
+    def test_nested_phases(self):
+        with profiling.Profiler() as profiler:
+            self._tick(1)
+            with profiling.phase("load"):
+                self._tick(2)
+                with profiling.phase("dates"):
+                    self._tick(3)
+                self._tick(4)
+            with profiling.phase("dates"):
+                self._tick(5)
+        self.assertEqual(dict(profiler.times), {"other": 1, "load": 6, "dates": 8})
+        self.assertEqual(profiler.total, 15)
+        self.assertEqual(sum(profiler.times.values()), profiler.total)
+
+    def test_iterate(self):
+        def lines():
+            for line in ("a", "b"):
+                self._tick(1)
+                yield line
+        with profiling.Profiler() as profiler:
+            for _ in profiling.iterate("generate", lines()):
+                with profiling.phase("write"):
+                    self._tick(10)
+            self.assertEqual(profiling.iterate("generate", "text"), "text")
+        self.assertEqual(dict(profiler.times), {"other": 0, "generate": 2, "write": 20})
+
+    def test_error_in_phase(self):
+        with profiling.Profiler() as profiler:
+            try:
+                with profiling.phase("load"):
+                    self._tick(1)
+                    raise ValueError
+            except ValueError:
+                pass
+            self._tick(2)
+        self.assertEqual(dict(profiler.times), {"other": 2, "load": 1})
+
+    def test_one_at_a_time(self):
+        with profiling.Profiler():
+            self.assertRaises(RuntimeError, profiling.Profiler().__enter__)
+        self.assertIs(profiling._active, None) # pylint: disable=protected-access
+
+    def test_other_threads(self):
+        def worker():
+            with profiling.phase("write"):
+                self._tick(1)
+            self.assertEqual(profiling.iterate("generate", items), items)
+        items = [1]
+        with profiling.Profiler() as profiler:
+            with profiling.phase("generate"):
+                thread = threading.Thread(target=worker)
+                thread.start()
+                thread.join()
+        self.assertEqual(dict(profiler.times), {"other": 0, "generate": 1})
+
+    def test_report(self):
+        with profiling.Profiler() as profiler:
+            with profiling.phase("decode"):
+                self._tick(3)
+            self._tick(1)
+        output = six.StringIO()
+        profiler.report(output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "Time per phase:")
+        self.assertEqual([line.split() for line in lines[1:3]],
+                         [["other", "1.0000s", "25.0%"], ["decode", "3.0000s", "75.0%"]])
+        self.assertEqual(lines[-1].split(), ["total", "4.0000s"])
+
+class TestCProfile(unittest.TestCase):
+    """Tests for recording a run with cProfile"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_dump(self):
+        filename = os.path.join(self.tmpdir, "profile.out")
+        with profiling.Profiler(filename) as profiler:
+            sorted(range(1000), key=str)
+        self.assertTrue(os.path.exists(filename))
+        output = six.StringIO()
+        profiler.report(output)
+        self.assertTrue("cProfile data saved to " + filename in output.getvalue())
+        self.assertTrue("Ordered by: cumulative time" in output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
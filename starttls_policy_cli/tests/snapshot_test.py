@@ -0,0 +1,65 @@
+""" Tests for snapshot.py """
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from dateutil import tz
+
+from starttls_policy_cli import snapshot
+from starttls_policy_cli.tests.util import param, parametrize_over
+
+class TestSnapshot(unittest.TestCase):
+    """Tests for storing and validating snapshots"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'policy.json')
+        with open(self.filename, 'w') as f:
+            f.write('{}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        key = snapshot.source_key(self.filename)
+        payload = {'policies': {'a.com': (0, ('mx',), None, None)}}
+        self.assertTrue(snapshot.save(self.filename, key, payload))
+        self.assertEqual(snapshot.load(self.filename, key), payload)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['policy.json', 'policy.json.snapshot'])
+
+    def test_missing(self):
+        self.assertEqual(snapshot.load(self.filename, snapshot.source_key(self.filename)), None)
+
+    def test_stale(self):
+        key = snapshot.source_key(self.filename)
+        snapshot.save(self.filename, key, {})
+        with open(self.filename, 'w') as f:
+            f.write('{ }')
+        self.assertNotEqual(snapshot.source_key(self.filename), key)
+        self.assertEqual(snapshot.load(self.filename, snapshot.source_key(self.filename)), None)
+
+    def test_save_failure(self):
+        with mock.patch('starttls_policy_cli.util.AtomicFile', side_effect=OSError):
+            self.assertFalse(snapshot.save(self.filename, (), {}))
+        self.assertFalse(snapshot.save(self.filename, (), {'unsupported': object()}))
+        self.assertEqual(os.listdir(self.tmpdir), ['policy.json'])
+
+    def datetime_test(self, value):
+        """Parametrized test for datetime packing"""
+        unpacked = snapshot.unpack_datetime(snapshot.pack_datetime(value))
+        self.assertEqual(unpacked, value)
+        self.assertEqual(unpacked.utcoffset(), value.utcoffset())
+
+parametrize_over(TestSnapshot, TestSnapshot.datetime_test, [
+    param('datetime_utc', datetime.datetime(2038, 1, 16, 9, 41, 50, 264201, tz.tzutc())),
+    param('datetime_negative_offset',
+          datetime.datetime(2018, 6, 18, 9, 41, 50, 0, tz.tzoffset(None, -7 * 3600))),
+    param('datetime_positive_offset',
+          datetime.datetime(1969, 12, 31, 23, 59, 59, 1, tz.tzoffset(None, 5 * 3600 + 1800))),
+])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+""" Tests for socketmap.py """
+import unittest
+import errno
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import mock
+
+from starttls_policy_cli import configure
+from starttls_policy_cli import socketmap
+from starttls_policy_cli.tests.util import param, parametrize_over
+
+test_json = """{
+    "timestamp": "2018-06-18T09:41:50-07:00",
+    "expires": "2038-01-16T09:41:50-07:00",
+    "policy-aliases": {"provider": {"mode": "enforce", "mxs": [".provider.example"]}},
+    "policies": {
+        "A.com": {"mode": "enforce", "mxs": ["mx.a.com", ".a.net"]},
+        "b.com": {"mode": "testing", "mxs": ["mx.b.com"]},
+        "c.com": {"policy-alias": "provider"}
+    }
+}"""
+
+class TestNetstring(unittest.TestCase):
+    """Tests for netstring encoding"""
+
+    def test_roundtrip(self):
+        stream = io.BytesIO(socketmap.netstring(b"tls_policy a.com") + socketmap.netstring(b""))
+        self.assertEqual(socketmap.netstring(b"abc"), b"3:abc,")
+        self.assertEqual(socketmap.read_netstring(stream), b"tls_policy a.com")
+        self.assertEqual(socketmap.read_netstring(stream), b"")
+        self.assertEqual(socketmap.read_netstring(stream), None)
+
+    def invalid(self, data):
+        """Malformed netstrings are rejected"""
+        self.assertRaises(ValueError, socketmap.read_netstring, io.BytesIO(data), 100)
+
+parametrize_over(TestNetstring, TestNetstring.invalid, [
+    param("no_length", b":abc,"),
+    param("not_a_number", b"x:abc,"),
+    param("too_long", b"101:" + b"x" * 101 + b","),
+    param("endless_length", b"0" * 10),
+    param("truncated_length", b"3"),
+    param("truncated_data", b"3:ab"),
+    param("missing_comma", b"3:abc;"),
+])
+
+class TestParseAddress(unittest.TestCase):
+    """Tests for parsing Postfix socket addresses"""
+
+    def test_addresses(self):
+        self.assertEqual(socketmap.parse_address("unix:/run/x.sock"),
+                         (socket.AF_UNIX, "/run/x.sock"))
+        self.assertEqual(socketmap.parse_address("/run/x.sock"), (socket.AF_UNIX, "/run/x.sock"))
+        self.assertEqual(socketmap.parse_address("inet:127.0.0.1:10027"),
+                         (socket.AF_INET, ("127.0.0.1", 10027)))
+        self.assertEqual(socketmap.parse_address("inet:[::1]:10027"),
+                         (socket.AF_INET6, ("::1", 10027)))
+        for address in ("inet:localhost", "inet::25", "tcp:localhost:25"):
+            self.assertRaises(ValueError, socketmap.parse_address, address)
+
+class TestServer(unittest.TestCase):
+    """Tests for serving lookups"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "policy.json")
+        self._write(test_json)
+        self.address = "unix:" + os.path.join(self.tmpdir, "socketmap.sock")
+        self.server = socketmap.SocketmapServer(self.address,
+                                                configure.PostfixGenerator(self.tmpdir))
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.start()
+        self.client = socketmap.Client(self.address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, contents):
+        with open(self.filename, "w") as f:
+            f.write(contents)
+
+    def test_lookup(self):
+        self.assertEqual(self.client.lookup("a.com"), ("TEMP", "policy list not loaded yet"))
+        self.assertEqual(self.server.update(), 2)
+        self.assertEqual(self.client.lookup("a.com"), ("OK", "secure match=mx.a.com:.a.net"))
+        self.assertEqual(self.client.lookup("A.COM"), ("OK", "secure match=mx.a.com:.a.net"))
+        self.assertEqual(self.client.lookup("c.com"), ("OK", "secure match=.provider.example"))
+        self.assertEqual(self.client.lookup("b.com"), ("NOTFOUND", ""))
+        self.assertEqual(self.client.lookup("d.com"), ("NOTFOUND", ""))
+        self.assertEqual(self.client.lookup("a.com", name="other"), ("PERM", "unknown map"))
+
+    def test_same_as_generated(self):
+        generator = self.server.generator
+        self.server.update()
+        generator.generate()
+        with open(os.path.join(self.tmpdir, generator.default_filename)) as f:
+            for line in f:
+                if not line.startswith("#"):
+                    domain, value = line.split(None, 1)
+                    self.assertEqual(self.client.lookup(domain), ("OK", value.strip()))
+
+    def test_expired(self):
+        self.server.update()
+        with mock.patch("starttls_policy_cli.util.is_expired", return_value=True):
+            self.assertEqual(self.client.lookup("a.com"), ("NOTFOUND", ""))
+
+    def test_reload_keeps_connections(self):
+        watcher = socketmap.TableWatcher(self.server, [self.filename], backend=mock.Mock())
+        watcher.generate()
+        self.assertEqual(self.client.lookup("d.com"), ("NOTFOUND", ""))
+        self._write(test_json.replace('"b.com": {"mode": "testing"',
+                                      '"d.com": {"mode": "enforce"'))
+        self.assertEqual(watcher.generate(), [3])
+        self.assertEqual(self.client.lookup("d.com"), ("OK", "secure match=mx.b.com"))
+        self.assertEqual(watcher.regenerations, 2)
+
+    def test_malformed_request(self):
+        # pylint: disable=protected-access
+        self.client._socket.sendall(b"x:")
+        # The server drops the connection, which may reach the client as a reset.
+        try:
+            self.assertEqual(self.client._reader.read(), b"")
+        except socket.error as e:
+            self.assertEqual(e.errno, errno.ECONNRESET)
+
+    def test_load_test(self):
+        self.server.update()
+        counts, seconds = socketmap.load_test(self.address, ["a.com", "b.com"], requests=100,
+                                              connections=3)
+        self.assertEqual(counts, {"OK": 50, "NOTFOUND": 50})
+        self.assertTrue(seconds > 0)
+
+class TestServe(unittest.TestCase):
+    """Tests for serving until stopped, on TCP, and for the load-test client"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, "policy.json"), "w") as f:
+            f.write(test_json)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_serve(self):
+        server = socketmap.SocketmapServer("inet:127.0.0.1:0",
+                                           configure.PostfixGenerator(self.tmpdir))
+        address = "inet:127.0.0.1:{}".format(server.server_address[1])
+        stop = threading.Event()
+        replies = []
+        def lookup(results):
+            client = socketmap.Client(address)
+            replies.append((results, client.lookup("c.com")))
+            client.close()
+            stop.set()
+        watcher = socketmap.TableWatcher(server, [], backend=mock.Mock(), on_generate=lookup)
+        socketmap.serve(server, watcher, stop)
+        self.assertEqual(replies, [([2], ("OK", "secure match=.provider.example"))])
+        self.assertRaises(socket.error, socketmap.Client, address)
+
+    def test_main(self):
+        with mock.patch("starttls_policy_cli.socketmap.load_test",
+                        return_value=({"OK": 6, "NOTFOUND": 4}, 0.5)) as load_test:
+            with mock.patch("starttls_policy_cli.socketmap.print", create=True) as output:
+                self.assertEqual(socketmap.main(["unix:/x.sock", "--policy-dir", self.tmpdir,
+                                                 "--requests", "10"]), 0)
+        load_test.assert_called_once_with(
+            "unix:/x.sock", ["A.com", "unknown.A.com", "b.com", "unknown.b.com",
+                             "c.com", "unknown.c.com"], 10, 4)
+        output.assert_any_call("10 lookups over 4 connections in 0.500s: 20 lookups/s")
+
+if __name__ == '__main__':
+    unittest.main()
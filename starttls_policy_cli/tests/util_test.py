@@ -2,10 +2,19 @@
 import unittest
 from functools import partial
 import datetime
-from dateutil import tz
+import errno
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import mock
+from dateutil import parser, tz
 
 from starttls_policy_cli import util
-from starttls_policy_cli.tests.util import param, parametrize_over
+from starttls_policy_cli.tests.util import assertRaisesRegex, param, parametrize_over
 
 class TestEnforceUtil(unittest.TestCase):
     """ Unittests for "enforcer" functions."""
@@ -41,6 +50,45 @@ class TestEnforceUtil(unittest.TestCase):
         func = partial(util.enforce_fields, partial(util.enforce_type, int))
         self.assertRaises(util.ConfigError, func, {"b": "a", "c": 2})
 
+    def compiled_enforcer_test(self, enforcer, value):
+        """Parametrized test: compiled enforcers behave like the original ones"""
+        compiled = util.compile_enforcer(enforcer)
+        self.assertFalse(compiled is enforcer)
+        try:
+            expected = enforcer(value)
+        except util.ConfigError as e:
+            with assertRaisesRegex(self, util.ConfigError, "^" + re.escape(str(e)) + "$"):
+                compiled(value)
+        else:
+            self.assertEqual(compiled(value), expected)
+
+    def test_compile_other_enforcer(self):
+        def enforcer(val):
+            return val
+        self.assertTrue(util.compile_enforcer(enforcer) is enforcer)
+        keyword = partial(util.enforce_type, type_=int)
+        self.assertTrue(util.compile_enforcer(keyword) is keyword)
+
+    def test_compile_unhashable_in(self):
+        func = util.compile_enforcer(partial(util.enforce_in, [["a"], ["b"]]))
+        self.assertEqual(func.func, util.enforce_in)
+        self.assertEqual(func(["a"]), ["a"])
+
+    def test_compile_schema(self):
+        compiled = util.compile_schema(util.POLICY_SCHEMA)
+        self.assertTrue(util.compile_schema(util.POLICY_SCHEMA) is compiled)
+        self.assertTrue(util.compile_schema(compiled) is compiled)
+        self.assertEqual(sorted(compiled), sorted(util.POLICY_SCHEMA))
+        self.assertEqual(len(compiled), len(util.POLICY_SCHEMA))
+        self.assertTrue(compiled['mode'] is util.POLICY_SCHEMA['mode'])
+        self.assertEqual(compiled.defaults, [('mode', 'testing')])
+        self.assertEqual(sorted(util.compile_schema(util.CONFIG_SCHEMA).required),
+                         ['expires', 'timestamp'])
+
+    def test_compile_schema_without_enforcer(self):
+        compiled = util.compile_schema({'author': 'Author field here'})
+        self.assertIsNone(compiled.enforcers['author'])
+
     def test_parse_bad_datestring(self):
         self.assertRaises(util.ConfigError, util.parse_valid_date, "fake")
 
@@ -69,6 +117,182 @@ parametrize_over(TestEnforceUtil, TestEnforceUtil.parse_valid_date_test,
                     param("valid_string_date_nocolon",
                           "2014-05-26T01:35:33+0000",
                           datetime.datetime(2014, 5, 26, 1, 35, 33, tzinfo=tz.tzutc())),
+                    param("valid_string_date_fallback",
+                          "May 26 2014 01:35:33",
+                          datetime.datetime(2014, 5, 26, 1, 35, 33, tzinfo=tz.tzutc())),
+                    param("valid_naive_datetime",
+                          datetime.datetime(2014, 5, 26, 1, 35, 33),
+                          datetime.datetime(2014, 5, 26, 1, 35, 33, tzinfo=tz.tzutc())),
+                 ])
+
+class TestParseDate(unittest.TestCase):
+    """ Unittests for the fast path of util.parse_valid_date."""
+
+    def same_as_dateutil_test(self, date):
+        """Parametrized test that the fast path agrees with dateutil"""
+        # pylint: disable=protected-access
+        result = util._parse_iso_date(date)
+        expected = parser.parse(date)
+        if expected.tzinfo is None:
+            expected = expected.replace(tzinfo=tz.tzutc())
+        self.assertEqual(result, expected)
+        self.assertEqual(result.utcoffset(), expected.utcoffset())
+        self.assertEqual(result.microsecond, expected.microsecond)
+
+    def test_invalid_values(self):
+        for date in ("2014-13-01T00:00:00Z", "2014-02-30T00:00:00Z", "2014-01-01T24:00:00Z",
+                     "2019-01-01T00:00:00+99:00", "2019-01-01T00:00:00-24:00",
+                     10 ** 20, -10 ** 20):
+            with self.assertRaises(util.ConfigError):
+                util.parse_valid_date(date)
+
+    def test_unusual_formats_use_fallback(self):
+        # pylint: disable=protected-access
+        for date in ("2014-05-26 01:35:33", "20140526T013533Z", "2014-05-26T01:35:33 +00:00",
+                     "2014-05-26T01:35:33+00:00\n", "2014-05-26"):
+            self.assertIsNone(util._parse_iso_date(date))
+            self.assertEqual(util.parse_valid_date(date).replace(tzinfo=None),
+                             parser.parse(date).replace(tzinfo=None))
+
+    def test_memoized(self):
+        date = "2014-05-26T01:35:33.5-07:00"
+        self.assertTrue(util.parse_valid_date(date) is util.parse_valid_date(date))
+        with mock.patch("starttls_policy_cli.util._parse_iso_date") as parse:
+            util.parse_valid_date(date)
+        self.assertFalse(parse.called)
+
+    def test_memo_is_bounded(self):
+        for i in range(util._PARSED_DATES_MAX * 2): # pylint: disable=protected-access
+            util.parse_valid_date(i)
+        self.assertTrue(len(util._parsed_dates) <= util._PARSED_DATES_MAX) # pylint: disable=protected-access
+
+    def test_unhashable(self):
+        self.assertRaises(util.ConfigError, util.parse_valid_date, ["2014"])
+
+    def test_dateutil_not_imported(self):
+        code = ("import sys; from starttls_policy_cli import util; "
+                "util.parse_valid_date('2018-06-18T09:41:50.264201364-07:00'); "
+                "util.parse_valid_date(0); "
+                "sys.exit('dateutil' in sys.modules)")
+        self.assertEqual(subprocess.call([sys.executable, "-c", code]), 0)
+
+    def test_fixed_timezone(self):
+        self.assertTrue(util.fixed_timezone(0) is util.UTC)
+        self.assertTrue(util.fixed_timezone(-25200) is util.fixed_timezone(-25200))
+        self.assertEqual(util.fixed_timezone(19800).utcoffset(None),
+                         datetime.timedelta(hours=5, minutes=30))
+
+parametrize_over(TestParseDate, TestParseDate.same_as_dateutil_test,
+                 [
+                    param("iso_utc_z", "2038-01-16T09:41:50Z"),
+                    param("iso_nanoseconds", "2018-06-18T09:41:50.264201364-07:00"),
+                    param("iso_milliseconds", "2018-06-18T09:41:50.264+05:30"),
+                    param("iso_encoder_format", "2018-06-18T09:41:50-0700"),
+                    param("iso_no_timezone", "2018-06-18T09:41:50"),
+                    param("iso_negative_zero", "2018-06-18T09:41:50-00:00"),
+                 ])
+
+class TestAtomicFile(unittest.TestCase):
+    """ Unittests for atomic file replacement."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "output")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with open(self.filename) as f:
+            return f.read()
+
+    def test_commit(self):
+        with util.AtomicFile(self.filename) as f:
+            f.write("new")
+            self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(self._read(), "new")
+        self.assertEqual(os.listdir(self.tmpdir), ["output"])
+
+    def test_check_before_commit(self):
+        with util.AtomicFile(self.filename) as f:
+            f.write("new")
+            f.flush()
+            with open(f.tmp_filename) as written:
+                self.assertEqual(written.read(), "new")
+        self.assertFalse(os.path.exists(f.tmp_filename))
+        self.assertEqual(self._read(), "new")
+
+    def test_replace_keeps_mode(self):
+        with open(self.filename, "w") as f:
+            f.write("old")
+        os.chmod(self.filename, 0o640)
+        with util.AtomicFile(self.filename) as f:
+            f.write("new")
+        self.assertEqual(self._read(), "new")
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0o640)
+
+    def test_error_discards(self):
+        with open(self.filename, "w") as f:
+            f.write("old")
+        with self.assertRaises(RuntimeError):
+            with util.AtomicFile(self.filename) as f:
+                f.write("partial")
+                raise RuntimeError
+        self.assertEqual(self._read(), "old")
+        self.assertEqual(os.listdir(self.tmpdir), ["output"])
+
+    def test_fsync(self):
+        with mock.patch("os.fsync") as fsync:
+            with util.AtomicFile(self.filename, fsync=True) as f:
+                f.write("new")
+        self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(self._read(), "new")
+
+    def test_name_collision(self):
+        real_open = os.open
+        def fake_open(*args):
+            if fake_open.collided:
+                return real_open(*args)
+            fake_open.collided = True
+            raise OSError(errno.EEXIST, "exists")
+        fake_open.collided = False
+        with mock.patch("os.open", side_effect=fake_open) as mock_open:
+            with util.AtomicFile(self.filename) as f:
+                f.write("new")
+        self.assertEqual(mock_open.call_count, 2)
+        self.assertEqual(self._read(), "new")
+
+    def test_unwritable_directory(self):
+        with self.assertRaises(OSError):
+            util.AtomicFile(os.path.join(self.tmpdir, "missing", "output"))
+
+    def test_stat_error(self):
+        with mock.patch("os.stat", side_effect=OSError(errno.EACCES, "denied")):
+            with self.assertRaises(OSError):
+                with util.AtomicFile(self.filename) as f:
+                    f.write("new")
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+_str_list = partial(util.enforce_list, partial(util.enforce_type, str))
+_int_list = partial(util.enforce_list, partial(util.enforce_in, (0, 1)))
+_fields = partial(util.enforce_fields, partial(util.enforce_type, int))
+
+parametrize_over(TestEnforceUtil, TestEnforceUtil.compiled_enforcer_test,
+                 [
+                    param("compiled_in", partial(util.enforce_in, ("a", "b")), "a"),
+                    param("compiled_in_bad", partial(util.enforce_in, ("a", "b")), "c"),
+                    param("compiled_in_unhashable", partial(util.enforce_in, ("a", "b")), ["a"]),
+                    param("compiled_type", partial(util.enforce_type, int), 1),
+                    param("compiled_type_bad", partial(util.enforce_type, int), "a"),
+                    param("compiled_object", partial(util.enforce_type, object), None),
+                    param("compiled_list", _str_list, ["a", "b"]),
+                    param("compiled_list_bad", _str_list, ["a", 2]),
+                    param("compiled_list_not_iterable", _str_list, True),
+                    param("compiled_list_generic", _int_list, [0, 1]),
+                    param("compiled_list_generic_bad", _int_list, [2]),
+                    param("compiled_list_generic_not_iterable", _int_list, 5),
+                    param("compiled_fields", _fields, {"a": 0}),
+                    param("compiled_fields_bad", _fields, {"a": "b"}),
                  ])
 
 parametrize_over(TestEnforceUtil, TestEnforceUtil.is_expired_test,
@@ -0,0 +1,195 @@
+""" Tests for watch.py """
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import timeit
+
+import mock
+
+from starttls_policy_cli import configure
+from starttls_policy_cli import watch
+
+test_json = """{
+    "timestamp": "2018-06-18T09:41:50-07:00",
+    "expires": "2038-01-16T09:41:50-07:00",
+    "policies": {
+        "a.com": {"mode": "enforce", "mxs": ["mx.a.com"]}
+    }
+}"""
+
+class FakeBackend(object):
+    # pylint: disable=useless-object-inheritance
+    """Backend reporting a change for each queued True, then nothing."""
+
+    def __init__(self, changes=()):
+        self.changes = list(changes)
+        self.timeouts = []
+        self.closed = False
+
+    def wait(self, timeout):
+        # pylint: disable=missing-docstring
+        self.timeouts.append(timeout)
+        return self.changes.pop(0) if self.changes else False
+
+    def close(self):
+        # pylint: disable=missing-docstring
+        self.closed = True
+
+class TestBackends(unittest.TestCase):
+    """Tests for waiting for changes to files"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "policy.json")
+        with open(self.filename, "w") as f:
+            f.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _replace(self, contents):
+        other = os.path.join(self.tmpdir, "policy.json.new")
+        with open(other, "w") as f:
+            f.write(contents)
+        os.rename(other, self.filename)
+
+    def test_polling(self):
+        backend = watch.PollingBackend([self.filename], interval=0.01)
+        self.assertFalse(backend.wait(0.02))
+        self._replace('{"policies": {}}')
+        self.assertTrue(backend.wait(0.02))
+        self.assertFalse(backend.wait(0))
+        os.remove(self.filename)
+        self.assertTrue(backend.wait(0))
+
+    def test_inotify(self):
+        try:
+            backend = watch.InotifyBackend([self.filename])
+        except OSError:
+            self.skipTest("inotify is not available")
+        try:
+            self.assertFalse(backend.wait(0.01))
+            with open(os.path.join(self.tmpdir, "unrelated"), "w") as f:
+                f.write("x")
+            self.assertFalse(backend.wait(0.01))
+            self._replace('{"policies": {}}')
+            self.assertTrue(backend.wait(1))
+        finally:
+            backend.close()
+
+    def test_backend_for(self):
+        with mock.patch("starttls_policy_cli.watch.InotifyBackend", side_effect=OSError):
+            backend = watch.backend_for([self.filename], interval=5)
+        self.assertTrue(isinstance(backend, watch.PollingBackend))
+        self.assertEqual(backend.interval, 5)
+
+class TestPolicyWatcher(unittest.TestCase):
+    """Tests for keeping configuration files up to date"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "policy.json")
+        self.output = os.path.join(self.tmpdir, "postfix_tls_policy")
+        self._write(test_json)
+        self.backend = FakeBackend()
+        self.results = []
+        self.watcher = watch.PolicyWatcher([configure.PostfixGenerator(self.tmpdir)],
+                                           [self.filename], debounce=0.5, interval=10,
+                                           on_generate=self.results.append,
+                                           backend=self.backend)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, contents):
+        with open(self.filename, "w") as f:
+            f.write(contents)
+
+    def _output(self):
+        with open(self.output) as f:
+            return f.read()
+
+    def test_regenerates_on_change(self):
+        self.watcher.generate()
+        self.assertEqual(self.watcher.regenerations, 1)
+        self.assertTrue("a.com" in self._output())
+        self.assertFalse(self.watcher.step())
+        self.assertEqual(self.backend.timeouts, [10])
+        self._write(test_json.replace('"a.com"', '"b.com"'))
+        # A burst of three events is debounced into one regeneration.
+        self.backend.changes = [True, True, True]
+        self.assertTrue(self.watcher.step())
+        self.assertEqual(self.backend.timeouts[-3:], [0.5, 0.5, 0.5])
+        self.assertEqual(self.watcher.regenerations, 2)
+        self.assertTrue("b.com" in self._output())
+        self.assertEqual(len(self.results), 2)
+        self.assertTrue(self.results[-1])
+
+    def test_ignores_unchanged_contents(self):
+        self.watcher.generate()
+        # Touching the file changes its status, but not its contents.
+        os.utime(self.filename, (time.time() + 10, time.time() + 10))
+        self.backend.changes = [True]
+        self.assertFalse(self.watcher.step())
+        self.assertEqual(self.watcher.regenerations, 1)
+
+    def test_keeps_policy_list_when_invalid(self):
+        self.watcher.generate()
+        policy_list = self.watcher.generators[0].policy_list
+        self._write("{not json")
+        self.backend.changes = [True]
+        with mock.patch("sys.stderr") as stderr:
+            self.assertFalse(self.watcher.step())
+        written = "".join(call[0][0] for call in stderr.write.call_args_list)
+        self.assertTrue(written.startswith("Keeping the policy list loaded before:"))
+        self.assertTrue(self.watcher.generators[0].policy_list is policy_list)
+        self.assertEqual(self.watcher.regenerations, 1)
+        # The same invalid contents aren't reloaded again.
+        self.backend.changes = [True]
+        with mock.patch("sys.stderr") as stderr:
+            self.assertFalse(self.watcher.step())
+        stderr.write.assert_not_called()
+
+    def test_first_load_fails(self):
+        self._write("{not json")
+        self.assertRaises(ValueError, self.watcher.generate)
+
+    def test_regenerates_on_expiry(self):
+        with mock.patch("starttls_policy_cli.util.is_expired", return_value=False):
+            self.watcher.generate()
+        self.assertTrue(self.watcher.backend.timeouts == [])
+        with mock.patch("starttls_policy_cli.util.is_expired", return_value=True):
+            with mock.patch("sys.stdout"):
+                self.assertTrue(self.watcher.step())
+            self.assertTrue("Falling back" in self._output())
+            self.assertEqual(self.watcher.regenerations, 2)
+            # Once expired, it isn't regenerated again until the list changes.
+            self.assertFalse(self.watcher.step())
+        self.assertEqual(self.watcher.regenerations, 2)
+
+    def test_profile_each_run(self):
+        self.watcher.profile = True
+        self.watcher.generate()
+        first = self.watcher.profiler
+        self.assertTrue("load" in first.times)
+        self._write(test_json.replace('"a.com"', '"b.com"'))
+        self.backend.changes = [True]
+        start = timeit.default_timer()
+        self.assertTrue(self.watcher.step())
+        elapsed = timeit.default_timer() - start
+        # Only the run is timed, not the time since the first one.
+        self.assertFalse(self.watcher.profiler is first)
+        self.assertTrue(0 < self.watcher.profiler.total <= elapsed)
+
+    def test_run(self):
+        stop = mock.Mock()
+        stop.is_set.side_effect = [False, False, True]
+        self.watcher.run(stop)
+        self.assertEqual(self.watcher.regenerations, 1)
+        self.assertEqual(self.backend.timeouts, [10, 10])
+        self.assertTrue(self.backend.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,21 @@
 """ Utils for transforming and linting the config. """
 
 import datetime
+import errno
 from functools import partial
+import binascii
+import hashlib
+import os
+import re
 import six
-from dateutil import parser, tz # Dependency: python-dateutil
+
+from starttls_policy_cli import profiling
+
+try:
+    # Python 3.3+
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 
 class ConfigError(ValueError):
@@ -48,32 +60,377 @@ def enforce_fields(enforcer, obj):
         raise ConfigError('Configuration value {} has a bad type: '.format(obj) + str(e))
     return obj
 
+def file_digest(filename, chunk_size=64 * 1024):
+    """ Returns the hex SHA-256 digest of the contents of `filename`. """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(chunk_size)
+    return digest.hexdigest()
+
+class AtomicFile(object):
+    # pylint: disable=useless-object-inheritance
+    """ Writable file that replaces `filename` atomically.
+
+    Data is written to a temporary file in the same directory, which is
+    renamed over `filename` by `commit()`, so readers only ever see the old
+    or the new complete file. If `fsync` is set, the data (and the directory
+    entry) are flushed to disk before and after the rename. If
+    `keep_unchanged` is set and the new content hashes the same as the
+    existing file, the existing file is left untouched (including its mtime).
+    When used as a context manager, the file is committed on success and
+    discarded if an exception is raised; `changed` then tells whether
+    `filename` was replaced.
+    """
+
+    def __init__(self, filename, mode="w", fsync=False, keep_unchanged=False):
+        # pylint: disable=too-many-arguments
+        self.filename = filename
+        self.changed = None
+        self._fsync = fsync
+        self._keep_unchanged = keep_unchanged
+        while True:
+            self._tmp_filename = "{}.{}.tmp".format(
+                filename, binascii.hexlify(os.urandom(6)).decode("ascii"))
+            try:
+                # Mode 0666 lets the umask decide, as for a plain `open`.
+                fd = os.open(self._tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._file = os.fdopen(fd, mode)
+
+    @property
+    def tmp_filename(self):
+        """ Path of the temporary file, e.g. to check what was written
+        (after `flush`) before committing it. """
+        return self._tmp_filename
+
+    def write(self, data):
+        """ Writes `data` to the temporary file. """
+        self._file.write(data)
+
+    def flush(self):
+        """ Flushes the data written so far to the temporary file. """
+        self._file.flush()
+
+    def seek(self, offset, whence=0):
+        """ Moves the write position within the temporary file. """
+        self._file.seek(offset, whence)
+
+    def _unchanged(self):
+        """ Whether the temporary file has the same content as `filename`. """
+        try:
+            if os.path.getsize(self.filename) != os.path.getsize(self._tmp_filename):
+                return False
+        except OSError:
+            return False
+        return file_digest(self.filename) == file_digest(self._tmp_filename)
+
+    def commit(self):
+        """ Closes the temporary file and renames it over `filename`,
+        keeping the permissions of the file it replaces.
+        Returns False if `filename` was kept because its content is unchanged. """
+        committed = False
+        try:
+            self._file.flush()
+            self._file.close()
+            if self._keep_unchanged and self._unchanged():
+                self.changed = False
+                return False
+            if self._fsync:
+                fd = os.open(self._tmp_filename, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            try:
+                os.chmod(self._tmp_filename, os.stat(self.filename).st_mode & 0o7777)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            getattr(os, "replace", os.rename)(self._tmp_filename, self.filename)
+            committed = True
+        finally:
+            if not committed:
+                self.discard()
+        if self._fsync:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self.changed = True
+        return True
+
+    def discard(self):
+        """ Closes and removes the temporary file, leaving `filename` as it was. """
+        self._file.close()
+        os.remove(self._tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
 # Extra JSON decoding/encoding helpers
 
 def as_attr(s):
     """ Replaces dashes with underscores, so `s` can be a python attribute :) """
     return s.replace('-', '_')
 
+try:
+    # Python 3.2+
+    UTC = datetime.timezone.utc
+
+    def _new_timezone(minutes):
+        return datetime.timezone(datetime.timedelta(minutes=minutes))
+except AttributeError:
+    class _FixedOffset(datetime.tzinfo):
+        """ Fixed offset from UTC, like Python 3's `datetime.timezone`. """
+        # pylint: disable=unused-argument
+
+        def __init__(self, minutes):
+            super(_FixedOffset, self).__init__()
+            self._offset = datetime.timedelta(minutes=minutes)
+
+        def utcoffset(self, dt):
+            return self._offset
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            minutes = self._offset.days * 1440 + self._offset.seconds // 60
+            sign = "-" if minutes < 0 else "+"
+            return "UTC{}{:02d}:{:02d}".format(sign, *divmod(abs(minutes), 60))
+
+        def __repr__(self):
+            return "{}({})".format(self.__class__.__name__, self.tzname(None))
+
+    UTC = _FixedOffset(0)
+    _new_timezone = _FixedOffset
+
+_timezones = {0: UTC}
+
+def fixed_timezone(seconds):
+    """ Returns a tzinfo for the fixed offset of `seconds` east of UTC,
+    rounded down to whole minutes. """
+    minutes = seconds // 60
+    timezone = _timezones.get(minutes)
+    if timezone is None:
+        timezone = _timezones[minutes] = _new_timezone(minutes)
+    return timezone
+
+# The format `ConfigEncoder` writes, and RFC 3339 timestamps like the ones in
+# the published policy list (with nanoseconds, which are truncated).
+_ISO_DATE = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,9}))?"
+                       r"(?:Z|([+-])(\d\d):?(\d\d))?\Z")
+
+# Memoizes `parse_valid_date`, e.g. for the same dates in many merged configs.
+_parsed_dates = {}
+_PARSED_DATES_MAX = 256
+
+def _parse_iso_date(date):
+    """ Parses `date` if it is in the strict format of `_ISO_DATE`,
+    otherwise returns None. """
+    match = _ISO_DATE.match(date)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, sign, tz_hours, tz_minutes = \
+        match.groups()
+    microsecond = int(fraction[:6].ljust(6, "0")) if fraction else 0
+    timezone = UTC
+    try:
+        if sign is not None:
+            offset = int(tz_hours) * 3600 + int(tz_minutes) * 60
+            # datetime only supports offsets of less than a day.
+            if offset >= 24 * 3600:
+                raise ValueError("UTC offset out of range")
+            timezone = fixed_timezone(-offset if sign == "-" else offset)
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute),
+                                 int(second), microsecond, timezone)
+    except ValueError:
+        raise ConfigError("Invalid date: {}".format(date))
+
 def parse_valid_date(date):
     """ Date parser. `date` can be either an integer (in which it's
     interpreted as seconds since the epoch) or a formatted
-    string that `dateutils.parser` can understand."""
+    string that `dateutils.parser` can understand.
+    ISO 8601 timestamps in the format the policy list uses are parsed
+    directly; `dateutil` is only imported for other formats."""
     if isinstance(date, datetime.datetime):
-        result = date
-    elif isinstance(date, int):
-        result = datetime.datetime.fromtimestamp(date, tz.tzutc())
-    else:
-        try: # Fallback: try to parse a string-like
-            result = parser.parse(date)
-        except (TypeError, ValueError):
-            raise ConfigError("Invalid date: {}".format(date))
+        if date.tzinfo is None or date.tzinfo.utcoffset(date) is None:
+            date = date.replace(tzinfo=UTC)
+        return date
+    cacheable = isinstance(date, (six.string_types, int))
+    if cacheable:
+        result = _parsed_dates.get(date)
+        if result is not None:
+            return result
+    with profiling.phase("dates"):
+        if isinstance(date, int):
+            try:
+                result = datetime.datetime.fromtimestamp(date, UTC)
+            except (OverflowError, OSError, ValueError):
+                # Out of the range of datetime or of the platform's time_t.
+                raise ConfigError("Invalid date: {}".format(date))
+        else:
+            result = None
+            if isinstance(date, six.string_types):
+                result = _parse_iso_date(date)
+            if result is None:
+                result = _parse_other_date(date)
+    if cacheable:
+        if len(_parsed_dates) >= _PARSED_DATES_MAX:
+            _parsed_dates.clear()
+        _parsed_dates[date] = result
+    return result
+
+def _parse_other_date(date):
+    """ Parses `date` with `dateutil`, as UTC if it has no timezone. """
+    # Imported here, since it is slow to import and rarely needed.
+    from dateutil import parser # pylint: disable=import-outside-toplevel
+    try: # Fallback: try to parse a string-like
+        result = parser.parse(date)
+    except (TypeError, ValueError, OverflowError):
+        raise ConfigError("Invalid date: {}".format(date))
     if result.tzinfo is None or result.tzinfo.utcoffset(result) is None:
-        result = result.replace(tzinfo=tz.tzutc())
+        result = result.replace(tzinfo=UTC)
     return result
 
 def is_expired(exp):
     """ Checks if given expiration datetime is reached at this moment. """
-    return exp <= datetime.datetime.now(tz.tzutc())
+    return exp <= datetime.datetime.now(UTC)
+
+def _identity(val):
+    return val
+
+def _compile_type(type_):
+    if type_ is object:
+        return _identity
+    def enforce(val):
+        if isinstance(val, type_):
+            return val
+        raise ConfigError('Configuration value {} is not of type {}'.format(val, type_))
+    return enforce
+
+def _compile_in(possible):
+    try:
+        members = frozenset(possible)
+    except TypeError:
+        return partial(enforce_in, possible)
+    def enforce(val):
+        try:
+            if val in members:
+                return val
+        except TypeError: # unhashable values are never members
+            pass
+        raise ConfigError('Configuration value {} is not one of {}'.format(
+                              val, ', '.join(possible)))
+    return enforce
+
+def _compile_list(enforcer):
+    type_ = _checked_type(enforcer)
+    def enforce(list_):
+        try:
+            if type_ is not None:
+                for val in list_:
+                    if not isinstance(val, type_):
+                        raise ConfigError('Configuration value {} is not of type {}'.format(
+                                              val, type_))
+            else:
+                for val in list_:
+                    enforcer(val)
+        except TypeError as e:
+            raise ConfigError('Configuration value {} has a bad type: '.format(list_) + str(e))
+        return list_
+    return enforce
+
+def _compile_fields(enforcer):
+    compiled = compile_enforcer(enforcer)
+    def enforce(obj):
+        try:
+            for val in obj.values():
+                compiled(val)
+        except (TypeError, ConfigError) as e:
+            raise ConfigError('Configuration value {} has a bad type: '.format(obj) + str(e))
+        return obj
+    return enforce
+
+def _checked_type(enforcer):
+    """ If `enforcer` is a plain `enforce_type` check, returns the checked type. """
+    if isinstance(enforcer, partial) and enforcer.func is enforce_type \
+            and len(enforcer.args) == 1 and not enforcer.keywords:
+        return enforcer.args[0]
+    return None
+
+_COMPILERS = {
+    enforce_type: _compile_type,
+    enforce_in: _compile_in,
+    enforce_list: _compile_list,
+    enforce_fields: _compile_fields,
+}
+
+def compile_enforcer(enforcer):
+    """ Returns a function equivalent to `enforcer`, with the `enforce_*`
+    partials used in schema definitions unrolled into specialized checks.
+    Other callables are returned unchanged. """
+    if isinstance(enforcer, partial) and len(enforcer.args) == 1 and not enforcer.keywords:
+        compiler = _COMPILERS.get(enforcer.func)
+        if compiler is not None:
+            return compiler(enforcer.args[0])
+    return enforcer
+
+class CompiledSchema(Mapping):
+    """ A schema definition with its field properties resolved ahead of time.
+    Reads like the original schema dict; additionally, `enforcers` maps each
+    field to its compiled enforcer (or None if it has none), `defaults` lists
+    (field, default) pairs and `required` lists required fields.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.enforcers = {}
+        self.defaults = []
+        self.required = []
+        for key, subschema in six.iteritems(schema):
+            enforce, default, required = get_properties(subschema)
+            self.enforcers[key] = compile_enforcer(enforce) if callable(enforce) else None
+            if default:
+                self.defaults.append((key, default))
+            if required:
+                self.required.append(key)
+
+    def __getitem__(self, key):
+        return self.schema[key]
+
+    def __iter__(self):
+        return iter(self.schema)
+
+    def __len__(self):
+        return len(self.schema)
+
+_compiled_schemas = {}
+
+def compile_schema(schema):
+    """ Returns the `CompiledSchema` for `schema`, compiling it on first use.
+    Schemas are compiled once, so they shouldn't be modified afterwards. """
+    compiled = _compiled_schemas.get(id(schema))
+    if compiled is not None and compiled.schema is schema:
+        return compiled
+    if isinstance(schema, CompiledSchema):
+        return schema
+    compiled = CompiledSchema(schema)
+    _compiled_schemas[id(schema)] = compiled
+    return compiled
 
 def get_properties(schema):
     """ Return the three properties we have to enforce for this schema.
@@ -124,6 +481,17 @@ CONFIG_SCHEMA = {
             'enforce': partial(enforce_type, datetime.datetime),
             'required': True,
             },
-        'policies': partial(enforce_fields, partial(enforce_type, object)),
+        # Individual policies are validated by `policy.Config` itself, possibly lazily.
+        'policies': partial(enforce_type, Mapping),
         'policy-aliases': partial(enforce_fields, partial(enforce_type, object)),
 }
+
+# Overlays layered on top of a policy list (see `policy.merge_all`) only
+# need the fields they override.
+OVERLAY_SCHEMA = dict(CONFIG_SCHEMA,
+                      expires=partial(enforce_type, datetime.datetime),
+                      timestamp=partial(enforce_type, datetime.datetime))
+
+compile_schema(POLICY_SCHEMA)
+compile_schema(CONFIG_SCHEMA)
+compile_schema(OVERLAY_SCHEMA)
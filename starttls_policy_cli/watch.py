@@ -0,0 +1,280 @@
+""" Long-running mode that regenerates configuration files when the policy list changes.
+
+The policy list stays loaded between regenerations. The directories of the
+policy files are watched with inotify on Linux, or by polling the files'
+status elsewhere. The directories are watched rather than the files,
+since policy lists are usually updated by renaming a new file into place.
+"""
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from starttls_policy_cli import configure
+from starttls_policy_cli import profiling
+from starttls_policy_cli import util
+
+# Seconds to wait for a burst of changes to settle before regenerating.
+DEFAULT_DEBOUNCE = 2.0
+# Longest time to sleep between checks, and the polling interval without inotify.
+DEFAULT_INTERVAL = 30.0
+
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+class InotifyBackend(object):
+    # pylint: disable=useless-object-inheritance
+    """ Waits for changes to `filenames` with Linux's inotify, through
+    `ctypes`. Raises OSError if inotify isn't available. """
+
+    def __init__(self, filenames):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "libc doesn't support inotify")
+        self._fd = init(_IN_CLOEXEC | _IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._names = {}
+        for filename in filenames:
+            directory, name = os.path.split(os.path.abspath(filename))
+            self._names.setdefault(directory, set()).add(name)
+        self._directories = {}
+        try:
+            for directory in self._names:
+                wd = self._add_watch(self._fd, directory.encode(sys.getfilesystemencoding()),
+                                     _IN_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), "Can't watch {}".format(directory))
+                self._directories[wd] = directory
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        """ Stops watching. """
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _relevant(self, data):
+        pos = 0
+        relevant = False
+        while pos + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            pos += length
+            if mask & _IN_Q_OVERFLOW or name in self._names.get(self._directories.get(wd), ()):
+                relevant = True
+        return relevant
+
+    def wait(self, timeout):
+        """ Waits up to `timeout` seconds for a watched file to change.
+        Returns whether one did (or may have). """
+        deadline = time.time() + timeout
+        while True:
+            remaining = max(0, deadline - time.time())
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                return False
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                continue
+            if self._relevant(data):
+                return True
+
+class PollingBackend(object):
+    # pylint: disable=useless-object-inheritance
+    """ Waits for changes to `filenames` by checking their status every
+    `interval` seconds. """
+
+    def __init__(self, filenames, interval=DEFAULT_INTERVAL):
+        self._filenames = list(filenames)
+        self.interval = interval
+        self._status = self._stat()
+
+    def _stat(self):
+        status = []
+        for filename in self._filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                status.append(None)
+            else:
+                status.append((stat.st_ino, stat.st_size, stat.st_mtime))
+        return status
+
+    def close(self):
+        """ Stops watching. """
+
+    def wait(self, timeout):
+        """ Waits up to `timeout` seconds for a watched file to change.
+        Returns whether one did. """
+        deadline = time.time() + timeout
+        while True:
+            status = self._stat()
+            if status != self._status:
+                self._status = status
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+def backend_for(filenames, interval=DEFAULT_INTERVAL):
+    """ Returns an `InotifyBackend` for `filenames` if inotify is
+    available, otherwise a `PollingBackend`. """
+    try:
+        return InotifyBackend(filenames)
+    except OSError:
+        return PollingBackend(filenames, interval)
+
+class PolicyWatcher(object):
+    # pylint: disable=useless-object-inheritance,too-many-instance-attributes
+    """ Keeps configuration files up to date with the policy files.
+
+    `generators` are run with `configure.generate_all` on the policy list
+    they share. They run again, with the policy list reloaded, when the
+    contents of one of `filenames` (the policy list and any overlays)
+    change. Changes are debounced: regeneration waits until no change has
+    been seen for `debounce` seconds. They also run once when the policy
+    list expires, so the expired fallback configuration is written on time.
+
+    If given, `on_generate` is called with the results of each run.
+    `regenerations` counts the runs. If `profile` is set, each run is timed
+    by a new `profiling.Profiler`, left in `profiler` for `on_generate`.
+    """
+
+    def __init__(self, generators, filenames, incremental=False, debounce=DEFAULT_DEBOUNCE,
+                 interval=DEFAULT_INTERVAL, on_generate=None, backend=None, profile=False):
+        # pylint: disable=too-many-arguments
+        self.generators = list(generators)
+        self.filenames = list(filenames)
+        self.incremental = incremental
+        self.debounce = debounce
+        self.interval = interval
+        self.on_generate = on_generate
+        self.backend = backend or backend_for(self.filenames, interval)
+        self.regenerations = 0
+        self.profile = profile
+        self.profiler = None
+        self._fingerprint = None
+        self._expired = False
+
+    def _contents(self):
+        """ Identifies the contents of the policy files. """
+        fingerprint = []
+        for filename in self.filenames:
+            try:
+                fingerprint.append(util.file_digest(filename))
+            except (IOError, OSError):
+                fingerprint.append(None)
+        return fingerprint
+
+    def _reload(self):
+        """ Reloads the policy list. If it can't be loaded (e.g. the new
+        policy list is invalid), keeps the one that is loaded, if any, and
+        returns False. """
+        previous = None
+        if self._fingerprint is not None:
+            previous = self.generators[0].policy_list
+        self._fingerprint = self._contents()
+        self.generators[0].policy_list = None
+        try:
+            self.generators[0].policy_list # pylint: disable=pointless-statement
+        except (IOError, OSError, ValueError) as e:
+            if previous is None:
+                raise
+            print("Keeping the policy list loaded before: {}".format(e), file=sys.stderr)
+            self.generators[0].policy_list = previous
+            return False
+        return True
+
+    def generate(self, reload_policy=True):
+        """ Runs the generators, first reloading the policy list unless
+        `reload_policy` is False. Returns their results, or None if the
+        policy list couldn't be reloaded. """
+        if self.profile:
+            with profiling.Profiler() as profiler:
+                results = self._reload_and_run(reload_policy)
+            self.profiler = profiler
+        else:
+            results = self._reload_and_run(reload_policy)
+        if results is None:
+            return None
+        self.regenerations += 1
+        if self.on_generate is not None:
+            self.on_generate(results)
+        return results
+
+    def _reload_and_run(self, reload_policy):
+        """ The run of `generate`, apart from counting and reporting it. """
+        if reload_policy and not self._reload():
+            return None
+        results = self._run()
+        self._expired = util.is_expired(self.generators[0].policy_list.expires)
+        return results
+
+    def _run(self):
+        """ Runs the generators on the loaded policy list. Returns their results. """
+        return configure.generate_all(self.generators, incremental=self.incremental)
+
+    def _until_expiry(self):
+        """ Seconds until the policy list expires, or None if it has already. """
+        if self._expired:
+            return None
+        remaining = (self.generators[0].policy_list.expires -
+                     datetime.datetime.now(util.UTC))
+        return max(0.0, remaining.days * 86400 + remaining.seconds +
+                   remaining.microseconds / 1e6)
+
+    def step(self):
+        """ Waits for the next change to the policy files or for the policy
+        list to expire, whichever comes first, and regenerates if needed.
+        Waits at most `interval` seconds. Returns whether it regenerated. """
+        timeout = self.interval
+        until_expiry = self._until_expiry()
+        if until_expiry is not None:
+            timeout = min(timeout, until_expiry)
+        if self.backend.wait(timeout):
+            while self.backend.wait(self.debounce):
+                pass
+            if self._contents() != self._fingerprint and self.generate() is not None:
+                return True
+        if until_expiry is not None and util.is_expired(self.generators[0].policy_list.expires):
+            self.generate(reload_policy=False)
+            return True
+        return False
+
+    def run(self, stop=None):
+        """ Generates the configuration files, then keeps them up to date
+        until `stop` (a `threading.Event`) is set, if given, or forever. """
+        try:
+            self.generate()
+            while stop is None or not stop.is_set():
+                self.step()
+        finally:
+            self.backend.close()